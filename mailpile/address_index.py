@@ -0,0 +1,299 @@
+import math
+import re
+from array import array
+from heapq import nlargest
+
+import mailpile.util
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+from mailpile.search_sets import IdSet
+from mailpile.util import *
+
+
+class AddressIndex(object):
+    #
+    # This is an in-memory index of e-mail addresses and names, for
+    # autocompletion and contact searches.
+    #
+    # Every entry is indexed by the trigrams of the words in its (lowercased)
+    # text and by the one and two letter prefixes of each word. A search
+    # term of three letters or more matches entries containing it as a
+    # substring, shorter terms match the beginnings of words, which is
+    # what people type when completing a name. Posting lists are IdSets,
+    # so multi-term searches are intersections.
+    #
+    # Entries are ranked by "frecency": every time an address is seen in
+    # a message, exp((ts - epoch) / tau) is added to its score, which we
+    # store as a logarithm. Old messages thus count for less and less, and
+    # ranking does not depend on the current time.
+    #
+    # To avoid scoring every match of a common term ("com", say), we keep
+    # a ranking of all entries, which is rebuilt when enough of them have
+    # changed, and walk that until we have enough matches. Entries changed
+    # since the ranking was built are checked separately and merged in, so
+    # results are always in exact rank order.
+    #
+    # This class does no locking, callers must do that.
+    #
+    HALF_LIFE = 90 * 24 * 3600
+    WORD_RE = re.compile(r'[^\w]+', re.UNICODE)
+    RERANK_MIN = 1000
+
+    def __init__(self):
+        self.keys = []
+        self.ids = {}
+        self.text = []
+        self.score = array('d')
+        self.grams = {}
+        self._ranked = array('i')
+        self._changed = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    @classmethod
+    def Words(cls, text):
+        return [w for w in cls.WORD_RE.split(text) if w]
+
+    @classmethod
+    def Grams(cls, text):
+        """
+        Return the keys an entry is indexed under.
+
+        >>> sorted(AddressIndex.Grams(u'bo@x.is'))
+        [u'^b', u'^bo', u'^i', u'^is', u'^x']
+        >>> sorted(AddressIndex.Grams(u'bob'))
+        [u'^b', u'^bo', u'bob']
+        """
+        grams = set()
+        for word in set(cls.Words(text)):
+            grams.add(u'^' + word[:1])
+            grams.add(u'^' + word[:2])
+            grams.update(word[i:i + 3] for i in range(0, len(word) - 2))
+        return grams
+
+    def _new_entry(self, key):
+        eid = self.ids[key] = len(self.keys)
+        self.keys.append(key)
+        self.text.append(u'')
+        self.score.append(0.0)
+        self._changed.add(eid)
+        return eid
+
+    def add(self, key, text):
+        """Add an entry, or update the text of an existing one."""
+        text = text.lower()
+        eid = self.ids.get(key)
+        if eid is None:
+            eid = self._new_entry(key)
+        old_grams = self.Grams(self.text[eid])
+        new_grams = self.Grams(text)
+        for gram in old_grams - new_grams:
+            self.grams[gram].discard(eid)
+        for gram in new_grams - old_grams:
+            if gram not in self.grams:
+                self.grams[gram] = IdSet()
+            self.grams[gram].add(eid)
+        self.text[eid] = text
+
+    def add_many(self, entries):
+        """Add many (key, text) entries at once, much faster than add()."""
+        new_grams = {}
+        for key, text in entries:
+            if key in self.ids:
+                self.add(key, text)
+                continue
+            eid = self._new_entry(key)
+            self.text[eid] = text = text.lower()
+            for gram in self.Grams(text):
+                if gram in new_grams:
+                    new_grams[gram].append(eid)
+                else:
+                    new_grams[gram] = [eid]
+        for gram, eids in new_grams.iteritems():
+            if gram in self.grams:
+                self.grams[gram].update(IdSet.FromSorted(eids))
+            else:
+                self.grams[gram] = IdSet.FromSorted(eids)
+
+    def remove(self, key):
+        eid = self.ids.pop(key, None)
+        if eid is not None:
+            for gram in self.Grams(self.text[eid]):
+                self.grams[gram].discard(eid)
+            self.keys[eid] = None
+            self.text[eid] = u''
+
+    def seen(self, key, ts):
+        """Record that an address was seen in a message at a given time."""
+        eid = self.ids.get(key)
+        if eid is not None:
+            x = float(ts) * math.log(2) / self.HALF_LIFE
+            s = self.score[eid]
+            if s:
+                hi, lo = max(s, x), min(s, x)
+                x = hi + math.log1p(math.exp(lo - hi))
+            self.score[eid] = x
+            self._changed.add(eid)
+
+    def rank(self, key):
+        eid = self.ids.get(key)
+        return self.score[eid] if (eid is not None) else 0.0
+
+    def set_rank(self, key, score):
+        """Restore a score saved from rank(), replacing the current one."""
+        eid = self.ids.get(key)
+        if eid is not None:
+            self.score[eid] = score
+            self._changed.add(eid)
+
+    def rerank(self):
+        """Rebuild the ranking of all entries, which speeds up searches."""
+        self._ranked = array('i', sorted(
+            (e for e in xrange(0, len(self.keys)) if self.keys[e] is not None),
+            key=self.score.__getitem__, reverse=True))
+        self._changed = set()
+
+    def _conditions(self, terms):
+        # Returns a list of posting lists which all matches must be in,
+        # and a list of substrings which must be checked for by hand.
+        postings, check = [], []
+        for term in set(t.lower() for t in terms):
+            words = self.Words(term)
+            if words == [term] and len(term) < 3:
+                postings.append(self.grams.get(u'^' + term, IdSet()))
+                continue
+            grams = set(w[i:i + 3] for w in words
+                        for i in range(0, len(w) - 2))
+            postings.extend(self.grams.get(g, IdSet()) for g in grams)
+            if not (words == [term] and len(term) == 3):
+                check.append(term)
+        postings.sort(key=len)
+        return postings, check
+
+    def _walk(self, postings, check, count, max_steps):
+        # Walk the entries in rank order, looking for the best matches.
+        if len(self._changed) > max(self.RERANK_MIN, len(self.ids) // 32):
+            self.rerank()
+        text, changed = self.text, self._changed
+        match = lambda e: (not [p for p in postings if e not in p] and
+                           not [c for c in check if c not in text[e]])
+        best = [e for e in changed if self.keys[e] is not None and match(e)]
+        found, steps = 0, 0
+        for e in self._ranked:
+            if found >= count:
+                break
+            steps += 1
+            if steps > max_steps:
+                return None
+            if e not in changed and match(e):
+                best.append(e)
+                found += 1
+        return nlargest(count, best, key=self.score.__getitem__)
+
+    def search(self, terms, count=None):
+        """
+        Return the keys of all entries matching all the terms, best ranked
+        first. If count is given, only return that many.
+
+        >>> ai = AddressIndex()
+        >>> ai.add(1, u'bre@example.com (Bjarni)')
+        >>> ai.add(2, u'bjorn@example.org (Bjorn)')
+        >>> ai.seen(2, 1400000000)
+        >>> ai.search(['bj']), ai.search(['bj', 'com']), ai.search(['ample'])
+        ([2, 1], [1], [2, 1])
+        >>> ai.search(['x']), ai.search(['jarn']), ai.search(['bj'], count=1)
+        ([], [1], [2])
+        """
+        postings, check = self._conditions(terms)
+        total = len(self.ids)
+
+        # If even the rarest term is common, walking the entries in rank
+        # order finds the best matches faster than intersecting.
+        if count and postings and 4 * count * total < len(postings[0]) ** 2:
+            best = self._walk(postings, check, count,
+                              32 * count * total // len(postings[0]) + 1000)
+            if best is not None:
+                return [self.keys[e] for e in best]
+
+        if postings:
+            matches = postings[0]
+            for posting in postings[1:]:
+                matches = matches & posting
+                if not matches:
+                    break
+        else:
+            matches = (e for e in xrange(0, len(self.keys))
+                       if self.keys[e] is not None)
+        if check:
+            text = self.text
+            matches = [e for e in matches
+                       if not [c for c in check if c not in text[e]]]
+
+        score = self.score.__getitem__
+        if count is None or count >= len(matches):
+            ranked = sorted(matches, key=score, reverse=True)
+        else:
+            ranked = nlargest(count, matches, key=score)
+        return [self.keys[e] for e in ranked]
+
+
+if __name__ == "__main__":
+    import doctest
+    import random
+    import sys
+
+    # Check the index against a brute-force search
+    names = [u'%s%s' % (random.choice(['al', 'bo', 'cy', 'dee', 'ed']),
+                        random.choice(['ham', 'bert', 'mond', 'x'])) for
+             i in range(0, 200)]
+    ai, entries = AddressIndex(), {}
+    for i in range(0, 2000):
+        entries[i] = u'%s@%s.com (%s)' % (random.choice(names),
+                                          random.choice(names),
+                                          random.choice(names).title())
+    ai.add_many((i, entries[i]) for i in range(0, 1000))
+    for i in range(1000, 2000):
+        ai.add(i, entries[i])
+    for i in range(0, 2000):
+        entries[i] = entries[i].lower()
+        for j in range(0, random.randint(0, 3)):
+            ai.seen(i, random.randint(1300000000, 1400000000))
+    ai.add(7, u'changed@example.com')
+    entries[7] = u'changed@example.com'
+    ai.remove(8)
+    del entries[8]
+    words = lambda t: AddressIndex.WORD_RE.split(t)
+    for terms in (['bo'], ['com'], ['ed', 'bert'], ['mond', 'a'],
+                  ['change'], ['x.c'], ['zzz'], ['e', 'com'], ['al', 'x'],
+                  ['bert@'], ['a']):
+        expect = [k for k, t in entries.iteritems()
+                  if not [term for term in terms if not
+                          ((len(term) < 3 and
+                            [w for w in words(t) if w.startswith(term)]) or
+                           (len(term) >= 3 and term in t))]]
+        expect.sort(key=lambda k: (-ai.rank(k), k))
+        found = ai.search(terms)
+        assert(sorted(found) == sorted(expect))
+        assert([ai.rank(k) for k in found] == [ai.rank(k) for k in expect])
+        top = ai.search(terms, count=10)
+        assert([ai.rank(k) for k in top] == [ai.rank(k) for k in expect[:10]])
+    ai.rerank()
+    ai.seen(12, 1500000000)
+    assert(ai.search(['com'], count=1) == [12])
+
+    # Scores can be saved and restored
+    ai2 = AddressIndex()
+    ai2.add_many((k, t) for k, t in entries.iteritems())
+    for k in entries:
+        ai2.set_rank(k, ai.rank(k))
+    assert(ai2.search(['com'], count=10) == ai.search(['com'], count=10))
+
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
@@ -28,6 +28,7 @@ from mailpile.mailboxes import IsMailbox
 from mailpile.mailutils import AddressHeaderParser, ClearParseCache
 from mailpile.mailutils import ExtractEmails, ExtractEmailAndName, Email
 from mailpile.postinglist import GlobalPostingList
+from mailpile.query_plan import ExplainText
 from mailpile.safe_popen import MakePopenUnsafe, MakePopenSafe
 from mailpile.search import MailIndex
 from mailpile.util import *
@@ -804,18 +805,7 @@ class SearchResults(dict):
         return dict_merge(self.session.config.get_tag_info(tid), attributes)
 
     def _thread(self, thread_mid):
-        msg_info = self.idx.get_msg_at_idx_pos(int(thread_mid, 36))
-        thread = [i for i in msg_info[MailIndex.MSG_REPLIES].split(',') if i]
-
-        # FIXME: This is a hack, the indexer should just keep things
-        #        in the right order on rescan. Fixing threading is a bigger
-        #        problem though, so we do this for now.
-        def thread_sort_key(idx):
-            info = self.idx.get_msg_at_idx_pos(int(thread_mid, 36))
-            return int(info[self.idx.MSG_DATE], 36)
-        thread.sort(key=thread_sort_key)
-
-        return thread
+        return [b36(i) for i in self.idx.get_reply_idxs(int(thread_mid, 36))]
 
     WANT_MSG_TREE = ('attachments', 'html_parts', 'text_parts', 'header_list',
                      'editing_strings', 'crypto')
@@ -1096,6 +1086,8 @@ class SearchResults(dict):
             count += 1
         if not count:
             text = ['(No messages found)']
+        if self.get('explain'):
+            text += ['', ExplainText(self['explain'])]
         return '\n'.join(text) + '\n'
 
 
@@ -1484,18 +1476,31 @@ class ProgramStatus(Command):
             else:
                 locks = _('Nothing Found')
 
+            workers = self.result.get('workers')
+            if workers:
+                workers = '\n'.join([('  %(name)s: queued=%(queued)d '
+                                      'later=%(later)d running=%(running)d/'
+                                      '%(threads)d done=%(done)d '
+                                      'failed=%(failed)d wait=%(wait_avg_ms)d'
+                                      '/%(wait_max_ms)dms '
+                                      'run=%(run_avg_ms)dms') % w
+                                     for w in workers])
+            else:
+                workers = '  ' + _('Nothing Found')
+
             return ('Recent events:\n%s\n\n'
                     'Events in progress:\n%s\n\n'
                     'Live sessions:\n%s\n\n'
                     'Postinglist timers:\n%s\n\n'
                     'Threads: (bg delay %.3fs, live=%s, httpd=%s)\n%s\n\n'
+                    'Workers: (avg/max wait, avg run)\n%s\n\n'
                     'Locks:\n%s'
                     ) % (cevents, ievents, sessions,
                          self.result['pl_timers'],
                          self.result['delay'],
                          self.result['live'],
                          self.result['httpd'],
-                         threads, locks)
+                         threads, workers, locks)
 
     def command(self, args=None):
         import mailpile.auth
@@ -1545,6 +1550,15 @@ class ProgramStatus(Command):
             except AttributeError:
                 pass
 
+        workers, seen = [], set([id(config.dumb_worker)])
+        for worker in (config.slow_worker, config.scan_worker,
+                       config.async_worker, config.save_worker,
+                       config.merge_worker):
+            if (worker and id(worker) not in seen and
+                    hasattr(worker, 'status')):
+                seen.add(id(worker))
+                workers.append(worker.status())
+
         import mailpile.auth
         import mailpile.httpd
         result = {
@@ -1558,6 +1572,7 @@ class ProgramStatus(Command):
             'live': mailpile.util.LIVE_USER_ACTIVITIES,
             'httpd': mailpile.httpd.LIVE_HTTP_REQUESTS,
             'threads': threads,
+            'workers': workers,
             'locks': sorted(locks)
         }
         if config.event_log:
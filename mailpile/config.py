@@ -48,6 +48,7 @@ from mailpile.util import *
 from mailpile.ui import Session, BackgroundInteraction
 from mailpile.vcard import VCardStore
 from mailpile.workers import Worker, ImportantWorker, DumbWorker, Cron
+from mailpile.workers import LowPriorityWorker
 
 
 MAX_CACHED_MBOXES = 5
@@ -1130,8 +1131,10 @@ class ConfigManager(ConfigDict):
         self.scan_worker = self.dumb_worker
         self.save_worker = self.dumb_worker
         self.async_worker = self.dumb_worker
+        self.merge_worker = self.dumb_worker
         self.other_workers = []
         self.mail_sources = {}
+        self.scan_pool = None
 
         self.event_log = None
         self.index = None
@@ -1775,6 +1778,15 @@ class ConfigManager(ConfigDict):
     def mailindex_file(self):
         return os.path.join(self.workdir, 'mailpile.idx')
 
+    def mailindex_columns_file(self):
+        return os.path.join(self.workdir, 'mailpile.cdx')
+
+    def mailindex_checkpoint_file(self):
+        return os.path.join(self.workdir, 'mailpile.ckp')
+
+    def vcard_cache_file(self):
+        return os.path.join(self.workdir, 'vcards.cache')
+
     def mailpile_path(self, path):
         base = (self.workdir + os.sep).replace(os.sep+os.sep, os.sep)
         if path.startswith(base):
@@ -1872,6 +1884,10 @@ class ConfigManager(ConfigDict):
 
         # Start the other workers
         if daemons:
+            # The scan pool forks, so it goes before any of the threads
+            from mailpile.search import StartScanPool
+            StartScanPool(config)
+
             for src_id, src_config in config.sources.iteritems():
                 ms_thread = config.mail_sources.get(src_id)
                 if (ms_thread and src_config.enabled
@@ -1887,17 +1903,28 @@ class ConfigManager(ConfigDict):
                         pass
 
             if config.slow_worker == config.dumb_worker:
-                config.slow_worker = Worker('Slow worker', session)
+                # Rescans, sending mail and such: user requests go first,
+                # and may run alongside background jobs if there are
+                # several threads.
+                config.slow_worker = Worker('Slow worker', session,
+                                            threads=config.sys.slow_threads,
+                                            prioritize=True)
                 config.slow_worker.start()
             if config.scan_worker == config.dumb_worker:
                 config.scan_worker = Worker('Scan worker', session)
                 config.scan_worker.start()
             if config.async_worker == config.dumb_worker:
+                # One thread: async commands aren't written to run in
+                # parallel with each other.
                 config.async_worker = Worker('Async worker', session)
                 config.async_worker.start()
             if config.save_worker == config.dumb_worker:
                 config.save_worker = ImportantWorker('Save worker', session)
                 config.save_worker.start()
+            if config.merge_worker == config.dumb_worker:
+                config.merge_worker = LowPriorityWorker('Merge worker',
+                                                        session)
+                config.merge_worker.start()
             if not config.cron_worker:
                 config.cron_worker = Cron('Cron worker', session)
                 config.cron_worker.start()
@@ -1941,13 +1968,21 @@ class ConfigManager(ConfigDict):
 
             from mailpile.postinglist import GlobalPostingList
             def optimizer():
-                config.scan_worker.add_unique_task(
+                config.merge_worker.add_unique_task(
                     config.background, 'gpl_optimize',
                     lambda: GlobalPostingList.Optimize(config.background,
                                                        config.index,
-                                                       ratio=0.25, runtime=15))
+                                                       lazy=True, runtime=15))
             config.cron_worker.add_task('gpl_optimize', 29, optimizer)
 
+            from mailpile.postinglist import PostingListContainer
+            def plc_migrator():
+                config.scan_worker.add_unique_task(
+                    config.background, 'plc_migrate',
+                    lambda: PostingListContainer.MigrateAll(config.background,
+                                                            runtime=15))
+            config.cron_worker.add_task('plc_migrate', 127, plc_migrator)
+
             # Schedule plugin jobs
             from mailpile.plugins import PluginManager
 
@@ -1980,12 +2015,14 @@ class ConfigManager(ConfigDict):
                             config.async_worker,
                             config.slow_worker,
                             config.scan_worker,
+                            config.merge_worker,
                             config.cron_worker])
             config.other_workers = []
             config.http_worker = config.cron_worker = None
             config.slow_worker = config.dumb_worker
             config.scan_worker = config.dumb_worker
             config.async_worker = config.dumb_worker
+            config.merge_worker = config.dumb_worker
 
         for wait in (False, True):
             for w in worker_list:
@@ -1994,6 +2031,9 @@ class ConfigManager(ConfigDict):
                         print 'Waiting for %s' % w
                     w.quit(join=wait)
 
+        from mailpile.search import StopScanPool
+        StopScanPool(config)
+
         # Flush the mailbox cache (queues save worker jobs)
         config.flush_mbox_cache(config.background, clear=True)
 
@@ -119,7 +119,8 @@ class ViewMetadata(Hacks):
             'subject': info[idx.MSG_SUBJECT],
             'body': info[idx.MSG_BODY],
             'tags': info[idx.MSG_TAGS],
-            'replies': info[idx.MSG_REPLIES],
+            'replies': ','.join(b36(r) for r in idx.get_reply_idxs(
+                int(info[idx.MSG_MID], 36))),
             'thread_mid': info[idx.MSG_THREAD_MID],
             'parsed': {
                 'date': friendly_datetime(long(info[idx.MSG_DATE], 36)),
@@ -1,3 +1,4 @@
+import base64
 import os
 import hashlib
 import random
@@ -15,6 +16,23 @@ from mailpile.safe_popen import Popen, PIPE
 from mailpile.util import md5_hex, CryptoLock, safe_remove
 from mailpile.util import sha512b64 as genkey
 
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+    from cryptography.hazmat.primitives.ciphers import modes
+except ImportError:
+    Cipher = None
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
 
 LEN_MD5 = len(md5_hex('testing'))
 MD5_SUM_FORMAT = 'md5sum: %s'
@@ -145,13 +163,375 @@ class IOFilter(threading.Thread):
             self.info = 'Dead'
 
 
+##[ In-process ciphers ]#######################################################
+#
+# Forking openssl for every file we encrypt or decrypt is slow, so when a
+# suitable Python library is available we do the work in-process instead.
+# The filters below stand in for `openssl enc -a -pass stdin`: the first
+# line is the password, and the output is byte-for-byte what openssl would
+# produce (salted, base64 encoded, PKCS#7 padded), so the on-disk format
+# and the MD5 checks stay exactly the same.
+#
+# Keys are derived using EVP_BytesToKey, as openssl does. Since OpenSSL
+# 1.1.0 that uses SHA-256 (which is what we write), older versions used
+# MD5; when decrypting we try both.
+#
+# Backends only need to do raw CBC on whole blocks. To add one, put a
+# class with the same interface as CryptographyAES in CIPHER_BACKENDS.
+#
+IN_PROCESS_CRYPTO = True
+
+
+class CryptographyAES(object):
+    """AES-CBC using the `cryptography` library."""
+    KEY_BYTES = {'aes-128-cbc': 16, 'aes-192-cbc': 24, 'aes-256-cbc': 32}
+
+    @classmethod
+    def Supports(cls, cipher):
+        return (Cipher is not None) and (cipher in cls.KEY_BYTES)
+
+    def __init__(self, cipher, key, iv, encrypt=True):
+        aes = Cipher(algorithms.AES(key), modes.CBC(iv),
+                     backend=default_backend())
+        self._ctx = aes.encryptor() if encrypt else aes.decryptor()
+
+    def update(self, data):
+        return self._ctx.update(data)
+
+    def finalize(self):
+        return self._ctx.finalize()
+
+
+class PyCryptoAES(CryptographyAES):
+    """AES-CBC using PyCrypto (or PyCryptodome)."""
+
+    @classmethod
+    def Supports(cls, cipher):
+        return (AES is not None) and (cipher in cls.KEY_BYTES)
+
+    def __init__(self, cipher, key, iv, encrypt=True):
+        aes = AES.new(key, AES.MODE_CBC, iv)
+        self.update = aes.encrypt if encrypt else aes.decrypt
+
+    def finalize(self):
+        return ''
+
+
+CIPHER_BACKENDS = [CryptographyAES, PyCryptoAES]
+
+
+def InProcessBackend(cipher):
+    """Return an in-process backend for a cipher, or None."""
+    if IN_PROCESS_CRYPTO:
+        for backend in CIPHER_BACKENDS:
+            if backend.Supports(cipher):
+                return backend
+    return None
+
+
+def _evp_bytes_to_key(password, salt, key_len, iv_len, digest):
+    """
+    Derive a key and IV from a password, the way `openssl enc` does.
+
+    >>> k, iv = _evp_bytes_to_key('pw', 'saltsalt', 32, 16, hashlib.md5)
+    >>> k.encode('hex')[:16], iv.encode('hex')[:16]
+    ('0a2bca35e14cf2bc', '3f24356c0efb5092')
+    >>> k, iv = _evp_bytes_to_key('pw', 'saltsalt', 32, 16, hashlib.sha256)
+    >>> k.encode('hex')[:16], iv.encode('hex')[:16]
+    ('60583585680d53af', '9387692988d117b0')
+    """
+    data, block = '', ''
+    while len(data) < key_len + iv_len:
+        block = digest(block + password + salt).digest()
+        data += block
+    return data[:key_len], data[key_len:key_len + iv_len]
+
+
+class InProcessEncryptor(object):
+    """
+    Encrypts data written to it, writing base64 encoded ciphertext to fd.
+    The first line written is the password.
+    """
+    SALT_MAGIC = 'Salted__'
+    LINE_BYTES = 48
+    LINE_CHARS = 64
+
+    def __init__(self, fd, cipher, backend):
+        self.fd = fd
+        self.cipher = cipher
+        self.backend = backend
+        self.closed = False
+        self._aes = None
+        self._plain = ''
+        self._out = ''
+
+    def _start(self, password):
+        salt = os.urandom(8)
+        key, iv = _evp_bytes_to_key(password, salt,
+                                    self.backend.KEY_BYTES[self.cipher], 16,
+                                    hashlib.sha256)
+        self._aes = self.backend(self.cipher, key, iv, encrypt=True)
+        self._out = self.SALT_MAGIC + salt
+
+    def _emit(self, final=False):
+        out = self._out
+        if final:
+            end = len(out)
+        else:
+            end = len(out) - (len(out) % self.LINE_BYTES)
+        if end:
+            b64, width = base64.b64encode(out[:end]), self.LINE_CHARS
+            lines = [b64[i:i + width] for i in range(0, len(b64), width)]
+            lines.append('')
+            self.fd.write('\n'.join(lines))
+        self._out = out[end:]
+
+    def write(self, data):
+        self._plain += data
+        if self._aes is None:
+            if '\n' not in self._plain:
+                return
+            password, self._plain = self._plain.split('\n', 1)
+            self._start(password)
+        plain = self._plain
+        end = len(plain) - (len(plain) % 16)
+        if end:
+            self._out += self._aes.update(plain[:end])
+            self._plain = plain[end:]
+            self._emit()
+
+    def flush(self):
+        self.fd.flush()
+
+    def close(self, *args):
+        if not self.closed:
+            self.closed = True
+            if self._aes is None:
+                self._start(self._plain)
+                self._plain = ''
+            pad = 16 - (len(self._plain) % 16)
+            self._out += self._aes.update(self._plain + chr(pad) * pad)
+            self._out += self._aes.finalize()
+            self._emit(final=True)
+        return 0
+
+
+class InProcessDecryptor(object):
+    """
+    Decrypts base64 encoded ciphertext read from fd, the first line of
+    which is the password. The whole thing is decrypted on first read, as
+    that is the only way to tell which key derivation was used.
+
+    If given, check() is used to choose between candidate plaintexts.
+    """
+    SALT_MAGIC = InProcessEncryptor.SALT_MAGIC
+    DIGESTS = (hashlib.sha256, hashlib.md5)
+
+    def __init__(self, fd, cipher, backend, check=None):
+        self.fd = fd
+        self.cipher = cipher
+        self.backend = backend
+        self.check = check
+        self.retval = None
+        self._data = None
+
+    def _decrypt(self):
+        password = self.fd.readline().rstrip('\r\n')
+        lines = []
+        for line in self.fd:
+            # When fed line by line, the END marker may be included too.
+            if line.startswith('-'):
+                break
+            lines.append(line.strip())
+        try:
+            raw = base64.b64decode(''.join(lines))
+        except TypeError:
+            raw = ''
+        salt, ciphertext = raw[8:16], raw[16:]
+        if (not raw.startswith(self.SALT_MAGIC) or not ciphertext or
+                len(ciphertext) % 16):
+            return None
+
+        candidates = []
+        for digest in self.DIGESTS:
+            key, iv = _evp_bytes_to_key(password, salt,
+                                        self.backend.KEY_BYTES[self.cipher],
+                                        16, digest)
+            aes = self.backend(self.cipher, key, iv, encrypt=False)
+            plain = aes.update(ciphertext) + aes.finalize()
+            pad = ord(plain[-1])
+            if 1 <= pad <= 16 and plain.endswith(chr(pad) * pad):
+                plain = plain[:-pad]
+                if self.check is None or self.check(plain):
+                    return plain
+                candidates.append(plain)
+        return candidates[0] if candidates else None
+
+    def _ready(self):
+        if self._data is None:
+            plain = self._decrypt()
+            self.retval = 0 if (plain is not None) else 1
+            self._data = StringIO.StringIO(plain or '')
+        return self._data
+
+    def __iter__(self, *args):
+        return self._ready().__iter__(*args)
+
+    def readline(self, *args):
+        return self._ready().readline(*args)
+
+    def readlines(self, *args):
+        return self._ready().readlines(*args)
+
+    def read(self, *args):
+        return self._ready().read(*args)
+
+    def close(self, *args):
+        self._ready()
+        return self.retval
+
+
+class InlineIOFilter(object):
+    """
+    This is a stand-in for IOFilter, which filters in the calling thread
+    instead of a background thread. Used when there is no coprocess which
+    would need a real file descriptor to talk to.
+    """
+    BLOCKSIZE = IOFilter.BLOCKSIZE
+
+    def __init__(self, fd, callback, name=None, error_callback=None):
+        self.fd = fd
+        self.callback = callback
+        self.name = name
+        self.writing = None
+        self.eof = False
+        self.buffered = ''
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # Writing...
+
+    def writer(self):
+        self.writing = True
+        return self
+
+    def write(self, data):
+        self.fd.write(self.callback(data))
+
+    def flush(self):
+        self.fd.flush()
+
+    def close(self):
+        if self.writing and not self.eof:
+            self.eof = True
+            self.fd.write(self.callback(None) or '')
+
+    def join(self, aborting=None):
+        pass
+
+    # Reading...
+
+    def reader(self):
+        self.writing = False
+        return self
+
+    def _read_block(self):
+        return self.fd.read(self.BLOCKSIZE) or None
+
+    def _fill(self, until):
+        # Filtered data is collected in a list and joined once, and reads
+        # advance an offset instead of copying what remains; otherwise
+        # large chunks would cost time quadratic in their size.
+        if self.eof or until(self.buffered[self.offset:], self._left()):
+            return
+        chunks, left = [self.buffered[self.offset:]], self._left()
+        while not self.eof:
+            data = self._read_block()
+            if data is None:
+                self.eof = True
+            chunk = self.callback(data) or ''
+            chunks.append(chunk)
+            left += len(chunk)
+            if until(chunk, left):
+                break
+        self.buffered, self.offset = ''.join(chunks), 0
+
+    def _left(self):
+        return len(self.buffered) - self.offset
+
+    def _take(self, size):
+        start = self.offset
+        self.offset = min(len(self.buffered), start + size)
+        return self.buffered[start:self.offset]
+
+    def prime(self, until):
+        """Read and filter data until a condition is met (or EOF)."""
+        self._fill(lambda chunk, left: until())
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self._fill(lambda chunk, left: False)
+            size = self._left()
+        else:
+            self._fill(lambda chunk, left: left >= size)
+        return self._take(size)
+
+    def readline(self, *args):
+        end = self.buffered.find('\n', self.offset)
+        if end < 0:
+            self._fill(lambda chunk, left: '\n' in chunk)
+            end = self.buffered.find('\n', self.offset)
+        if end < 0:
+            return self._take(self._left())
+        return self._take(end + 1 - self.offset)
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+
+class InlineReadLineIOFilter(InlineIOFilter):
+    """An InlineIOFilter which behaves like ReadLineIOFilter."""
+    def __init__(self, fd, callback,
+                 start_data=None, stop_check=None, **kwargs):
+        InlineIOFilter.__init__(self, fd, callback, **kwargs)
+        self.start_data = start_data
+        self.stop_check = stop_check
+        self.stopped = False
+
+    def _read_block(self):
+        if self.start_data:
+            data, self.start_data = ''.join(self.start_data), None
+            return data
+        if self.stopped:
+            return None
+        try:
+            data = self.fd.next()
+        except StopIteration:
+            return None
+        if self.stop_check and self.stop_check(data):
+            self.stopped = True
+        return data
+
+
 class IOCoprocess(object):
     def __init__(self, command, fd, name=None, long_running=False):
         self.stderr = ''
         self._retval = None
         self._reading = False
         self.name = name
-        if command:
+        self._in_process = callable(command)
+        if self._in_process:
+            # An in-process filter stands in for the coprocess
+            self._proc, self._fd = None, command(fd)
+        elif command:
             try:
                 self._proc, self._fd = self._popen(command, fd, long_running)
             except:
@@ -182,6 +562,8 @@ class IOCoprocess(object):
                         proc.kill()
                 self.stderr = proc.stderr.read()
                 self._retval = proc.wait()
+            elif fd and self._in_process:
+                self._retval = fd.close(*args) or 0
             else:
                 self._retval = 0
         return self._retval
@@ -240,7 +622,12 @@ class ChecksummingStreamer(OutputCoprocess):
 
         self.outer_md5sum = None
         self.outer_md5 = hashlib.md5()
-        self.md5filter = IOFilter(self.tempfile, self._md5_callback,
+        command = self._mk_command()
+        if command and not callable(command):
+            iofilter = IOFilter
+        else:
+            iofilter = InlineIOFilter
+        self.md5filter = iofilter(self.tempfile, self._md5_callback,
                                   name='%s/md5' % (self.name or 'css'))
         self.fd = self.md5filter.writer()
 
@@ -248,7 +635,7 @@ class ChecksummingStreamer(OutputCoprocess):
         self.finished = False
         try:
             self._write_preamble()
-            OutputCoprocess.__init__(self, self._mk_command(), self.fd,
+            OutputCoprocess.__init__(self, command, self.fd,
                                      name=self.name,
                                      long_running=long_running)
         except:
@@ -409,6 +796,9 @@ class EncryptingDelimitedStreamer(ChecksummingStreamer):
         self._fd.write('%s\n' % self.key)
 
     def _mk_command(self):
+        backend = InProcessBackend(self.cipher)
+        if backend:
+            return lambda fd: InProcessEncryptor(fd, self.cipher, backend)
         return [OPENSSL_COMMAND, "enc", "-e", "-a", "-%s" % self.cipher,
                 "-pass", "stdin", "-bufsize", "0"]
 
@@ -497,6 +887,8 @@ class DecryptingStreamer(InputCoprocess):
         self.buffered = ''
         self.mep_key = mep_key
         self.gpg_pass = gpg_pass
+        self.inline = bool(InProcessBackend(self.DEFAULT_CIPHER))
+        self.pump = None
 
         # Start reading our data...
         self.startup_lock = CryptoLock()
@@ -507,8 +899,20 @@ class DecryptingStreamer(InputCoprocess):
         try:
             # Once the header has been processed (_read_data() will release
             # the lock), fork out our coprocess.
-            self.startup_lock.acquire()
-            InputCoprocess.__init__(self, self._mk_command(), self.read_fd,
+            if self.inline:
+                self.data_filter.prime(lambda: self.state not in
+                                       (self.STATE_BEGIN, self.STATE_HEADER))
+                self.startup_lock.acquire(False)
+            else:
+                self.startup_lock.acquire()
+            command = self._mk_command()
+            read_fd = self.read_fd
+            if self.inline and command and not callable(command):
+                # Coprocesses need a real file descriptor to read from
+                self.pump = IOFilter(self.read_fd, lambda d: d or '',
+                                     name='%s/pump' % (self.name or 'ds'))
+                read_fd = self.pump.reader()
+            InputCoprocess.__init__(self, command, read_fd,
                                     name=name, long_running=long_running)
             self.startup_lock = None
         except:
@@ -526,6 +930,8 @@ class DecryptingStreamer(InputCoprocess):
 
     def close(self):
         self.data_filter.join()
+        if self.pump:
+            self.pump.join()
         self.read_fd.close()
         return InputCoprocess.close(self)
 
@@ -559,7 +965,8 @@ class DecryptingStreamer(InputCoprocess):
         return True
 
     def _mk_data_filter(self, fd, cb, ecb):
-        return IOFilter(fd, cb, error_callback=ecb,
+        iofilter = InlineIOFilter if self.inline else IOFilter
+        return iofilter(fd, cb, error_callback=ecb,
                         name='%s/filter' % (self.name or 'ds'))
 
     def _read_data(self, data):
@@ -657,6 +1064,13 @@ class DecryptingStreamer(InputCoprocess):
     def _mutate_key(self, key, nonce):
         return genkey(key or '', nonce)[:32].strip()
 
+    def _check_inner_md5sum(self, data):
+        if not self.expected_inner_md5sum:
+            return True
+        inner_md5 = self.inner_md5.copy()
+        inner_md5.update(data)
+        return (inner_md5.hexdigest() == self.expected_inner_md5sum)
+
     def _mk_command(self):
         if self.state == self.STATE_RAW_DATA:
             return None
@@ -665,6 +1079,10 @@ class DecryptingStreamer(InputCoprocess):
             if self.gpg_pass:
                 gpg.extend(["--no-use-agent", "--passphrase-fd=0"])
             return gpg
+        backend = InProcessBackend(self.cipher)
+        if backend:
+            return lambda fd: InProcessDecryptor(
+                fd, self.cipher, backend, check=self._check_inner_md5sum)
         return [OPENSSL_COMMAND, "enc", "-d", "-a", "-%s" % self.cipher,
                 "-pass", "stdin"]
 
@@ -706,11 +1124,12 @@ class PartialDecryptingStreamer(DecryptingStreamer):
         DecryptingStreamer.__init__(self, *args, **kwargs)
 
     def _mk_data_filter(self, fd, cb, ecb):
-        return ReadLineIOFilter(fd, cb,
-                                start_data=self.start_data,
-                                stop_check=self.EndEncrypted,
-                                error_callback=ecb,
-                                name='%s/filter' % (self.name or 'ds'))
+        iofilter = InlineReadLineIOFilter if self.inline else ReadLineIOFilter
+        return iofilter(fd, cb,
+                        start_data=self.start_data,
+                        stop_check=self.EndEncrypted,
+                        error_callback=ecb,
+                        name='%s/filter' % (self.name or 'ds'))
 
 
 if __name__ == "__main__":
@@ -821,5 +1240,73 @@ if __name__ == "__main__":
          # Cleanup
          os.unlink(fn)
 
+     if InProcessBackend(EncryptingDelimitedStreamer.DEFAULT_CIPHER):
+         data = ''.join('Line %d of some very secret data\n' % i
+                        for i in range(0, 500))
+         for writer, reader in ((True, False), (False, True), (True, True)):
+             print 'Compatibility test, in-process=%s/%s' % (writer, reader)
+             IN_PROCESS_CRYPTO = writer
+             with EncryptingStreamer('test key', dir='/tmp',
+                                     delimited=True) as es:
+                 es.write(data)
+                 es.save('/tmp/iofilter.tmp')
+             IN_PROCESS_CRYPTO = reader
+             with open('/tmp/iofilter.tmp', 'rb') as bfd:
+                 with DecryptingStreamer(bfd, mep_key='test key',
+                                         md5sum=es.outer_md5sum) as ds:
+                     assert(ds.read() == data)
+                     assert(ds.verify(_raise=AssertionError))
+             assert(fdcheck('Compatibility test, %s/%s' % (writer, reader)))
+
+             # Encrypted chunks embedded in a larger file
+             with open('/tmp/iofilter.tmp', 'rb') as bfd:
+                 chunk = bfd.read()
+             with open('/tmp/iofilter.tmp', 'wb') as bfd:
+                 bfd.write('Before\n' + chunk + 'After\n' + chunk)
+             lines = []
+             with open('/tmp/iofilter.tmp', 'rb') as bfd:
+                 for line in bfd:
+                     if PartialDecryptingStreamer.StartEncrypted(line):
+                         with PartialDecryptingStreamer([line], bfd,
+                                                        mep_key='test key'
+                                                        ) as pds:
+                             lines.extend(pds)
+                             assert(pds.verify(_raise=AssertionError))
+                     else:
+                         lines.append(line)
+             assert(''.join(lines) == 'Before\n%sAfter\n%s' % (data, data))
+
+         print 'Partial decryption test, base64 without padding'
+         for size in range(300, 340):
+             with EncryptingStreamer('test key', dir='/tmp',
+                                     delimited=True) as es:
+                 es.write(data[:size])
+                 es.save('/tmp/iofilter.tmp')
+             with open('/tmp/iofilter.tmp', 'rb') as bfd:
+                 with PartialDecryptingStreamer([], bfd,
+                                                mep_key='test key') as pds:
+                     assert(pds.read() == data[:size])
+                     assert(pds.verify(_raise=AssertionError))
+
+         print 'Legacy (MD5 key derivation) decryption test'
+         legacy = Popen([OPENSSL_COMMAND, 'enc', '-e', '-a', '-md', 'md5',
+                         '-aes-256-cbc', '-pass', 'stdin'],
+                        stdin=PIPE, stdout=PIPE, stderr=PIPE
+                        ).communicate('test key\n' + data)[0]
+         ipd = InProcessDecryptor(StringIO.StringIO('test key\n' + legacy),
+                                  'aes-256-cbc',
+                                  InProcessBackend('aes-256-cbc'))
+         assert(ipd.read() == data and ipd.close() == 0)
+         ipd = InProcessDecryptor(StringIO.StringIO('bad key\n' + legacy),
+                                  'aes-256-cbc',
+                                  InProcessBackend('aes-256-cbc'))
+         assert(ipd.read() != data)
+
      os.unlink('/tmp/iofilter.tmp')
      assert(fdcheck('All done'))
+
+     import doctest
+     results = doctest.testmod(optionflags=doctest.ELLIPSIS)
+     print '%s' % (results, )
+     if results.failed:
+         sys.exit(1)
@@ -37,6 +37,12 @@ CONFIG_RULES = {
         'postinglist_kb': (_('Posting list target size in KB'), int,       64),
         'sort_max':       (_('Max results we sort "well"'), int,         2500),
         'snippet_max':    (_('Max length of metadata snippets'), int,     250),
+        'scan_processes': (_('Processes parsing new mail (0=auto)'), int,   1),
+        'load_threads':   (_('Threads loading the index (0=auto)'), int,    1),
+        'slow_threads':   (_('Threads running slow background jobs'), int, 1),
+        'keyword_buffer_kb': (_('Keyword buffer size in KB'), int,   8192),
+        'gpl_fanout':     (_('Index segments merged at once'), int,         4),
+        'gpl_levels':     (_('Index segment levels'), int,                  3),
         'debug':         p(_('Debugging flags'), str,                      ''),
         'gpg_keyserver':  (_('Host:port of PGP keyserver'),
                            str, 'pool.sks-keyservers.net'),
@@ -47,6 +53,10 @@ CONFIG_RULES = {
         'local_mailbox_id': (_('Local read/write Maildir'), 'b36',         ''),
         'mailindex_file': (_('Metadata index file'), 'file',               ''),
         'postinglist_dir': (_('Search index directory'), 'dir',            ''),
+        'index_tokenizer': (_('Tokenizer the search index was built with'),
+                            str, ''),
+        'index_reindexed': (_('Progress reindexing for a new tokenizer'),
+                            str, ''),
         'mailbox':        [_('Mailboxes we index'), 'str',                 []],
         'plugins':        [_('Plugins to load on startup'),
                            CONFIG_PLUGINS, []],
@@ -78,6 +88,9 @@ CONFIG_RULES = {
         'obfuscate_index': X(_('Key to use to scramble the index'), str,    ''),
         'index_encrypted': X(_('Make encrypted content searchable'),
                              bool, False),
+        'index_stemmer':   (_('Language to stem indexed words in'), str,   ''),
+        'index_skip_html': X(_('Skip HTML copies of long plain text mail'),
+                             bool, False),
         'encrypt_mail':   X(_('Encrypt locally stored mail'), bool,      True),
         'encrypt_index':  X(_('Encrypt the local search index'), bool,  False),
         'encrypt_vcards': X(_('Encrypt the contact database'), bool,     True),
@@ -132,6 +145,7 @@ CONFIG_RULES = {
         'host':            (_('Host'), str, ''),
         'port':            (_('Port'), int, 993),
         'keepalive':       (_('Keep server connections alive'), bool, False),
+        'connections':     (_('Max simultaneous server connections'), int, 3),
         'discovery':       (_('Mailbox discovery policy'), False, {
             'paths':       (_('Paths to watch for new mailboxes'), str, []),
             'policy':      (_('Default mailbox policy'),
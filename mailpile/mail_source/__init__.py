@@ -552,8 +552,16 @@ class BaseMailSource(threading.Thread):
                 'batch_size': stop_after if (stop_after > 0) else len(keys)
             })
 
-            # Go download!
-            for key in reversed(keys):
+            # Go download! Mailboxes which can download in batches give
+            # us a stream of messages, otherwise we fetch them one by one.
+            keys.reverse()
+            if stop_after > 0:
+                keys = keys[:stop_after]
+            if hasattr(src, 'iter_bytes'):
+                stream = src.iter_bytes(keys)
+            else:
+                stream = ((key, src.get_bytes(key)) for key in keys)
+            for key, data in stream:
                 if self._check_interrupt(clear=False):
                     progress['interrupted'] = True
                     return count
@@ -561,7 +569,6 @@ class BaseMailSource(threading.Thread):
 
                 session.ui.mark(_('Copying message: %s') % key)
                 progress['copying_src_id'] = key
-                data = src.get_bytes(key)
                 loc_key = loc.add_from_source(key, data)
                 self.event.data['counters']['copied_messages'] += 1
                 del progress['copying_src_id']
@@ -41,6 +41,7 @@
 #
 import os
 import re
+import select
 import socket
 import traceback
 from imaplib import IMAP4, IMAP4_SSL
@@ -57,6 +58,7 @@ from mailpile.eventlog import Event
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.mail_source import BaseMailSource
+from mailpile.mailboxes import NoSuchMailboxError
 from mailpile.mailutils import FormatMbxId, MBX_ID_LEN
 from mailpile.util import *
 
@@ -88,10 +90,16 @@ def _parse_imap(reply):
 
     >>> _parse_imap(('BAD', ['Sorry']))
     (False, ['Sorry'])
+
+    >>> _parse_imap(('OK', [None]))
+    (True, [])
     """
     stack = []
     pdata = []
     for dline in reply[1]:
+        if dline is None:
+            # This is how imaplib says "no data"
+            continue
         while True:
             if isinstance(dline, (str, unicode)):
                 m = IMAP_TOKEN.match(dline)
@@ -116,6 +124,74 @@ def _parse_imap(reply):
     return (reply[0].upper() == 'OK'), pdata
 
 
+FETCH_UID = re.compile(r'\bUID\s+(\d+)', re.IGNORECASE)
+
+# Once QRESYNC is enabled, servers report expunged messages with
+# "* VANISHED <uid-set>" instead of "* <n> EXPUNGE".
+IDLE_CHANGE = re.compile(r'^\*\s+(?:(\d+)\s+(EXISTS|EXPUNGE|RECENT|FETCH)'
+                         r'|(VANISHED)\s+(?:\(EARLIER\)\s+)?(\S+))\b',
+                         re.IGNORECASE)
+
+
+def _uid_set(uids):
+    """
+    Format a list of UIDs as a compact IMAP sequence set.
+
+    >>> _uid_set([9, 1, 2, 3, 5, 6])
+    '1:3,5:6,9'
+    """
+    ranges = []
+    for uid in sorted(set(int(u) for u in uids)):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join((a == b) and str(a) or ('%d:%d' % (a, b))
+                    for a, b in ranges)
+
+
+def _uid_list(uid_set):
+    """
+    Expand an IMAP sequence set (without *) to a list of UIDs.
+
+    >>> _uid_list('1:3,5:6,9')
+    [1, 2, 3, 5, 6, 9]
+    """
+    uids = []
+    for rng in uid_set.split(','):
+        if rng:
+            a, b = (rng + ':' + rng).split(':')[:2]
+            uids.extend(range(int(a), int(b) + 1))
+    return uids
+
+
+def _parse_fetch_literals(data):
+    """
+    Extract message data from a raw imaplib FETCH reply, by UID. Servers
+    may send the UID before or after the literal.
+
+    >>> sorted(_parse_fetch_literals([('1 (UID 5 BODY[] {3}', 'abc'), ')',
+    ...                               ('2 (BODY[] {2}', 'de'), ' UID 7)',
+    ...                               '3 (FLAGS (\\Seen))']).items())
+    [(5, 'abc'), (7, 'de')]
+    """
+    found, pending = {}, None
+    for item in data:
+        if isinstance(item, tuple):
+            m = FETCH_UID.search(item[0])
+            if m:
+                found[int(m.group(1))] = item[1]
+                pending = None
+            else:
+                pending = item[1]
+        elif pending is not None and isinstance(item, str):
+            m = FETCH_UID.search(item)
+            if m:
+                found[int(m.group(1))] = pending
+            pending = None
+    return found
+
+
 class SharedImapConn(threading.Thread):
     """
     This is a wrapper around an imaplib.IMAP4 connection which facilitates
@@ -125,7 +201,26 @@ class SharedImapConn(threading.Thread):
     it will switch to IMAP IDLE mode when not otherwise in use.
 
     Callers are expected to use the "with sharedconn as conn: ..." syntax.
+
+    >>> changes = []
+    >>> shared = SharedImapConn(session, _Mocks.Idler(),
+    ...                         idle_mailbox='INBOX',
+    ...                         idle_callback=lambda m, c: changes.append(c))
+    >>> shared._idle(time.time() + 10)
+    >>> changes
+    [[(4, 'EXISTS')]]
+    >>> shared._conn.sent
+    ['MOCK1 IDLE\\r\\n', 'DONE\\r\\n']
+    >>> shared.quit()
     """
+    # While nobody is using the connection, we IDLE. When somebody wants
+    # it, the IDLE loop notices within IDLE_POLL seconds, sends DONE and
+    # hands over. We only start IDLE again after IDLE_DELAY quiet seconds,
+    # so a burst of activity doesn't keep toggling it on and off.
+    KEEPALIVE = 120
+    IDLE_DELAY = 5
+    IDLE_POLL = 0.25
+
     def __init__(self, session, conn, idle_mailbox=None, idle_callback=None):
         threading.Thread.__init__(self)
         self.daemon = True
@@ -136,9 +231,12 @@ class SharedImapConn(threading.Thread):
         self._idle_callback = idle_callback
         self._idling = False
         self._selected = None
+        self._users = 0
+        self._users_lock = threading.Lock()
+        self._last_used = time.time()
 
         for meth in ('append', 'add', 'capability', 'fetch', 'noop',
-                     'list', 'login', 'search', 'uid'):
+                     'list', 'login', 'response', 'search', 'uid'):
             self.__setattr__(meth, self._mk_proxy(meth))
 
         self._update_name()
@@ -180,17 +278,20 @@ class SharedImapConn(threading.Thread):
             self.name += ' (closed)'
         return self._conn.close()
 
-    def select(self, mailbox='INBOX', readonly=True):
+    def select(self, mailbox='INBOX', readonly=True, refresh=False):
         # This routine caches the SELECT operations, because we will be
         # making lots and lots of superfluous ones "just in case" as part
         # of multiplexing one IMAP connection for multiple mailboxes.
+        # Passing refresh=True bypasses the cache, to get fresh counts.
         assert(self._lock.locked())
-        if self._selected and self._selected[0] == (mailbox, readonly):
+        if (not refresh and
+                self._selected and self._selected[0] == (mailbox, readonly)):
             return self._selected[1]
         rv = self._conn.select(mailbox='"%s"' % mailbox, readonly=readonly)
         if rv[0].upper() == 'OK':
             info = dict(self._conn.response(f) for f in
-                        ('FLAGS', 'EXISTS', 'RECENT', 'UIDVALIDITY'))
+                        ('FLAGS', 'EXISTS', 'RECENT', 'UIDVALIDITY',
+                         'UIDNEXT', 'HIGHESTMODSEQ'))
             self._selected = ((mailbox, readonly), rv, info)
         else:
             info = '(error)'
@@ -215,7 +316,11 @@ class SharedImapConn(threading.Thread):
         if not self._conn:
             raise IOError('I am dead')
         self._stop_idling()
-        self._lock.acquire()
+        try:
+            self._lock.acquire()
+        except:
+            self._start_idling()
+            raise
         return self
 
     def __exit__(self, type, value, traceback):
@@ -223,23 +328,112 @@ class SharedImapConn(threading.Thread):
         self._start_idling()
 
     def _start_idling(self):
-        pass  # FIXME
+        with self._users_lock:
+            self._users -= 1
+            self._last_used = time.time()
 
     def _stop_idling(self):
-        pass  # FIXME
+        # This makes the IDLE loop (if running) stop and release the lock.
+        with self._users_lock:
+            self._users += 1
+
+    def _want_idle(self):
+        return (self._idle_mailbox and self._idle_callback and
+                not self._users and
+                time.time() - self._last_used >= self.IDLE_DELAY)
+
+    def _idle(self, deadline):
+        # IDLE until the deadline, until something changes or until
+        # somebody else needs the connection. This uses imaplib's low-level
+        # send/readline, as imaplib itself doesn't know about IDLE.
+        changes = []
+        with self._lock:
+            conn = self._conn
+            if self._users or not conn:
+                return
+            typ, data = self.select(self._idle_mailbox)
+            if typ.upper() != 'OK':
+                self._idle_callback = None
+                return
+
+            tag = conn._new_tag()
+            conn.send('%s IDLE\r\n' % tag)
+            line = conn.readline()
+            if not line.startswith('+'):
+                # Server refused, don't ask again.
+                if 'imap' in self.session.config.sys.debug:
+                    self.session.ui.debug('IDLE refused: %s' % line.strip())
+                conn.tagged_commands.pop(tag, None)
+                self._idle_callback = None
+                return
+
+            self._idling = True
+            try:
+                while (not changes and not self._users and
+                        self._conn and time.time() < deadline):
+                    r, w, x = select.select([conn.socket()], [], [],
+                                            self.IDLE_POLL)
+                    if r:
+                        line = conn.readline()
+                        if not line:
+                            raise IOError('Connection closed while idling')
+                        self._idle_change(line, changes)
+            finally:
+                self._idling = False
+                conn.send('DONE\r\n')
+                while True:
+                    line = conn.readline()
+                    if not line:
+                        raise IOError('Connection closed while idling')
+                    if line.startswith(tag):
+                        break
+                    self._idle_change(line, changes)
+                conn.tagged_commands.pop(tag, None)
+
+            if changes:
+                # Our cached SELECT counts are stale now.
+                self._selected = None
+
+        if changes:
+            if 'imap' in self.session.config.sys.debug:
+                self.session.ui.debug('IDLE %s: %s' % (self._idle_mailbox,
+                                                       changes))
+            self._idle_callback(self._idle_mailbox, changes)
+
+    def _idle_change(self, line, changes):
+        """
+        Parse an untagged IDLE response into (number, change) tuples.
+        For VANISHED the "number" is the set of UIDs which went away.
+
+        >>> changes = []
+        >>> for line in ('* 3 EXPUNGE', '* VANISHED 4:6,9', '* OK still',
+        ...              '* 7 exists'):
+        ...     SharedImapConn._idle_change.im_func(None, line, changes)
+        >>> changes
+        [(3, 'EXPUNGE'), ('4:6,9', 'VANISHED'), (7, 'EXISTS')]
+        """
+        m = IDLE_CHANGE.match(line)
+        if m and m.group(3):
+            changes.append((m.group(4), 'VANISHED'))
+        elif m:
+            changes.append((int(m.group(1)), m.group(2).upper()))
 
     def quit(self):
         self._conn = None
         self._update_name()
 
     def run(self):
-        # FIXME: Do IDLE stuff if requested.
         try:
             while self._conn:
                 # By default, all this does is send a NOOP every 120 seconds
-                # to keep the connection alive (or detect errors).
-                for t in range(0, 120):
-                    time.sleep(1 if self._conn else 0)
+                # to keep the connection alive (or detect errors). If IDLE
+                # was requested, we IDLE whenever we're not otherwise busy.
+                deadline = time.time() + self.KEEPALIVE
+                while self._conn and time.time() < deadline:
+                    if self._want_idle():
+                        self._idle(deadline)
+                    else:
+                        time.sleep(1)
                 if self._conn:
                     with self as raw_conn:
                         raw_conn.noop()
@@ -251,15 +445,209 @@ class SharedImapConn(threading.Thread):
             self._update_name()
 
 
+class SharedImapPool(object):
+    """
+    This is a bounded pool of SharedImapConns to a single server, which
+    can be used wherever a single SharedImapConn was: "with pool as conn"
+    checks out a connection. More connections are opened on demand, up to
+    the limit; when we are at the limit, callers wait their turn.
+
+    Callers which know what mailbox they want should check out using
+    "with pool.using(mailbox) as conn", which prefers a connection that
+    already has that mailbox selected.
+
+    Connections which haven't been used for a while get a NOOP before
+    they are handed out, and dead ones are replaced. Surplus connections
+    are closed by reap() when they've been unused for IDLE_TIMEOUT.
+
+    >>> pool = SharedImapPool(session, SharedImapConn(session, _MockImap()),
+    ...                       lambda: SharedImapConn(session, _MockImap()), 2)
+    >>> with pool as c1:
+    ...     with pool.using('INBOX') as c2:
+    ...         c1 is c2, len(pool._conns)
+    (False, 2)
+    >>> with pool.using('INBOX') as c3:
+    ...     c3 is c2
+    True
+    >>> pool.quit()
+    >>> pool.alive()
+    False
+    """
+    HEALTH_CHECK_AGE = 30
+    IDLE_TIMEOUT = 300
+
+    def __init__(self, session, first, connect, max_conns, timed=None):
+        self.session = session
+        self.max_conns = max(1, max_conns)
+        self._connect = connect
+        self._timed = timed or (lambda func, *a, **kw: func(*a, **kw))
+        self._cond = threading.Condition(MSrcLock())
+        self._conns = [first]
+        self._free = [first]
+        self._opening = 0
+        self._local = threading.local()
+
+    def __repr__(self):
+        return '<SharedImapPool(%s)>' % self._conns
+
+    def alive(self):
+        return bool([c for c in self._conns if c._conn])
+
+    def can_idle(self):
+        return bool([c for c in self._conns
+                     if c._conn and c._idle_callback])
+
+    def _pick(self, mailbox):
+        # Prefer connections with our mailbox selected, then ones which
+        # are not busy IDLEing.
+        def score(conn):
+            selected = conn._selected and conn._selected[0][0]
+            return (mailbox is not None and selected == mailbox,
+                    not conn._idling)
+        return max(self._free, key=score)
+
+    def _healthy(self, conn):
+        if conn._idling:
+            return True
+        if time.time() - conn._last_used < self.HEALTH_CHECK_AGE:
+            return True
+        try:
+            with conn as c:
+                return (self._timed(c.noop)[0] == 'OK')
+        except (IOError, IMAP4.error, AttributeError, TimedOut):
+            return False
+
+    def checkout(self, mailbox=None):
+        while True:
+            conn = None
+            with self._cond:
+                while conn is None:
+                    self._conns = [c for c in self._conns if c._conn]
+                    self._free = [c for c in self._free if c._conn]
+                    if self._free:
+                        conn = self._pick(mailbox)
+                        self._free.remove(conn)
+                    elif len(self._conns) + self._opening < self.max_conns:
+                        self._opening += 1
+                        break
+                    elif not self._conns and not self._opening:
+                        raise IOError('No live connections')
+                    else:
+                        self._cond.wait(1)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                finally:
+                    with self._cond:
+                        self._opening -= 1
+                        if conn is not None:
+                            self._conns.append(conn)
+                if conn is None:
+                    with self._cond:
+                        # Couldn't grow, make do with what we have
+                        self.max_conns = max(1, len(self._conns))
+                    continue
+
+            if self._healthy(conn):
+                try:
+                    conn.__enter__()
+                    if conn._conn:
+                        return conn
+                    conn.__exit__(None, None, None)
+                except IOError:
+                    pass
+            conn.quit()
+            self.checkin(conn)
+
+    def checkin(self, conn):
+        with self._cond:
+            if conn._conn:
+                self._free.append(conn)
+            self._cond.notify()
+
+    def using(self, mailbox):
+        return _ImapCheckout(self, mailbox)
+
+    def __enter__(self):
+        checkout = _ImapCheckout(self, None)
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        self._local.stack.append(checkout)
+        return checkout.__enter__()
+
+    def __exit__(self, *args):
+        return self._local.stack.pop(-1).__exit__(*args)
+
+    def reap(self):
+        """Close surplus connections which haven't been used in a while."""
+        with self._cond:
+            expired = [c for c in self._free[1:]
+                       if time.time() - c._last_used > self.IDLE_TIMEOUT
+                       and not c._idle_callback]
+            for conn in expired:
+                self._free.remove(conn)
+                self._conns.remove(conn)
+        for conn in expired:
+            conn.quit()
+
+    def quit(self):
+        with self._cond:
+            conns, self._conns, self._free = self._conns, [], []
+        for conn in conns:
+            conn.quit()
+
+
+class _ImapCheckout(object):
+    def __init__(self, pool, mailbox):
+        self.pool = pool
+        self.mailbox = mailbox
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = self.pool.checkout(self.mailbox)
+        return self.conn
+
+    def __exit__(self, *args):
+        try:
+            self.conn.__exit__(*args)
+        finally:
+            self.pool.checkin(self.conn)
+
+
 class SharedImapMailbox(Mailbox):
     """
     This implements a Mailbox view of an IMAP folder. The IMAP connection
     itself is obtained as a SharedImapConn from a particular mail source.
 
+    Downloads are batched: iter_bytes() fetches sizes and flags for many
+    messages with one command, and then fetches small messages many at a
+    time and large ones in chunks, sized to the measured bandwidth.
+
     >>> imap = ImapMailSource(session, imap_config)
     >>> mailbox = SharedImapMailbox(session, imap, conn_cls=_MockImap)
     >>> #mailbox.add('From: Bjarni\\r\\nBarely a message')
+
+    >>> mailbox = SharedImapMailbox(session, imap, conn_cls=_Mocks.Mailbox)
+    >>> keys = ['1.%s' % b36(uid) for uid in sorted(_Mocks.Mailbox.MESSAGES)]
+    >>> del _Mocks.Mailbox.FETCHES[:]
+    >>> imap.bandwidth = 1024
+    >>> [(k, len(data)) for k, data in mailbox.iter_bytes(keys)]
+    [('1.1', 11), ('1.2', 20000), ('1.3', 3), ('1.5', 12)]
+    >>> for fetch in _Mocks.Mailbox.FETCHES:
+    ...     print fetch
+    1:3,5 (UID RFC822.SIZE FLAGS)
+    1 (UID BODY[])
+    2 (UID BODY[]<0.15360>)
+    2 (UID BODY[]<15360.61440>)
+    3,5 (UID BODY[])
+    >>> mailbox.get_bytes('1.2') == _Mocks.Mailbox.MESSAGES[2]
+    True
+    >>> '1.4' in mailbox, '1.5' in mailbox
+    (False, True)
     """
+    INFO_BATCH = 500
+    BODY_BATCH = 100
 
     def __init__(self, session, mail_source,
                  mailbox_path='INBOX', conn_cls=None):
@@ -271,7 +659,8 @@ class SharedImapMailbox(Mailbox):
         self._factory = None  # Unused, for Mailbox compatibility
 
     def open_imap(self):
-        return self.source.open(throw=IMAP_IOError, conn_cls=self.conn_cls)
+        return self.source.open(throw=IMAP_IOError, conn_cls=self.conn_cls
+                                ).using(self.path)
 
     def timed_imap(self, *args, **kwargs):
         return self.source.timed_imap(*args, **kwargs)
@@ -300,54 +689,138 @@ class SharedImapMailbox(Mailbox):
                                        mailbox=self.path)
             self._assert(ok, _('Failed to remove message'))
 
-    def mailbox_info(self, k, default=None):
+    def mailbox_info(self, k, default=None, refresh=False):
         with self.open_imap() as imap:
-            imap.select(self.path)
+            imap.select(self.path, refresh=refresh)
             return imap.mailbox_info(k, default=default)
 
-    def get_info(self, key):
-        with self.open_imap() as imap:
+    def get_infos(self, keys):
+        """Fetch sizes and flags for many messages with a single command."""
+        uids = {}
+        for key in keys:
             uidv, uid = (int(k, 36) for k in key.split('.'))
-            ok, data = self.timed_imap(imap.uid, 'FETCH', uid,
-                                       # Note: It seems that either python's
-                                       #       imaplib, or our parser cannot
-                                       #       handle dovecot's ENVELOPE
-                                       #       details. So omit that for now.
-                                       '(RFC822.SIZE FLAGS)',
-                                       mailbox=self.path)
+            uids[uid] = (uidv, key)
+        infos = {}
+        if not uids:
+            return infos
+        with self.open_imap() as imap:
+            typ, data = self.source.timed(imap.uid, 'FETCH', _uid_set(uids),
+                                          # Note: It seems that either
+                                          #       python's imaplib, or our
+                                          #       parser cannot handle
+                                          #       dovecot's ENVELOPE details.
+                                          #       So omit that for now.
+                                          '(UID RFC822.SIZE FLAGS)',
+                                          mailbox=self.path)
+            ok, data = _parse_imap((typ, data))
             if not ok:
                 raise KeyError
-            self._assert(str(uidv) in imap.mailbox_info('UIDVALIDITY', ['0']),
+            validity = imap.mailbox_info('UIDVALIDITY', ['0'])
+            self._assert(not [1 for uidv, k in uids.values()
+                              if str(uidv) not in validity],
                          _('Mailbox is out of sync'))
-            info = dict(zip(*[iter(data[1])]*2))
-            info['UIDVALIDITY'] = uidv
-            info['UID'] = uid
+        for fields in data:
+            if not isinstance(fields, list):
+                continue
+            info = dict(zip(*[iter(fields)]*2))
+            uid = int(info.get('UID', -1))
+            if uid in uids:
+                info['UIDVALIDITY'], key = uids[uid]
+                info['UID'] = uid
+                infos[key] = info
+        return infos
+
+    def get_info(self, key):
+        info = self.get_infos([key]).get(key)
+        if info is None:
+            raise KeyError(key)
         return info
 
-    def get(self, key):
-        info = self.get_info(key)
+    def _fetch_chunked(self, info):
+        # Download a message in chunks, one command per chunk.
         msg_bytes = int(info['RFC822.SIZE'])
-        with self.open_imap() as imap:
-            msg_data = []
-
-            # FIXME: This will hard fail to download mail, if our internet
-            #        connection averages 8 kbps or worse. Better would be to
-            #        adapt the chunk size here to actual network performance.
-            #
-            chunk_size = self.source.timeout * 1024
-            chunks = 1 + msg_bytes // chunk_size
-            for chunk in range(0, chunks):
-                req = '(BODY[]<%d.%d>)' % (chunk * chunk_size, chunk_size)
+        msg_data, offset = [], 0
+        while True:
+            chunk_size = self.source.chunk_size()
+            req = '(UID BODY[]<%d.%d>)' % (offset, chunk_size)
+            with self.open_imap() as imap:
                 # Note: use the raw method, not the convenient parsed version.
+                t0 = time.time()
                 typ, data = self.source.timed(imap.uid,
                                               'FETCH', info['UID'], req,
                                               mailbox=self.path)
-                self._assert((typ == 'OK') and (chunk == chunks-1 or
-                                                len(data[0][1]) == chunk_size),
-                             _('Fetching chunk %d failed') % chunk)
-                msg_data.append(data[0][1])
+                elapsed = time.time() - t0
+            chunk = None
+            if typ == 'OK':
+                chunk = _parse_fetch_literals(data).get(info['UID'])
+            self._assert((chunk is not None) and
+                         (len(chunk) == chunk_size or
+                          offset + len(chunk) >= msg_bytes),
+                         _('Fetching chunk %d failed') % len(msg_data))
+            self.source.measured(len(chunk), elapsed)
+            msg_data.append(chunk)
+            offset += len(chunk)
+            if len(chunk) < chunk_size or offset >= msg_bytes:
+                return ''.join(msg_data)
+
+    def _fetch_many(self, batch):
+        # Download a batch of small messages with a single command.
+        if not batch:
+            return
+        with self.open_imap() as imap:
+            t0 = time.time()
+            typ, data = self.source.timed(imap.uid, 'FETCH',
+                                          _uid_set(i['UID'] for k, i in batch),
+                                          '(UID BODY[])',
+                                          mailbox=self.path)
+            elapsed = time.time() - t0
+        self._assert(typ == 'OK', _('Failed to fetch messages'))
+        found = _parse_fetch_literals(data)
+        self.source.measured(sum(len(d) for d in found.values()), elapsed)
+        for key, info in batch:
+            if info['UID'] in found:
+                yield key, found[info['UID']]
+            else:
+                # Empty messages may come back without a literal, and some
+                # servers are just strange. Try again the slow way.
+                yield key, self._fetch_chunked(info)
+
+    def iter_bytes(self, keys):
+        """
+        Download many messages, yielding (key, data) pairs in order.
+        Messages which have been deleted from the server are skipped.
+
+        The connection is only held while a command is running, so other
+        users of the shared connection are not locked out between batches.
+        """
+        keys = list(keys)
+        for i in range(0, len(keys), self.INFO_BATCH):
+            batch = keys[i:i + self.INFO_BATCH]
+            infos = self.get_infos(batch)
+            small, small_bytes = [], 0
+            for key in batch:
+                info = infos.get(key)
+                if info is None:
+                    continue
+                msg_bytes = int(info['RFC822.SIZE'])
+                limit = self.source.chunk_size()
+                if (msg_bytes > limit or
+                        small_bytes + msg_bytes > limit or
+                        len(small) >= self.BODY_BATCH):
+                    for key_data in self._fetch_many(small):
+                        yield key_data
+                    small, small_bytes = [], 0
+                if msg_bytes > limit:
+                    yield key, self._fetch_chunked(info)
+                else:
+                    small.append((key, info))
+                    small_bytes += msg_bytes
+            for key_data in self._fetch_many(small):
+                yield key_data
 
-            return info, ''.join(msg_data)
+    def get(self, key):
+        info = self.get_info(key)
+        return info, self._fetch_chunked(info)
 
     def get_message(self, key):
         info, payload = self.get(key)
@@ -361,18 +834,85 @@ class SharedImapMailbox(Mailbox):
         info, payload = self.get(key)
         return StringIO.StringIO(payload)
 
+    def _sync_uids(self, imap):
+        # With CONDSTORE, we remember which UIDs the mailbox had as of
+        # which HIGHESTMODSEQ. If that hasn't changed, neither has the
+        # mailbox and one SELECT was all it took. Otherwise we ask for
+        # what changed since then and (with QRESYNC) what vanished. If
+        # the result doesn't add up to EXISTS, we give up and return None,
+        # so the caller lists everything.
+        ok, data = self.timed_imap(imap.select, self.path, refresh=True)
+        if not ok:
+            return None
+        uv, ms, ex = (imap.mailbox_info(k, [None])[0] for k in
+                      ('UIDVALIDITY', 'HIGHESTMODSEQ', 'EXISTS'))
+        state = self.source.sync_state().get(self.path, {})
+        if None in (uv, ms, ex) or state.get('uv') != uv:
+            return None
+
+        uids = set(_uid_list(state['uids']))
+        if state['ms'] != ms:
+            qresync = 'QRESYNC' in self.source.enabled
+            imap.response('VANISHED')  # Discard anything stale
+            ok, data = self.timed_imap(imap.uid, 'FETCH', '1:*', '(UID)',
+                                       '(CHANGEDSINCE %s%s)'
+                                       % (state['ms'],
+                                          qresync and ' VANISHED' or ''),
+                                       mailbox=self.path)
+            if not ok:
+                return None
+            for fields in data:
+                if isinstance(fields, list):
+                    uids.add(int(dict(zip(*[iter(fields)]*2))['UID']))
+            if qresync:
+                typ, vanished = imap.response('VANISHED')
+                for v in vanished:
+                    if v:
+                        uids -= set(_uid_list(v.split()[-1]))
+        if len(uids) != int(ex):
+            return None
+        return uids
+
     def iterkeys(self):
         with self.open_imap() as imap:
-            ok, data = self.timed_imap(imap.uid, 'SEARCH', None, 'ALL',
-                                       mailbox=self.path)
-            self._assert(ok, _('Failed to list mailbox contents'))
+            uids = None
+            if self.source.enabled:
+                uids = self._sync_uids(imap)
+            if uids is None:
+                ok, data = self.timed_imap(imap.uid, 'SEARCH', None, 'ALL',
+                                           mailbox=self.path)
+                self._assert(ok, _('Failed to list mailbox contents'))
+                uids = set(int(k) for k in data)
             validity = imap.mailbox_info('UIDVALIDITY', ['0'])[0]
-            return ('%s.%s' % (b36(int(validity)), b36(int(k)))
-                    for k in sorted(data))
+            modseq = imap.mailbox_info('HIGHESTMODSEQ', [None])[0]
+            if self.source.enabled and modseq:
+                self.source.sync_state()[self.path] = {
+                    'uv': validity,
+                    'ms': modseq,
+                    'uids': _uid_set(uids)
+                }
+            return ('%s.%s' % (b36(int(validity)), b36(k))
+                    for k in sorted(uids))
 
     def update_toc(self):
         pass
 
+    def get_change_token(self):
+        """UIDVALIDITY, UIDNEXT and EXISTS change if mail comes or goes."""
+        try:
+            with self.open_imap() as imap:
+                ok, data = self.timed_imap(imap.select, self.path,
+                                           refresh=True)
+                if not ok:
+                    return None
+                info = [imap.mailbox_info(k, [None])[0]
+                        for k in ('UIDVALIDITY', 'UIDNEXT', 'EXISTS')]
+            if None in info:
+                return None
+            return ':'.join(str(i) for i in info)
+        except (IOError, IMAP4.error):
+            return None
+
     def get_msg_ptr(self, mboxid, key):
         return '%s%s' % (mboxid, quote(key))
 
@@ -423,15 +963,29 @@ class ImapMailSource(BaseMailSource):
 
     TIMEOUT_INITIAL = 15
     TIMEOUT_LIVE = 60
+    IDLE_MAILBOX = 'INBOX'
+    IDLE_FALLBACK_INTERVAL = 30 * 60
     CONN_ERRORS = (IOError, IMAP_IOError, IMAP4.error, TimedOut)
 
+    # Downloads are split into chunks, or grouped into batches, so each
+    # command takes about a quarter of the timeout at the bandwidth we have
+    # measured. Until we know better, we assume a sluggish 4kB/s.
+    BANDWIDTH_INITIAL = 4096
+    CHUNK_MIN = 4096
+    CHUNK_MAX = 16 * 1024 * 1024
+
     def __init__(self, *args, **kwargs):
         BaseMailSource.__init__(self, *args, **kwargs)
         self.timeout = self.TIMEOUT_INITIAL
+        self.bandwidth = self.BANDWIDTH_INITIAL
         self.watching = -1
         self.capabilities = set()
         self.conn = None
         self.conn_id = ''
+        self._idle_changed = set()
+        self._checked = {}
+        self.enabled = set()
+        self._unsaved_state = {}
 
     @classmethod
     def Tester(cls, conn_cls, *args, **kwargs):
@@ -444,13 +998,115 @@ class ImapMailSource(BaseMailSource):
     def timed_imap(self, *args, **kwargs):
         return _parse_imap(RunTimed(self.timeout, *args, **kwargs))
 
+    def sync_state(self):
+        """Per-mailbox CONDSTORE state, saved along with our event."""
+        data = self.event.data if self.event else self._unsaved_state
+        if 'imap_sync' not in data:
+            data['imap_sync'] = {}
+        return data['imap_sync']
+
+    def chunk_size(self):
+        """
+        How many bytes to ask for in one command.
+
+        >>> imap = ImapMailSource(session, imap_config)
+        >>> imap.chunk_size()
+        15360
+        >>> imap.measured(15360, 0.1)
+        >>> imap.chunk_size()
+        61440
+        >>> imap.measured(61440, 60)
+        >>> imap.chunk_size()
+        32640
+        """
+        chunk_size = int(self.bandwidth * self.timeout // 4)
+        return max(self.CHUNK_MIN, min(self.CHUNK_MAX, chunk_size))
+
+    def measured(self, nbytes, seconds):
+        # Small replies measure latency, not bandwidth, so they are ignored.
+        # Otherwise we keep a moving average, but don't let one lucky reply
+        # make us much greedier all at once.
+        if nbytes >= self.chunk_size() // 2:
+            rate = float(nbytes) / max(seconds, 0.001)
+            self.bandwidth = min(4 * self.bandwidth,
+                                 (self.bandwidth + rate) / 2)
+
+    def _idle_covers_all(self):
+        """
+        True if IDLE watches every mailbox we watch: IDLE only covers
+        IDLE_MAILBOX, other folders still need the regular poll.
+
+        >>> imap = ImapMailSource(session, imap_config)
+        >>> imap_config.mailbox['0001'] = {'path': 'src:imap/INBOX',
+        ...                                'policy': 'read'}
+        >>> imap._idle_covers_all()
+        True
+        >>> imap_config.mailbox['0002'] = {'path': 'src:imap/Sent',
+        ...                                'policy': 'ignore'}
+        >>> imap._idle_covers_all()
+        True
+        >>> imap_config.mailbox['0002'].policy = 'read'
+        >>> imap._idle_covers_all()
+        False
+        >>> imap_config.mailbox = {}
+        """
+        watched = [self._mailbox_name(self._path(mbx_cfg))
+                   for mbx_cfg in self.my_config.mailbox.values()
+                   if mbx_cfg.policy not in ('ignore', 'unknown')]
+        return watched == [self.IDLE_MAILBOX]
+
     def _sleep(self, seconds):
-        # FIXME: While we are sleeping, we should switch to IDLE mode
-        #        if it is available.
-        if 'IDLE' in self.capabilities:
-            pass
+        # If the server can IDLE and that covers all our mailboxes, new
+        # mail wakes us up right away, so the regular poll is just a
+        # fallback and can be much less frequent. Otherwise IDLE merely
+        # pulls INBOX in early.
+        if (self.conn and self.conn.can_idle() and
+                seconds >= self.my_config.interval and
+                self._idle_covers_all()):
+            seconds = max(seconds, self.IDLE_FALLBACK_INTERVAL)
         return BaseMailSource._sleep(self, seconds)
 
+    def _sorted_mailboxes(self):
+        # When woken up by IDLE, only look at the mailboxes which changed.
+        mailboxes = BaseMailSource._sorted_mailboxes(self)
+        with self._lock:
+            idled, self._idle_changed = self._idle_changed, set()
+        if idled:
+            mailboxes = [m for m in mailboxes if m._key in idled]
+        self._check_mailboxes(mailboxes)
+        return mailboxes
+
+    def _check_mailboxes(self, mailboxes):
+        # Check which mailboxes have changed in parallel, over as many
+        # connections as we are allowed. The rescans themselves then happen
+        # one at a time, as they are mostly waiting for the search index.
+        self._checked = {}
+        mailboxes = [m for m in mailboxes
+                     if m.policy not in ('ignore', 'unknown')]
+        threads = min(len(mailboxes), self.my_config.connections)
+        if threads < 2 or not self.conn:
+            return
+        checked = {}
+        def checker():
+            while mailboxes and not self._check_interrupt(clear=False):
+                try:
+                    mbx = mailboxes.pop(0)
+                except IndexError:
+                    break
+                state = {}
+                try:
+                    checked[mbx._key] = (self._check_mailbox(mbx, state),
+                                         state)
+                except self.CONN_ERRORS + (NoSuchMailboxError, OSError):
+                    pass
+        threads = [threading.Thread(target=checker) for t in range(threads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        self._checked = checked
+
     def _conn_id(self):
         return md5_hex('\n'.join([str(self.my_config[k]) for k in
                                   ('host', 'port', 'password', 'username')]))
@@ -464,21 +1120,80 @@ class ImapMailSource(BaseMailSource):
             self.conn.quit()
             self.conn = None
 
+    def _new_conn(self, conn_cls):
+        my_config = self.my_config
+        def mkconn():
+            with ConnBroker.context(need=[ConnBroker.OUTGOING_IMAP]):
+                return conn_cls(my_config.host, my_config.port)
+        conn = self.timed(mkconn)
+        conn.debug = ('imaplib' in self.session.config.sys.debug) and 4 or 0
+        return conn
+
+    def _login(self, conn, ev):
+        # Returns the server's capabilities and the extensions we enabled,
+        # or None if we could not log in.
+        my_config = self.my_config
+        ok, data = self.timed_imap(conn.capability)
+        if ok:
+            capabilities = set(' '.join(data).upper().split())
+        else:
+            capabilities = set()
+
+        #if 'STARTTLS' in capabilities and not want_ssl:
+        #
+        # FIXME: We need to send a STARTTLS and do a switcheroo where
+        #        the connection gets encrypted.
+
+        try:
+            ok, data = self.timed_imap(conn.login,
+                                       my_config.username,
+                                       my_config.password)
+        except IMAP4.error:
+            ok = False
+        if not ok:
+            ev['error'] = ['auth', _('Invalid username or password')]
+            return None
+
+        # If the server can tell us what changed since we last
+        # looked, we want it to.
+        enabled = set()
+        if 'ENABLE' in capabilities:
+            for ext in ('QRESYNC', 'CONDSTORE'):
+                if ext in capabilities:
+                    ok, data = self.timed_imap(conn.xatom, 'ENABLE', ext)
+                    if ok:
+                        enabled = set([ext, 'CONDSTORE'])
+                        break
+
+        return capabilities, enabled
+
+    def _pool_connect(self, conn_cls):
+        # Opens more connections for the pool. These don't IDLE, one
+        # connection doing that is enough.
+        def connect():
+            try:
+                conn = self._new_conn(conn_cls)
+                if self._login(conn, {}) is not None:
+                    return SharedImapConn(self.session, conn)
+            except self.CONN_ERRORS + (socket.error, AttributeError):
+                if 'imap' in self.session.config.sys.debug:
+                    self.session.ui.debug(traceback.format_exc())
+            return None
+        return connect
+
     def open(self, conn_cls=None, throw=False):
         conn = self.conn
         conn_id = self._conn_id()
         if conn:
-            try:
-                with conn as c:
-                    if (conn_id == self.conn_id and
-                            self.timed(c.noop)[0] == 'OK'):
-                        # Make the timeout longer, so we don't drop things
-                        # on every hiccup and so downloads will be more
-                        # efficient (chunk size relates to timeout).
-                        self.timeout = self.TIMEOUT_LIVE
-                        return conn
-            except self.CONN_ERRORS + (AttributeError, ):
-                pass
+            # Stale or dead connections are weeded out by the pool itself,
+            # as they are checked out.
+            if conn_id == self.conn_id and conn.alive():
+                # Make the timeout longer, so we don't drop things
+                # on every hiccup and so downloads will be more
+                # efficient (chunk size relates to timeout).
+                self.timeout = self.TIMEOUT_LIVE
+                conn.reap()
+                return conn
             with self._lock:
                 if self.conn == conn:
                     self.conn = None
@@ -501,7 +1216,6 @@ class ImapMailSource(BaseMailSource):
 
         conn = None
         my_config = self.my_config
-        mailboxes = my_config.mailbox.values()
 
         # If we are given a conn class, use that - this allows mocks for
         # testing.
@@ -510,47 +1224,30 @@ class ImapMailSource(BaseMailSource):
             conn_cls = IMAP4_SSL if want_ssl else IMAP4
 
         try:
-            def mkconn():
-                with ConnBroker.context(need=[ConnBroker.OUTGOING_IMAP]):
-                    return conn_cls(my_config.host, my_config.port)
-            conn = self.timed(mkconn)
-            conn.debug = ('imaplib' in self.session.config.sys.debug
-                          ) and 4 or 0
-
-            ok, data = self.timed_imap(conn.capability)
-            if ok:
-                capabilities = set(' '.join(data).upper().split())
-            else:
-                capabilities = set()
-
-            #if 'STARTTLS' in capabilities and not want_ssl:
-            #
-            # FIXME: We need to send a STARTTLS and do a switcheroo where
-            #        the connection gets encrypted.
-
-            try:
-                ok, data = self.timed_imap(conn.login,
-                                           my_config.username,
-                                           my_config.password)
-            except IMAP4.error:
-                ok = False
-            if not ok:
-                ev['error'] = ['auth', _('Invalid username or password')]
+            conn = self._new_conn(conn_cls)
+            login = self._login(conn, ev)
+            if login is None:
                 if throw:
-                    raise throw(event.data['conn_error'])
+                    raise throw(ev['error'])
                 return WithaBool(False)
+            capabilities, enabled = login
 
             with self._lock:
                 if self.conn is not None:
                     raise IOError('Woah, we lost a race.')
                 self.capabilities = capabilities
+                self.enabled = enabled
                 if 'IDLE' in capabilities:
-                    self.conn = SharedImapConn(
+                    first = SharedImapConn(
                         self.session, conn,
-                        idle_mailbox='INBOX',
+                        idle_mailbox=self.IDLE_MAILBOX,
                         idle_callback=self._idle_callback)
                 else:
-                    self.conn = SharedImapConn(self.session, conn)
+                    first = SharedImapConn(self.session, conn)
+                self.conn = SharedImapPool(self.session, first,
+                                           self._pool_connect(conn_cls),
+                                           my_config.connections,
+                                           timed=self.timed)
 
             if self.event:
                 self._log_status(_('Connected to IMAP server %s'
@@ -587,8 +1284,16 @@ class ImapMailSource(BaseMailSource):
             raise throw(ev['error'])
         return WithaBool(False)
 
-    def _idle_callback(self, data):
-        pass
+    def _idle_callback(self, mailbox, changes):
+        if not [c for c in changes
+                if c[1] in ('EXISTS', 'EXPUNGE', 'VANISHED')]:
+            return
+        with self._lock:
+            for mbx_cfg in self.my_config.mailbox.values():
+                if self._mailbox_name(self._path(mbx_cfg)) == mailbox:
+                    self._idle_changed.add(mbx_cfg._key)
+        if self._idle_changed:
+            self.wake_up()
 
     def open_mailbox(self, mbx_id, mfn):
         if FormatMbxId(mbx_id) in self.my_config.mailbox:
@@ -602,19 +1307,36 @@ class ImapMailSource(BaseMailSource):
         return None
 
     def _has_mailbox_changed(self, mbx, state):
+        checked = self._checked.pop(mbx._key, None)
+        if checked is not None:
+            state.update(checked[1])
+            return checked[0]
+        return self._check_mailbox(mbx, state)
+
+    def _check_mailbox(self, mbx, state):
         src = self.session.config.open_mailbox(self.session,
                                                FormatMbxId(mbx._key),
                                                prefer_local=False)
-        uv = state['uv'] = src.mailbox_info('UIDVALIDITY', ['0'])[0]
+        uv = state['uv'] = src.mailbox_info('UIDVALIDITY', ['0'],
+                                            refresh=True)[0]
         ex = state['ex'] = src.mailbox_info('EXISTS', ['0'])[0]
-        uvex = '%s/%s' % (uv, ex)
-        if uvex == '0/0':
+        state['un'] = src.mailbox_info('UIDNEXT', [None])[0]
+        if '%s/%s' % (uv, ex) == '0/0':
             return True
-        return (uvex != self.event.data.get('mailbox_state',
-                                            {}).get(mbx._key))
+        return (self._uvex(state) != self.event.data.get('mailbox_state',
+                                                         {}).get(mbx._key))
+
+    def _uvex(self, state):
+        # UIDNEXT moves whenever mail arrives, so together with EXISTS it
+        # also catches messages which came and went between scans. We
+        # don't use HIGHESTMODSEQ: it moves for flag changes too, which a
+        # rescan does not pick up, so it would only cost needless rescans.
+        if state.get('un'):
+            return '%s/%s/%s' % (state['uv'], state['ex'], state['un'])
+        return '%s/%s' % (state['uv'], state['ex'])
 
     def _mark_mailbox_rescanned(self, mbx, state):
-        uvex = '%s/%s' % (state['uv'], state['ex'])
+        uvex = self._uvex(state)
         if 'mailbox_state' in self.event.data:
             self.event.data['mailbox_state'][mbx._key] = uvex
         else:
@@ -665,7 +1387,7 @@ class _MockImap(object):
 
     >>> imap = ImapMailSource(session, imap_config)
     >>> imap.open(conn_cls=_MockImap)
-    <SharedImapConn(mock, started ...)>
+    <SharedImapPool([<SharedImapConn(mock, started ...)>])>
 
     >>> sorted(imap.capabilities)
     ['IMAP4REV1', 'X-MAGIC-BEANS']
@@ -688,7 +1410,9 @@ class _MockImap(object):
             return cmd
         for cmd, rval in dict_merge(self.DEFAULT_RESULTS, self.RESULTS
                                     ).iteritems():
-            self.__setattr__(cmd, mkcmd(rval))
+            # Subclasses may implement commands for real
+            if not hasattr(type(self), cmd):
+                self.__setattr__(cmd, mkcmd(rval))
 
     def __getattr__(self, attr):
         return self.__getattribute__(attr)
@@ -711,6 +1435,124 @@ class _Mocks(object):
     class BadLogin(_MockImap):
         RESULTS = {'login': ('BAD', ['"Sorry dude"'])}
 
+    class Mailbox(_MockImap):
+        MESSAGES = {1: 'Hello world', 2: 'x' * 20000, 3: 'Hi!',
+                    5: 'Goodbye, now'}
+        FETCHES = []
+
+        def response(self, code):
+            return (code, {'UIDVALIDITY': ['1'],
+                           'EXISTS': [str(len(self.MESSAGES))]
+                           }.get(code, [None]))
+
+        def uid(self, command, uids, request):
+            if command == 'SEARCH':
+                return ('OK', [' '.join('%d' % u for u in self.MESSAGES)])
+            self.FETCHES.append('%s %s' % (uids, request))
+            wanted = set()
+            for rng in str(uids).split(','):
+                a, b = (rng + ':' + rng).split(':')[:2]
+                wanted |= set(range(int(a), int(b) + 1))
+            data = []
+            for uid in sorted(wanted & set(self.MESSAGES)):
+                msg = self.MESSAGES[uid]
+                if 'RFC822.SIZE' in request:
+                    data.append('%d (UID %d RFC822.SIZE %d FLAGS (\\Seen))'
+                                % (uid, uid, len(msg)))
+                    continue
+                m = re.search(r'<(\d+)\.(\d+)>', request)
+                if m:
+                    beg, ln = int(m.group(1)), int(m.group(2))
+                    msg = msg[beg:beg + ln]
+                data.extend([('%d (UID %d BODY[] {%d}' % (uid, uid, len(msg)),
+                              msg), ')'])
+            return ('OK', data or [None])
+
+
+    class Idler(Mailbox):
+        RESULTS = {'capability': ('OK', ['IDLE', 'IMAP4rev1'])}
+        NOTIFY = '* 4 EXISTS\r\n'
+
+        def __init__(self, *args, **kwargs):
+            _Mocks.Mailbox.__init__(self, *args, **kwargs)
+            self._server, self._client = socket.socketpair()
+            self.file = self._client.makefile('rb')
+            self.tagged_commands = {}
+            self.sent = []
+
+        def _new_tag(self):
+            self.tagged_commands['MOCK1'] = None
+            return 'MOCK1'
+
+        def socket(self):
+            return self._client
+
+        def readline(self):
+            return self.file.readline()
+
+        def send(self, data):
+            self.sent.append(data)
+            if data.endswith(' IDLE\r\n'):
+                self._server.sendall('+ idling\r\n' + self.NOTIFY)
+            elif data == 'DONE\r\n':
+                self._server.sendall('MOCK1 OK IDLE terminated\r\n')
+
+    class CondStore(Mailbox):
+        """
+        A server with QRESYNC, which counts its round trips.
+
+        >>> imap = ImapMailSource(session, imap_config)
+        >>> mbx = SharedImapMailbox(session, imap, conn_cls=_Mocks.CondStore)
+        >>> len(mbx.keys()), sorted(imap.enabled)
+        (4, ['CONDSTORE', 'QRESYNC'])
+        >>> del _Mocks.CondStore.FETCHES[:]
+        >>> len(mbx.keys()), _Mocks.CondStore.FETCHES
+        (4, ['SELECT'])
+
+        >>> _Mocks.CondStore.MESSAGES[7] = 'New!'
+        >>> _Mocks.CondStore.MODSEQ[7] = 4
+        >>> del _Mocks.CondStore.MESSAGES[2]
+        >>> _Mocks.CondStore.VANISHED.append(2)
+        >>> del _Mocks.CondStore.FETCHES[:]
+        >>> mbx.keys(), _Mocks.CondStore.FETCHES
+        (['1.1', '1.3', '1.5', '1.7'], ['SELECT', 'CHANGEDSINCE 3 VANISHED'])
+        """
+        RESULTS = {'capability': ('OK', ['IMAP4rev1 ENABLE QRESYNC'])}
+        MESSAGES = {1: 'Hello world', 2: 'x' * 20000, 3: 'Hi!',
+                    5: 'Goodbye, now'}
+        MODSEQ = {1: 1, 2: 1, 3: 2, 5: 3}
+        VANISHED = []
+        FETCHES = []
+
+        def xatom(self, name, *args):
+            return ('OK', [])
+
+        def select(self, *args, **kwargs):
+            self.FETCHES.append('SELECT')
+            return ('OK', ['%d' % len(self.MESSAGES)])
+
+        def response(self, code):
+            if code == 'HIGHESTMODSEQ':
+                return (code, [str(max(self.MODSEQ.values()))])
+            if code == 'VANISHED':
+                vanished, self._vanished = getattr(self, '_vanished',
+                                                   None), None
+                return (code, [vanished])
+            return _Mocks.Mailbox.response(self, code)
+
+        def uid(self, command, uids, request, *modifiers):
+            if command == 'SEARCH':
+                self.FETCHES.append('SEARCH')
+            if not modifiers:
+                return _Mocks.Mailbox.uid(self, command, uids, request)
+            since = int(re.search(r'CHANGEDSINCE (\d+)',
+                                  modifiers[0]).group(1))
+            self.FETCHES.append(modifiers[0][1:-1])
+            if 'VANISHED' in modifiers[0] and self.VANISHED:
+                self._vanished = '(EARLIER) %s' % _uid_set(self.VANISHED)
+            return ('OK', ['%d (UID %d MODSEQ (%d))' % (uid, uid, ms)
+                           for uid, ms in sorted(self.MODSEQ.items())
+                           if ms > since and uid in self.MESSAGES] or [None])
 
 if __name__ == "__main__":
     import doctest
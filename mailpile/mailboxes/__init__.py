@@ -8,6 +8,8 @@
 ## info required to locate this message and this message only within the
 ## larger mailbox.
 
+import os
+import time
 from urllib import quote, unquote
 
 from mailpile.i18n import gettext as _
@@ -127,6 +129,25 @@ def UnorderedPicklable(parent, editable=False):
         def update_toc(self):
             self._refresh()
 
+        def get_change_token(self):
+            """
+            Return a value which changes whenever mail is added or removed,
+            or None if we cannot tell cheaply. For Maildirs, that is the
+            mtimes of the directories. Very recent mtimes are not trusted,
+            as some filesystems only have one second resolution.
+            """
+            paths = getattr(self, '_paths', None)
+            if not paths:
+                return None
+            try:
+                stats = [os.stat(paths[k]) for k in sorted(paths.keys())]
+            except OSError:
+                return None
+            if max(st.st_mtime for st in stats) > time.time() - 2:
+                return None
+            return ','.join('%s:%s' % (st.st_ino, st.st_mtime)
+                            for st in stats)
+
         def get_msg_ptr(self, mboxid, toc_id):
             return '%s%s' % (mboxid, quote(toc_id))
 
@@ -32,6 +32,10 @@ class MailpileMailbox(maildir.MailpileMailbox):
             f = open(os.path.join(self._path, fname), 'rb')
         return mailbox._ProxyFile(f)
 
+    def get_change_token(self):
+        # Mail lives in nested subdirectories, so there is no cheap check.
+        return None
+
     def _refresh(self):
         """Update table of contents mapping."""
         # Refresh toc
@@ -1,5 +1,6 @@
 import errno
 import mailbox
+import mmap
 import os
 import threading
 
@@ -34,6 +35,7 @@ class MailpileMailbox(mailbox.mbox):
         self._encryption_key_func = lambda: None
         self._decryption_key_func = lambda: None
         self._lock = MboxRLock()
+        self._ptr_cache = {}
 
     def __enter__(self, *args, **kwargs):
         self._lock.acquire()
@@ -48,6 +50,7 @@ class MailpileMailbox(mailbox.mbox):
     def __setstate__(self, dict):
         self.__dict__.update(dict)
         self._lock = MboxRLock()
+        self._ptr_cache = {}
         self.is_local = False
         with self._lock:
             self._save_to = None
@@ -71,16 +74,88 @@ class MailpileMailbox(mailbox.mbox):
         # Pickle can't handle function objects.
         for dk in ('_save_to',
                    '_encryption_key_func', '_decryption_key_func',
-                   '_file', '_lock', 'parsed'):
+                   '_file', '_lock', '_ptr_cache', 'parsed'):
             if dk in odict:
                 del odict[dk]
         return odict
 
+    #
+    # The table of contents is updated incrementally when mail is appended.
+    # We record a checkpoint: the key and offset of the last message, and
+    # checksums of the first few bytes of the file and of that message.
+    # If the file has grown and both checksums still match, only the last
+    # message (which may have been incomplete) and anything after it gets
+    # rescanned. Otherwise we rebuild from scratch.
+    #
+    # Message boundaries are found by searching memory mapped chunks of the
+    # file for '\nFrom ', instead of reading it a line at a time.
+    #
+    TOC_CHUNK_BYTES = 16 * 1024 * 1024
+    TOC_CHECKPOINT_BYTES = 1024
+
+    def _checksum(self, fd, start, length):
+        fd.seek(start)
+        return sha1b64(fd.read(length))
+
+    def _make_toc_checkpoint(self, fd):
+        if not self._toc:
+            return None
+        key = self._next_key - 1
+        start, end = self._toc[key]
+        hlen = min(self.TOC_CHECKPOINT_BYTES, self._file_length)
+        mlen = min(self.TOC_CHECKPOINT_BYTES, end - start)
+        return (key, start,
+                hlen, self._checksum(fd, 0, hlen),
+                mlen, self._checksum(fd, start, mlen))
+
+    def _check_toc_checkpoint(self, fd, checkpoint):
+        key, start, hlen, hsum, mlen, msum = checkpoint
+        return (self._toc.get(key, (None, ))[0] == start and
+                self._checksum(fd, 0, hlen) == hsum and
+                self._checksum(fd, start, mlen) == msum)
+
+    def _find_from_lines(self, fd, start, end):
+        """
+        Generate (offset, newline length) for each line starting with
+        'From ' in the given range of the file, which must begin at the
+        start of a line.
+        """
+        fileno = fd.fileno()
+        fd.seek(start)
+        if fd.read(5) == 'From ':
+            yield start, self._from_line_nl(fd, start)
+        pos = start
+        while pos < end:
+            base = pos - (pos % mmap.ALLOCATIONGRANULARITY)
+            length = min(end - base, self.TOC_CHUNK_BYTES + (pos - base))
+            mm = mmap.mmap(fileno, length, access=mmap.ACCESS_READ,
+                           offset=base)
+            try:
+                i = mm.find('\nFrom ', pos - base)
+                while i >= 0:
+                    line_pos = base + i + 1
+                    eol = mm.find('\n', i + 1)
+                    if eol > 0:
+                        yield line_pos, (mm[eol - 1] == '\r') and 2 or 1
+                    else:
+                        yield line_pos, self._from_line_nl(fd, line_pos)
+                    i = mm.find('\nFrom ', i + 1)
+            finally:
+                mm.close()
+            if base + length >= end:
+                break
+            # Overlap chunks, in case a '\nFrom ' straddles the boundary
+            pos = base + length - 5
+
+    def _from_line_nl(self, fd, line_pos):
+        fd.seek(line_pos)
+        line = fd.readline()
+        return ('\r' == line[-2]) and 2 or 1
+
     def update_toc(self):
         with self._lock:
             fd = self._file
 
-            # FIXME: Should also check the mtime.
             fd.seek(0, 2)
             cur_length = fd.tell()
             cur_mtime = os.path.getmtime(self._path)
@@ -88,30 +163,39 @@ class MailpileMailbox(mailbox.mbox):
                 if (self._file_length == cur_length and
                         self._mtime == cur_mtime):
                     return
+                checkpoint = self._toc_checkpoint
+                if not (checkpoint and
+                        self._file_length < cur_length and
+                        self._check_toc_checkpoint(fd, checkpoint)):
+                    checkpoint = None
             except (NameError, AttributeError):
-                pass
+                checkpoint = None
 
-            fd.seek(0)
-            self._next_key = 0
-            self._toc = {}
-            start = None
-            while True:
-                line_pos = fd.tell()
-                line = fd.readline()
-                if line.startswith('From '):
-                    if start is not None:
-                        len_nl = ('\r' == line[-2]) and 2 or 1
-                        self._toc[self._next_key] = (start, line_pos - len_nl)
-                        self._next_key += 1
-                    start = line_pos
-                elif line == '':
-                    if (start is not None) and (start != line_pos):
-                        self._toc[self._next_key] = (start, line_pos)
-                        self._next_key += 1
-                    break
+            if checkpoint:
+                # Only rescan the last known message and what follows
+                self._next_key, start = checkpoint[:2]
+                del self._toc[self._next_key]
+                self._ptr_cache.pop(self._next_key, None)
+            else:
+                self._next_key = 0
+                self._toc = {}
+                self._ptr_cache = {}
+                start = 0
 
-            self._file_length = fd.tell()
+            msg_start = None
+            for line_pos, len_nl in self._find_from_lines(fd, start,
+                                                          cur_length):
+                if msg_start is not None:
+                    self._toc[self._next_key] = (msg_start, line_pos - len_nl)
+                    self._next_key += 1
+                msg_start = line_pos
+            if (msg_start is not None) and (msg_start != cur_length):
+                self._toc[self._next_key] = (msg_start, cur_length)
+                self._next_key += 1
+
+            self._file_length = cur_length
             self._mtime = cur_mtime
+            self._toc_checkpoint = self._make_toc_checkpoint(fd)
         self.save(None)
 
     def save(self, session=None, to=None, pickler=None):
@@ -148,14 +232,26 @@ class MailpileMailbox(mailbox.mbox):
     def get_msg_cs80b(self, start, max_length):
         return self.get_msg_cs(start, 80, max_length)
 
+    def get_change_token(self):
+        """Return a value which changes whenever the mbox changes."""
+        try:
+            st = os.stat(self._path)
+            return '%s:%s:%s' % (st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            return None
+
     def get_msg_ptr(self, mboxid, toc_id):
         with self._lock:
-            msg_start = self._toc[toc_id][0]
-            msg_size = self.get_msg_size(toc_id)
-        return '%s%s:%s:%s' % (mboxid,
-                               b36(msg_start),
-                               b36(msg_size),
-                               self.get_msg_cs80b(msg_start, msg_size))
+            # The pointer only changes if the TOC does, which clears the
+            # cache, so we can skip the seek and checksum.
+            ptr = self._ptr_cache.get(toc_id)
+            if ptr is None:
+                msg_start = self._toc[toc_id][0]
+                msg_size = self.get_msg_size(toc_id)
+                ptr = self._ptr_cache[toc_id] = '%s:%s:%s' % (
+                    b36(msg_start), b36(msg_size),
+                    self.get_msg_cs80b(msg_start, msg_size))
+        return '%s%s' % (mboxid, ptr)
 
     def get_file_by_ptr(self, msg_ptr):
         parts = msg_ptr[MBX_ID_LEN:].split(':')
@@ -180,3 +276,81 @@ class MailpileMailbox(mailbox.mbox):
 
 
 mailpile.mailboxes.register(90, MailpileMailbox)
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    import tempfile
+
+    def _readline_toc(fn):
+        # The original, line-at-a-time table of contents builder.
+        toc, start = [], None
+        with open(fn, 'rb') as fd:
+            while True:
+                line_pos = fd.tell()
+                line = fd.readline()
+                if line.startswith('From '):
+                    if start is not None:
+                        len_nl = ('\r' == line[-2]) and 2 or 1
+                        toc.append((start, line_pos - len_nl))
+                    start = line_pos
+                elif line == '':
+                    if (start is not None) and (start != line_pos):
+                        toc.append((start, line_pos))
+                    break
+        return toc
+
+    def _msg(n, nl='\n'):
+        return nl.join(['From test@example.com Mon Jan  1 00:00:00 2014',
+                        'Subject: Message %d' % n, '',
+                        'Body of %d' % n, '>From quoted', '', ''])
+
+    tfd, tfn = tempfile.mkstemp()
+    os.close(tfd)
+    try:
+        with open(tfn, 'wb') as fd:
+            fd.write('junk\n' + ''.join(_msg(i) for i in range(0, 5)))
+        mbx = MailpileMailbox(tfn)
+        MailpileMailbox.TOC_CHUNK_BYTES = mmap.ALLOCATIONGRANULARITY
+        mbx.update_toc()
+        toc = lambda m: [m._toc[k] for k in sorted(m._toc.keys())]
+        assert(toc(mbx) == _readline_toc(tfn))
+
+        # Appending (including to the last message) scans incrementally
+        first_key_start = mbx._toc[0]
+        token = mbx.get_change_token()
+        ptrs = lambda m: [m.get_msg_ptr('0000', k) for k in sorted(m._toc)]
+        old_ptrs = ptrs(mbx)
+        with open(tfn, 'ab') as fd:
+            fd.write('more body\n' + _msg(5, nl='\r\n') +
+                     'x' * (3 * mmap.ALLOCATIONGRANULARITY) + '\n' +
+                     ''.join(_msg(i) for i in range(6, 9)))
+        mbx._mtime = 0
+        mbx.update_toc()
+        assert(toc(mbx) == _readline_toc(tfn))
+        assert(len(mbx._toc) == 9 and mbx._toc[0] == first_key_start)
+        assert(mbx.get_change_token() != token)
+        fresh = MailpileMailbox(tfn)
+        fresh.update_toc()
+        assert(ptrs(mbx) == ptrs(fresh))
+        assert(ptrs(mbx)[:4] == old_ptrs[:4] and ptrs(mbx)[4] != old_ptrs[4])
+
+        # Changing the prefix triggers a full rebuild
+        data = open(tfn, 'rb').read()
+        with open(tfn, 'wb') as fd:
+            fd.write(data.replace('Message 0', 'Message zero') + _msg(9))
+        mbx._mtime = 0
+        mbx.update_toc()
+        assert(toc(mbx) == _readline_toc(tfn) and len(mbx._toc) == 10)
+        fresh = MailpileMailbox(tfn)
+        fresh.update_toc()
+        assert(ptrs(mbx) == ptrs(fresh))
+    finally:
+        os.remove(tfn)
+
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
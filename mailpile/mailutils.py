@@ -15,6 +15,7 @@ import re
 import StringIO
 import threading
 import traceback
+from collections import OrderedDict
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
@@ -81,31 +82,148 @@ def MakeContentID():
         return '%x' % GLOBAL_CONTENT_ID
 
 
-GLOBAL_PARSE_CACHE_LOCK = MboxLock()
-GLOBAL_PARSE_CACHE = []
+class ParseCache(object):
+    #
+    # This is an LRU cache of parsed messages, keyed by (cache_id, pgpmime),
+    # where cache_id is usually the message's index position. The cache is
+    # limited by the (estimated) size of the messages it holds, rather than
+    # their number, so a long thread of short messages fits while a single
+    # huge message does not push out everything else. Messages larger than
+    # a quarter of the budget are not cached at all.
+    #
+    # Lookups are O(1): the OrderedDict keeps the least recently used
+    # entry first and entries are moved to the end when they are used.
+    #
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = MboxLock()
+        self.cache = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.cache),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def get(self, cache_id, pgpmime):
+        key = (cache_id, pgpmime)
+        with self.lock:
+            entry = self.cache.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.cache[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def _drop(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[0]
+
+    def put(self, cache_id, pgpmime, message):
+        key = (cache_id, pgpmime)
+        size = ParsedMessageSize(message)
+        with self.lock:
+            self._drop(key)
+            if size > self.max_bytes // 4:
+                return
+            self.cache[key] = (size, message)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self.cache)))
+                self.evictions += 1
+
+    def update(self, cache_id, message):
+        """Replace a cached raw message, if it is cached at all."""
+        with self.lock:
+            if (cache_id, False) not in self.cache:
+                if (cache_id, True) not in self.cache:
+                    return
+            self._drop((cache_id, True))
+        self.put(cache_id, False, message)
+
+    def clear(self, cache_id=None, pgpmime=False, full=False):
+        with self.lock:
+            if full:
+                self.cache = OrderedDict()
+                self.bytes = 0
+                return
+            if pgpmime:
+                for key in [k for k in self.cache if k[1]]:
+                    self._drop(key)
+            if cache_id is not None:
+                self._drop((cache_id, False))
+                self._drop((cache_id, True))
+
+
+def ParsedMessageSize(message):
+    """
+    Estimate how much memory a parsed message is using.
+
+    >>> ParsedMessageSize(email.parser.Parser().parsestr('A: b\\n\\nHello'))
+    263
+    """
+    size = 0
+    for part in message.walk():
+        size += 256
+        for k, v in part._headers:
+            size += len(k) + (len(v) if isinstance(v, basestring) else 64)
+        payload = part.get_payload()
+        if isinstance(payload, basestring):
+            size += len(payload)
+    return size
+
+
+def ShareMessageTree(message):
+    """
+    Copy the structure of a parsed message, but not its contents.
+
+    The copy can be unwrapped or otherwise modified in place without
+    changing the original, as long as payloads are replaced rather than
+    edited. Payload strings are immutable, so this is much cheaper than
+    copy.deepcopy and the two trees share most of their memory.
+
+    >>> msg = email.parser.Parser().parsestr('A: b\\n\\nHello')
+    >>> clone = ShareMessageTree(msg)
+    >>> clone.set_payload('Bye'); clone.replace_header('A', 'c')
+    >>> (msg['A'], msg.get_payload()), (clone['A'], clone.get_payload())
+    (('b', 'Hello'), ('c', 'Bye'))
+    """
+    clone = copy.copy(message)
+    clone._headers = message._headers[:]
+    if message.is_multipart():
+        clone._payload = [ShareMessageTree(p) for p in message._payload]
+    return clone
+
+
+PARSE_CACHE_BYTES = 32 * 1024 * 1024
+GLOBAL_PARSE_CACHE = ParseCache(PARSE_CACHE_BYTES)
+
 
 def ClearParseCache(cache_id=None, pgpmime=False, full=False):
-    global GLOBAL_PARSE_CACHE
-    with GLOBAL_PARSE_CACHE_LOCK:
-        GPC = GLOBAL_PARSE_CACHE
-        for i in range(0, len(GPC)):
-            if (full or
-                    (pgpmime and GPC[i][1]) or
-                    (cache_id and GPC[i][0] == cache_id)):
-                GPC[i] = (None, None, None)
+    GLOBAL_PARSE_CACHE.clear(cache_id=cache_id, pgpmime=pgpmime, full=full)
 
 
 def ParseMessage(fd, cache_id=None, update_cache=False,
                      pgpmime=True, config=None):
-    global GLOBAL_PARSE_CACHE
     if not GnuPG:
         pgpmime = False
 
     if cache_id is not None and not update_cache:
-        with GLOBAL_PARSE_CACHE_LOCK:
-            for cid, pm, message in GLOBAL_PARSE_CACHE:
-                if cid == cache_id and pm == pgpmime:
-                    return message
+        message = GLOBAL_PARSE_CACHE.get(cache_id, pgpmime)
+        if message is not None:
+            return message
 
     if pgpmime:
         message = ParseMessage(fd, cache_id=cache_id,
@@ -116,7 +234,7 @@ def ParseMessage(fd, cache_id=None, update_cache=False,
         if cache_id is not None:
             # Caching is enabled, let's not clobber the encrypted version
             # of this message with a fancy decrypted one.
-            message = copy.deepcopy(message)
+            message = ShareMessageTree(message)
         def MakeGnuPG(*args, **kwargs):
             return GnuPG(config, *args, **kwargs)
         UnwrapMimeCrypto(message, protocols={
@@ -138,10 +256,7 @@ def ParseMessage(fd, cache_id=None, update_cache=False,
             part.encryption_info = EncryptionInfo(parent=mei)
 
     if cache_id is not None:
-        with GLOBAL_PARSE_CACHE_LOCK:
-            # Keep 25 items, put new ones at the front
-            GLOBAL_PARSE_CACHE[24:] = []
-            GLOBAL_PARSE_CACHE[:0] = [(cache_id, pgpmime, message)]
+        GLOBAL_PARSE_CACHE.put(cache_id, pgpmime, message)
 
     return message
 
@@ -774,11 +889,7 @@ class Email(object):
 
     def update_parse_cache(self, newmsg):
         if self.msg_idx_pos >= 0 and not self.ephemeral_mid:
-            with GLOBAL_PARSE_CACHE_LOCK:
-                GPC = GLOBAL_PARSE_CACHE
-                for i in range(0, len(GPC)):
-                    if GPC[i][0] == self.msg_idx_pos:
-                        GPC[i] = (self.msg_idx_pos, False, newmsg)
+            GLOBAL_PARSE_CACHE.update(self.msg_idx_pos, newmsg)
 
     def clear_from_parse_cache(self):
         if self.msg_idx_pos >= 0 and not self.ephemeral_mid:
@@ -887,7 +998,7 @@ class Email(object):
 
     def is_thread(self):
         return ((self.get_msg_info(self.index.MSG_THREAD_MID)) or
-                (0 < len(self.get_msg_info(self.index.MSG_REPLIES))))
+                (0 < len(self.index.THREADS.get_replies(self.msg_idx_pos))))
 
     def get(self, field, default=''):
         """Get one (or all) indexed fields for this mail."""
@@ -1115,11 +1226,8 @@ class Email(object):
             if conv_id:
                 conv = Email(self.index, int(conv_id, 36))
                 tree['conversation'] = convs = [conv.get_msg_summary()]
-                for rid in conv.get_msg_info(self.index.MSG_REPLIES
-                                             ).split(','):
-                    if rid:
-                        convs.append(Email(self.index, int(rid, 36)
-                                           ).get_msg_summary())
+                for rid in self.index.get_reply_idxs(int(conv_id, 36)):
+                    convs.append(Email(self.index, rid).get_msg_summary())
 
         if (want is None or 'headers' in want):
             tree['headers'] = {}
@@ -1778,6 +1886,34 @@ class AddressHeaderParser(list):
 if __name__ == "__main__":
     import doctest
     import sys
+
+    # Exercise the parse cache: LRU order, the size budget and sharing
+    # between the raw and unwrapped versions of a message.
+    pc = ParseCache(2000)
+    msgs = [email.parser.Parser().parsestr('A: %d\n\n%s' % (i, 'x' * 200))
+            for i in range(0, 6)]
+    for i, m in enumerate(msgs[:4]):
+        pc.put(i, False, m)
+    assert(pc.get(0, False) is msgs[0])
+    pc.put(4, False, msgs[4])
+    assert(pc.get(1, False) is None and pc.get(0, False) is msgs[0])
+    assert(pc.bytes <= pc.max_bytes and len(pc) == 4)
+    pc.put(5, True, msgs[5])
+    pc.clear(pgpmime=True)
+    assert(pc.get(5, True) is None and pc.get(4, False) is msgs[4])
+    assert(pc.stats()['hits'] == 3 and pc.stats()['evictions'] == 2)
+
+    GLOBAL_PARSE_CACHE.clear(full=True)
+    raw = 'To: a@b.c\nContent-Type: text/plain\n\nHello world\n'
+    parsed = ParseMessage(lambda: StringIO.StringIO(raw),
+                          cache_id=1, pgpmime=False)
+    unwrapped = ParseMessage(None, cache_id=1, pgpmime=True)
+    assert(ParseMessage(None, cache_id=1, pgpmime=False) is parsed)
+    if GnuPG:
+        assert(unwrapped is not parsed)
+        assert(unwrapped.get_payload() is parsed.get_payload())
+        assert(ParseMessage(None, cache_id=1, pgpmime=True) is unwrapped)
+
     results = doctest.testmod(optionflags=doctest.ELLIPSIS,
                               extraglobs={})
     print '%s' % (results, )
@@ -0,0 +1,614 @@
+import hashlib
+import mmap
+import os
+import struct
+from array import array
+from itertools import izip
+
+import mailpile.util
+from mailpile.crypto.streamer import InProcessBackend
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+from mailpile.util import *
+
+
+def _b36s(number):
+    """
+    Like b36(), but negative numbers round-trip through int(x, 36).
+
+    >>> _b36s(1295), _b36s(0), _b36s(-1)
+    ('ZZ', '0', '-1')
+    """
+    if number < 0:
+        return '-' + b36(-number)
+    return b36(number)
+
+
+class IndexCipher(object):
+    #
+    # The files in this module hold the same data as mailpile.idx, so if
+    # that is encrypted, so are they: with AES-256 in CBC mode, using the
+    # in-process backends from mailpile.crypto.streamer.
+    #
+    # CBC has the useful property that any block can be decrypted on its
+    # own, given the ciphertext block before it. So an encrypted file can
+    # still be memory mapped and read lazily, a few blocks at a time.
+    #
+    # Files start with a plain-text header holding a random salt (mixed
+    # into the key) and IV, followed by the ciphertext of whatever the
+    # unencrypted file would have contained, padded with zeros.
+    #
+    MAGIC = 'MPCRYPT\x01'
+    HEADER = '<8s16s16s'
+    HEADER_BYTES = struct.calcsize(HEADER)
+    CIPHER = 'aes-256-cbc'
+
+    @classmethod
+    def Available(cls):
+        return InProcessBackend(cls.CIPHER) is not None
+
+    @classmethod
+    def FromHeader(cls, key, data):
+        """Return a cipher for an encrypted file, or None if it is not."""
+        if data[:len(cls.MAGIC)] != cls.MAGIC or not key:
+            return None
+        magic, salt, iv = struct.unpack_from(cls.HEADER, data, 0)
+        return cls(key, salt=salt, iv=iv)
+
+    def __init__(self, key, salt=None, iv=None):
+        self.backend = InProcessBackend(self.CIPHER)
+        self.salt = salt or os.urandom(16)
+        self.iv = iv or os.urandom(16)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        self.key = hashlib.sha256(self.salt + key).digest()
+
+    def encrypt(self, data):
+        """Encrypt a string, returning it with the header prepended."""
+        data += '\0' * (-len(data) % 16)
+        aes = self.backend(self.CIPHER, self.key, self.iv, encrypt=True)
+        return (struct.pack(self.HEADER, self.MAGIC, self.salt, self.iv) +
+                aes.update(data) + aes.finalize())
+
+    def decrypt(self, data, start=0, end=None):
+        """
+        Decrypt bytes start to end of the plain text, from an encrypted
+        string or memory map (including the header).
+
+        >>> ic = IndexCipher('secret')
+        >>> data = ic.encrypt('0123456789abcdef' * 4)
+        >>> ic.decrypt(data, 30, 35), ic.decrypt(data, 60)
+        ('ef012', 'cdef')
+        >>> IndexCipher.FromHeader('secret', data).decrypt(data, 0, 4)
+        '0123'
+        """
+        hlen = self.HEADER_BYTES
+        size = len(data) - hlen
+        end = size if (end is None) else min(end, size)
+        if end <= start:
+            return ''
+        first = start - (start % 16)
+        last = min(size, end + (-end % 16))
+        if first:
+            iv = data[hlen + first - 16:hlen + first]
+        else:
+            iv = self.iv
+        aes = self.backend(self.CIPHER, self.key, iv, encrypt=False)
+        plain = aes.update(data[hlen + first:hlen + last]) + aes.finalize()
+        return plain[start - first:end - first]
+
+
+class _ColumnFile(object):
+    """A read-only, memory mapped view of a saved columnar index."""
+
+    def __init__(self, mm, count, columns, cipher=None):
+        self.mm = mm
+        self.count = count
+        self.columns = columns
+        self.cipher = cipher
+
+    def read(self, start, end):
+        if self.cipher is None:
+            return self.mm[start:end]
+        return self.cipher.decrypt(self.mm, start, end)
+
+    def fixed(self, col, pos):
+        offset, length = self.columns[col]
+        start = offset + 8 * pos
+        return struct.unpack('<q', self.read(start, start + 8))[0]
+
+    def var(self, col, pos):
+        offset, length = self.columns[col]
+        start = offset + 8 * pos
+        s, e = struct.unpack('<QQ', self.read(start, start + 16))
+        blob = offset + 8 * (length + 1)
+        return self.read(blob + s, blob + e)
+
+
+class ColumnarMetadataIndex(object):
+    #
+    # This is a drop-in replacement for the plain list of tab-separated
+    # lines that MailIndex.INDEX used to be.
+    #
+    # The bulk of the data lives in a memory mapped file, stored one column
+    # at a time: the date, size and thread ID are fixed-width 64-bit ints,
+    # everything else is a table of offsets into a blob of UTF-8 strings.
+    # Nothing is parsed until a row is requested, and then only that row.
+    #
+    # Rows which have changed since the file was written are kept in RAM,
+    # as plain lines, until the next time the columns are written out.
+    #
+    # The file records the size of mailpile.idx at the time it was written,
+    # along with an MD5 sum of the last few KB. If mailpile.idx still has
+    # the same prefix, anything appended since then can be replayed on top
+    # of the columns; otherwise the columns are stale and ignored.
+    #
+    # Given a key, the file is encrypted (see IndexCipher above).
+    #
+    MAGIC = 'MPCOLS\x00\x01'
+    HEADER = '<8sQQQ16s'
+    CHECKSUM_BYTES = 4096
+
+    FIXED = (3, 7, 12)  # MSG_DATE, MSG_KB, MSG_THREAD_MID
+    FIELDS = 13
+    VARIABLE = (0, 1, 2, 4, 5, 6, 8, 9, 10, 11)
+    RAW = FIELDS        # Rows which do not round-trip are stored whole
+    EMAILS = FIELDS + 1
+    COLUMNS = FIELDS + 2
+
+    @classmethod
+    def IndexChecksum(cls, fd, size):
+        """Checksum the last few KB before a given offset in a file."""
+        fd.seek(max(0, size - cls.CHECKSUM_BYTES))
+        return md5_hex(fd.read(min(size, cls.CHECKSUM_BYTES))).decode('hex')
+
+    @classmethod
+    def Open(cls, filename, index_fd=None, key=None):
+        """
+        Open a columnar index file, returning None if it is missing,
+        corrupt, (given a file descriptor for mailpile.idx) stale, or
+        not encrypted with the given key.
+        """
+        try:
+            with open(filename, 'rb') as fd:
+                mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError, mmap.error):
+            return None
+        try:
+            cipher = IndexCipher.FromHeader(key, mm)
+            if bool(cipher) != bool(key):
+                return None
+            base = _ColumnFile(mm, 0, [], cipher=cipher)
+            hlen = struct.calcsize(cls.HEADER)
+            dlen = hlen + 16 * cls.COLUMNS
+            header = base.read(0, dlen)
+            (magic, count, email_count, idx_size, idx_md5
+             ) = struct.unpack_from(cls.HEADER, header, 0)
+            if magic != cls.MAGIC:
+                return None
+            columns = []
+            for col in range(0, cls.COLUMNS):
+                columns.append(struct.unpack_from('<QQ', header,
+                                                  hlen + 16*col))
+            if index_fd is not None:
+                index_fd.seek(0, 2)
+                if ((index_fd.tell() < idx_size) or
+                        (cls.IndexChecksum(index_fd, idx_size) != idx_md5)):
+                    return None
+                index_fd.seek(0)
+        except (struct.error, IOError, OSError):
+            return None
+
+        cmi = cls()
+        cmi.idx_size = idx_size
+        cmi.idx_md5 = idx_md5
+        cmi._base = _ColumnFile(mm, count, columns, cipher=cipher)
+        cmi._email_count = email_count
+        return cmi
+
+    def __init__(self):
+        self.lock = SearchRLock()
+        self.idx_size = 0
+        self.idx_md5 = '\0' * 16
+        self._base = None
+        self._email_count = 0
+        self._overlay = {}
+        self._tail = []
+
+    def __len__(self):
+        return (self._base and self._base.count or 0) + len(self._tail)
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        for pos in range(0, len(self)):
+            yield self[pos]
+
+    def _pos(self, pos):
+        if pos < 0:
+            pos += len(self)
+        if pos < 0 or pos >= len(self):
+            raise IndexError('Index out of range: %s' % pos)
+        return pos
+
+    def __getitem__(self, pos):
+        """Return a row as a tab-separated UTF-8 line, like mailpile.idx."""
+        with self.lock:
+            pos = self._pos(pos)
+            base = self._base
+            bcount = base and base.count or 0
+            if pos >= bcount:
+                return self._tail[pos - bcount]
+            line = self._overlay.get(pos)
+        if line is not None:
+            return line
+        row = self._base_row(base, pos)
+        return row and '\t'.join(f.encode('utf-8') for f in row) or ''
+
+    def __setitem__(self, pos, line):
+        with self.lock:
+            pos = self._pos(pos)
+            bcount = self._base and self._base.count or 0
+            if pos >= bcount:
+                self._tail[pos - bcount] = line
+            else:
+                self._overlay[pos] = line
+
+    def append(self, line):
+        with self.lock:
+            self._tail.append(line)
+
+    def get_row(self, pos):
+        """
+        Return a row as a list of unicode fields, or None if empty.
+        The list is a fresh copy and may be freely modified.
+        """
+        with self.lock:
+            pos = self._pos(pos)
+            base = self._base
+            bcount = base and base.count or 0
+            if pos >= bcount:
+                line = self._tail[pos - bcount]
+            else:
+                line = self._overlay.get(pos)
+        if line is None:
+            return self._base_row(base, pos)
+        elif line:
+            return line.decode('utf-8').split(u'\t')
+        return None
+
+    def _base_row(self, base, pos):
+        raw = base.var(self.RAW, pos)
+        if raw:
+            return raw.decode('utf-8').split(u'\t')
+        row = [None] * self.FIELDS
+        for col in self.VARIABLE:
+            row[col] = base.var(col, pos).decode('utf-8')
+        if not row[0]:
+            return None
+        for col in self.FIXED:
+            row[col] = unicode(_b36s(base.fixed(col, pos)))
+        return row
+
+    def get_emails(self):
+        """Return the list of e-mail addresses saved with the columns."""
+        base = self._base
+        if not base:
+            return []
+        return [base.var(self.EMAILS, i).decode('utf-8')
+                for i in range(0, self._email_count)]
+
+    def snapshot(self):
+        with self.lock:
+            return (self._base, dict(self._overlay), list(self._tail))
+
+    def write(self, filename, emails, idx_size=0, idx_md5='\0' * 16,
+              key=None):
+        """
+        Write the current state out as a columnar file and switch to
+        reading from it. Rows modified while we were writing are kept
+        in RAM, everything else is released.
+        """
+        snapshot = self.snapshot()
+        base, overlay, tail = snapshot
+        bcount = base and base.count or 0
+        count = bcount + len(tail)
+
+        fixed = dict((col, []) for col in self.FIXED)
+        var = dict((col, []) for col in self.VARIABLE + (self.RAW, ))
+        for pos in xrange(0, count):
+            if pos >= bcount:
+                line = tail[pos - bcount]
+            else:
+                line = overlay.get(pos)
+            if line is None:
+                row = self._base_row(base, pos)
+            elif line:
+                row = line.decode('utf-8').split(u'\t')
+            else:
+                row = None
+
+            raw = ''
+            values = {}
+            if row is not None and len(row) != self.FIELDS:
+                raw = '\t'.join(row).encode('utf-8')
+            elif row is not None:
+                try:
+                    for col in self.FIXED:
+                        values[col] = int(row[col], 36)
+                        if _b36s(values[col]) != row[col]:
+                            raise ValueError()
+                except ValueError:
+                    raw = '\t'.join(row).encode('utf-8')
+
+            for col in self.FIXED:
+                fixed[col].append(values.get(col, 0))
+            for col in self.VARIABLE:
+                var[col].append((row and not raw) and
+                                row[col].encode('utf-8') or '')
+            var[self.RAW].append(raw)
+        var[self.EMAILS] = [e.encode('utf-8') for e in emails]
+
+        def var_column(values):
+            offsets, pos = [0], 0
+            for v in values:
+                pos += len(v)
+                offsets.append(pos)
+            return (struct.pack('<%dQ' % len(offsets), *offsets) +
+                    ''.join(values))
+
+        hlen = struct.calcsize(self.HEADER) + 16 * self.COLUMNS
+        data, directory, offset = [], [], hlen
+        for col in range(0, self.COLUMNS):
+            if col in fixed:
+                blob = struct.pack('<%dq' % count, *fixed[col])
+                length = count
+            else:
+                blob = var_column(var[col])
+                length = len(var[col])
+            directory.append(struct.pack('<QQ', offset, length))
+            data.append(blob)
+            offset += len(blob)
+
+        data[:0] = [struct.pack(self.HEADER, self.MAGIC, count, len(emails),
+                                idx_size, idx_md5)] + directory
+        if key:
+            data = [IndexCipher(key).encrypt(''.join(data))]
+
+        newfile = '%s.new' % filename
+        with open(newfile, 'wb') as fd:
+            for blob in data:
+                fd.write(blob)
+        try:
+            os.rename(newfile, filename)
+        except OSError:
+            # Windows will not let us replace a file which is mapped.
+            safe_remove(newfile)
+            return False
+
+        cmi = self.Open(filename, key=key)
+        if cmi is None:
+            return False
+        self.rebase(cmi._base, snapshot, email_count=len(emails))
+        self.idx_size = idx_size
+        self.idx_md5 = idx_md5
+        return True
+
+    def rebase(self, new_base, snapshot, email_count=0):
+        old_base, overlay, tail = snapshot
+        old_bcount = old_base and old_base.count or 0
+        with self.lock:
+            # Anything that changed after the snapshot stays in RAM
+            new_overlay = dict((p, l) for p, l in self._overlay.iteritems()
+                               if overlay.get(p) is not l)
+            new_tail = []
+            for i, line in enumerate(self._tail):
+                if i >= len(tail):
+                    new_tail.append(line)
+                elif tail[i] is not line:
+                    new_overlay[old_bcount + i] = line
+            self._base = new_base
+            self._overlay = new_overlay
+            self._tail = new_tail
+            self._email_count = email_count
+
+
+class IndexCheckpoint(object):
+    #
+    # A checkpoint of the structures MailIndex derives from its metadata
+    # (thread IDs, sort keys, tags and the various lookup tables), so
+    # startup does not have to rebuild them one message at a time.
+    #
+    # The checkpoint belongs to a particular generation of the columns:
+    # it records the row count and the mailpile.idx size and checksum the
+    # columns were written for, and is ignored unless those all match.
+    # Anything else which affects the derived data (the sort settings, for
+    # example) goes into the signature, which must also match.
+    #
+    # Each section is a flat blob: arrays are stored in their native
+    # machine format and dictionaries as a blob of newline separated keys
+    # plus an array of values, so everything loads with bulk reads.
+    #
+    # Like the columns, a checkpoint is encrypted if given a key: it is
+    # read in one go, so it is simply decrypted as a whole.
+    #
+    MAGIC = 'MPCKPT\x00\x01'
+    HEADER = '<8sQQQ16s16s'
+    SECTION = '<QQ'
+
+    @classmethod
+    def PackDict(cls, d, encoding=None):
+        """
+        Convert a dictionary of strings to ints into two blobs.
+
+        >>> k, v = IndexCheckpoint.PackDict({'a': 1, 'b': 2})
+        >>> sorted(IndexCheckpoint.UnpackDict(k, v).items())
+        [('a', 1), ('b', 2)]
+        """
+        keys, values = d.keys(), d.values()
+        blob = '\n'.join(keys)
+        if blob.count('\n') != max(0, len(keys) - 1):
+            raise ValueError('Keys must not contain newlines')
+        if encoding:
+            blob = blob.encode(encoding)
+        return blob, array('i', values).tostring()
+
+    @classmethod
+    def UnpackDict(cls, keys, values, encoding=None):
+        if encoding:
+            keys = keys.decode(encoding)
+        ints = array('i')
+        ints.fromstring(values)
+        if not ints:
+            return {}
+        return dict(izip(keys.split(encoding and u'\n' or '\n'), ints))
+
+    @classmethod
+    def Array(cls, typecode, blob):
+        a = array(typecode)
+        a.fromstring(blob)
+        return a
+
+    @classmethod
+    def Write(cls, filename, generation, signature, sections, key=None):
+        """
+        Write a checkpoint for a given generation of the columns, where
+        generation is a (row count, idx size, idx MD5) tuple, and sections
+        is a list of (name, blob) tuples.
+        """
+        count, idx_size, idx_md5 = generation
+        data = [struct.pack(cls.HEADER, cls.MAGIC, count, idx_size,
+                            len(sections), idx_md5, signature)]
+        for name, blob in sections:
+            name, blob = str(name), str(blob)
+            data.extend([struct.pack(cls.SECTION, len(name), len(blob)),
+                         name, blob])
+        data = ''.join(data)
+        if key:
+            data = IndexCipher(key).encrypt(data)
+        newfile = '%s.new' % filename
+        with open(newfile, 'wb') as fd:
+            fd.write(data)
+        try:
+            os.rename(newfile, filename)
+            return True
+        except OSError:
+            safe_remove(newfile)
+            return False
+
+    @classmethod
+    def Read(cls, filename, generation, signature, key=None):
+        """
+        Read a checkpoint, returning a dictionary of sections or None if
+        it is missing, corrupt, for a different generation or not
+        encrypted (or not) as expected.
+        """
+        try:
+            with open(filename, 'rb') as fd:
+                data = fd.read()
+            cipher = IndexCipher.FromHeader(key, data)
+            if bool(cipher) != bool(key):
+                return None
+            if cipher is not None:
+                data = cipher.decrypt(data)
+            hlen = struct.calcsize(cls.HEADER)
+            slen = struct.calcsize(cls.SECTION)
+            (magic, count, idx_size, nsections, idx_md5, sig
+             ) = struct.unpack_from(cls.HEADER, data, 0)
+            if ((magic != cls.MAGIC) or (sig != signature) or
+                    ((count, idx_size, idx_md5) != tuple(generation))):
+                return None
+            sections, pos = {}, hlen
+            for i in range(0, nsections):
+                nlen, blen = struct.unpack_from(cls.SECTION, data, pos)
+                pos += slen
+                name, pos = data[pos:pos + nlen], pos + nlen
+                sections[name], pos = data[pos:pos + blen], pos + blen
+            if pos > len(data) or data[pos:].strip('\0' if cipher else ''):
+                return None
+            return sections
+        except (IOError, OSError, struct.error):
+            return None
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    import tempfile
+
+    cmi = ColumnarMetadataIndex()
+    row = [u'0', u'ptr', u'id', u'ABC', u'G\xedsli', u'', u'', u'2',
+           u'Hello', u'snippet', u'1,2', u'', u'0']
+    line = u'\t'.join(row).encode('utf-8')
+    cmi.append(line)
+    cmi.append('')
+    bogus = line.replace('\tABC\t', '\tabc\t')
+    cmi.append(bogus)
+    assert(cmi.get_row(0) == row)
+    assert(cmi.get_row(1) is None)
+
+    tfd, tfn = tempfile.mkstemp()
+    os.close(tfd)
+    try:
+        assert(cmi.write(tfn, [u'a@b.c (A)'], idx_size=10))
+        assert(cmi._base.count == 3 and not cmi._tail)
+        assert(cmi.get_row(0) == row)
+        assert(cmi[0] == line)
+        assert(cmi.get_row(1) is None)
+        assert(cmi[2] == bogus)
+        assert(cmi.get_emails() == [u'a@b.c (A)'])
+
+        # Modifications go to RAM, appends to the tail
+        cmi[0] = line.replace('Hello', 'Goodbye')
+        cmi.append(line)
+        assert(cmi.get_row(0)[8] == u'Goodbye')
+        assert(len(cmi) == 4 and list(cmi)[3] == line)
+        assert(cmi.write(tfn, []))
+        assert(cmi.get_row(0)[8] == u'Goodbye')
+        assert(not cmi._overlay and not cmi._tail and len(cmi) == 4)
+
+        # Stale columns are ignored
+        with open(tfn + '.idx', 'wb') as fd:
+            fd.write('x' * 20)
+        with open(tfn + '.idx', 'rb') as fd:
+            assert(ColumnarMetadataIndex.Open(tfn, index_fd=fd) is None)
+            cmi.write(tfn, [], idx_size=20,
+                      idx_md5=ColumnarMetadataIndex.IndexChecksum(fd, 20))
+            assert(ColumnarMetadataIndex.Open(tfn, index_fd=fd) is not None)
+
+        # Encrypted columns need the right key, and read the same
+        if IndexCipher.Available():
+            cmi[1] = line.replace('Hello', u'Encrypted \xfe'.encode('utf-8'))
+            assert(cmi.write(tfn, [u'a@b.c (A)'], key='secret'))
+            with open(tfn, 'rb') as fd:
+                assert('Goodbye' not in fd.read())
+            for key in (None, 'wrong'):
+                assert(ColumnarMetadataIndex.Open(tfn, key=key) is None)
+            cmi2 = ColumnarMetadataIndex.Open(tfn, key='secret')
+            assert([cmi2.get_row(i) for i in range(0, 4)] ==
+                   [cmi.get_row(i) for i in range(0, 4)])
+            assert(cmi2.get_row(1)[8] == u'Encrypted \xfe')
+            assert(cmi2.get_emails() == [u'a@b.c (A)'])
+
+        # So are checkpoints
+        gen, sig = (4, 20, 'x' * 16), 'y' * 16
+        sections = [('thr', array('i', [0, 1, 1]).tostring()), ('x', '')]
+        for key in ('', 'secret'):
+            if key and not IndexCipher.Available():
+                continue
+            assert(IndexCheckpoint.Write(tfn, gen, sig, sections, key=key))
+            assert(IndexCheckpoint.Read(tfn, gen, sig, key=key) ==
+                   dict(sections))
+            for wrong in (key and ['', 'wrong'] or ['secret']):
+                assert(IndexCheckpoint.Read(tfn, gen, sig, key=wrong)
+                       is None)
+    finally:
+        safe_remove(tfn)
+        safe_remove(tfn + '.idx')
+
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
@@ -942,6 +942,8 @@ class Update(CompositionCommand):
 
             if outbox:
                 self._create_contacts(emails)
+                for email in emails:
+                    idx.address_seen(email.msg_idx_pos)
                 return self._return_search_results(message, emails,
                                                    sent=emails)
             else:
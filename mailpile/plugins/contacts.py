@@ -633,6 +633,12 @@ class AddressSearch(VCardCommand):
         existing = dict([(k['address'].lower(), k) for k in vcard_addresses])
         index = self._idx()
 
+        # Use the address index if it has been built, it knows how often
+        # and how recently we have exchanged mail with everyone.
+        ai = index.address_index()
+        if ai is not None:
+            return self._ranked_addresses(index, ai, terms, existing, count)
+
         # Figure out which tags are invisible so we can skip messages marked
         # with those tags.
         invisible = set([t._key for t in cfg.get_tags(flag_hides=True)])
@@ -697,6 +703,32 @@ class AddressSearch(VCardCommand):
 
         return addresses
 
+    def _ranked_addresses(self, index, ai, terms, existing, count):
+        with index._lock:
+            eids = ai.search(terms, count=count)
+            found = [(index.EMAILS[eid], ai.rank(eid)) for eid in eids]
+
+        # The best match gets 10 points, every factor of e less gets one
+        # point less; the boosts for matching names then reshuffle a bit.
+        addresses = []
+        best = found[0][1] if found else 0
+        for frm, score in found:
+            email, fn = ExtractEmailAndName(frm)
+            boost = max(0, 10 + int(score - best))
+            for term in terms:
+                boost += self._boost_rank(term, fn, email)
+
+            if not email or '@' not in email:
+                pass
+            elif email.lower() in existing:
+                existing[email.lower()]['rank'] += min(20, boost)
+            else:
+                info = AddressInfo(email, fn, rank=boost)
+                existing[email.lower()] = info
+                addresses.append(info)
+
+        return addresses
+
     def command(self):
         session, config = self.session, self.session.config
 
@@ -714,7 +746,7 @@ class AddressSearch(VCardCommand):
 
         self.session.ui.mark('Searching Metadata')
         index_addrs = self._index_addresses(config, terms, vcard_addrs,
-                                            count, deadline)
+                                            offset + count, deadline)
 
         self.session.ui.mark('Sorting')
         addresses = vcard_addrs + index_addrs
@@ -12,15 +12,16 @@ _plugins = PluginManager(builtin=__file__)
 ##[ Search terms ]############################################################
 
 def search(config, idx, term, hits):
-    group = config._vcards.get(term.split(':', 1)[1])
+    group = config.vcards.get_vcard(term.split(':', 1)[1])
     rt, emails = [], []
     if group and group.kind == 'group':
-        for email, attrs in group.get('EMAIL', []):
-            group = config._vcards.get(email.lower(), None)
-            if group:
-                emails.extend([e[0].lower() for e in group.get('EMAIL', [])])
+        for vcl in group.get_all('email'):
+            member = config.vcards.get_vcard(vcl.value)
+            if member:
+                emails.extend([e.value.lower()
+                               for e in member.get_all('email')])
             else:
-                emails.append(email.lower())
+                emails.append(vcl.value.lower())
     fromto = term.startswith('group:') and 'from' or 'to'
     for email in set(emails):
         rt.extend(hits('%s:%s' % (email, fromto)))
@@ -4,6 +4,7 @@ from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.mail_source.mbox import MboxMailSource
 from mailpile.mail_source.maildir import MaildirMailSource
+from mailpile.mailutils import Email
 from mailpile.plugins import PluginManager
 from mailpile.util import *
 from mailpile.vcard import *
@@ -232,13 +233,85 @@ def migrate_cleanup(session):
     return True
 
 
+REINDEX_BATCH = 250
+
+
+def migrate_tokenizer(session):
+    # If the index was built with a different tokenizer (or stemmer), the
+    # words in the posting lists won't match what searches look for, so
+    # everything gets reindexed in the background. Stale words left in
+    # the posting lists are harmless, nothing searches for them.
+    #
+    # The work is split into batches, each queued behind whatever else
+    # the scan worker has to do, so new mail gets a turn in between. How
+    # far we got is recorded in sys.index_reindexed (as "<signature>
+    # <position>"), so a restart picks up where we left off instead of
+    # starting over.
+    config = session.config
+    idx = config.get_index(session)
+    signature = idx.tokenizer().signature
+    if config.sys.index_tokenizer == signature:
+        return True
+    if len(idx.INDEX) == 0:
+        config.sys.index_tokenizer = signature
+        config.sys.index_reindexed = ''
+        return True
+
+    def progress():
+        try:
+            sig, pos = config.sys.index_reindexed.rsplit(' ', 1)
+            if sig == signature:
+                return int(pos)
+        except ValueError:
+            pass
+        return 0
+
+    def reindex_batch():
+        if mailpile.util.QUITTING or idx.tokenizer().signature != signature:
+            return
+        count = len(idx.INDEX)
+        start = progress()
+        end = min(count, start + REINDEX_BATCH)
+        session.ui.mark(_('Reindexing for new tokenizer: %d/%d'
+                          ) % (start, count))
+        for msg_idx_pos in range(start, end):
+            if mailpile.util.QUITTING:
+                end = msg_idx_pos
+                break
+            try:
+                idx.index_email(session, Email(idx, msg_idx_pos))
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                session.ui.warning(_('Failed to reindex: %s'
+                                     ) % b36(msg_idx_pos))
+        idx.save_changes(session)
+        if end >= count:
+            config.sys.index_tokenizer = signature
+            config.sys.index_reindexed = ''
+        else:
+            config.sys.index_reindexed = '%s %d' % (signature, end)
+        config.save()
+        if end < count and not mailpile.util.QUITTING:
+            schedule()
+
+    def schedule():
+        config.scan_worker.add_task(
+            session, 'Reindex for tokenizer', reindex_batch, unique=True)
+
+    schedule()
+    return True
+
+
 MIGRATIONS_BEFORE_SETUP = [migrate_routes]
-MIGRATIONS_AFTER_SETUP = [migrate_profiles, migrate_cleanup]
+MIGRATIONS_AFTER_SETUP = [migrate_profiles, migrate_cleanup,
+                          migrate_tokenizer]
 MIGRATIONS = {
     'routes': migrate_routes,
     'sources': migrate_mailboxes,
     'profiles': migrate_profiles,
-    'cleanup': migrate_cleanup
+    'cleanup': migrate_cleanup,
+    'tokenizer': migrate_tokenizer
 }
 
 
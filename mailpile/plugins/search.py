@@ -21,7 +21,7 @@ _plugins = PluginManager(builtin=__file__)
 
 class Search(Command):
     """Search your mail!"""
-    SYNOPSIS = ('s', 'search', 'search', '[@<start>] <terms>')
+    SYNOPSIS = ('s', 'search', 'search', '[--explain] [@<start>] <terms>')
     ORDER = ('Searching', 0)
     HTTP_CALLABLE = ('GET', )
     HTTP_QUERY_VARS = {
@@ -31,7 +31,8 @@ class Search(Command):
         'start': 'start position',
         'end': 'end position',
         'full': 'return all metadata',
-        'context': 'refine or redisplay an older search'
+        'context': 'refine or redisplay an older search',
+        'explain': 'explain how the search was performed'
     }
     IS_USER_ACTIVITY = True
     COMMAND_CACHE_TTL = 3600
@@ -87,6 +88,13 @@ class Search(Command):
         if self.context:
             args += self.session.searched
 
+        cmd_args = list(self.args)
+        if '--explain' in cmd_args or self.data.get('explain'):
+            cmd_args = [a for a in cmd_args if a != '--explain']
+            self._explain = []
+        else:
+            self._explain = None
+
         def nq(t):
             p = t[0] if (t and t[0] in '-+') else ''
             t = t[len(p):]
@@ -100,7 +108,7 @@ class Search(Command):
             return p+t
 
 
-        args += [a for a in list(nq(a) for a in self.args) if a not in args]
+        args += [a for a in list(nq(a) for a in cmd_args) if a not in args]
         for q in self.data.get('q', []):
             ext = [nq(a) for a in q.split()]
             args.extend([a for a in ext if a not in args])
@@ -162,17 +170,21 @@ class Search(Command):
                     elif prefix and '@' in arg:
                         session.searched.append(prefix + arg.lower())
                     else:
-                        words = re.findall(WORD_REGEXP, arg.lower())
+                        words = idx.tokenizer().words(arg, stem=False)
                         session.searched.extend([prefix + word
                                                  for word in words])
             if not session.searched:
                 session.searched = ['all:mail']
 
             context = session.results if self.context else None
-            session.results = list(idx.search(session, session.searched,
-                                              context=context).as_set())
-            if session.order:
-                idx.sort_results(session, session.results, session.order)
+            srs = idx.search(session, session.searched, context=context,
+                             explain=getattr(self, '_explain', None))
+            try:
+                session.results = srs.sorted_results(session.order)
+            except ValueError:
+                session.ui.warning(_('Unknown sort order: %s'
+                                     ) % session.order)
+                session.results = list(srs.as_ids())
 
         return session, idx
 
@@ -201,6 +213,8 @@ class Search(Command):
                                           start=self._start,
                                           num=self._num,
                                           full_threads=full_threads)
+        if self._explain is not None:
+            session.displayed['explain'] = self._explain
         session.ui.mark(_('Prepared %d search results (context=%s)'
                           ) % (len(session.results), self.context))
         return self._success(_('Found %d results in %.3fs'
@@ -1,14 +1,19 @@
 import os
 import sys
 import random
+import struct
 import threading
 import traceback
 import time
+import zlib
+from array import array
+from bisect import bisect_left
 
 import mailpile.util
-from mailpile.crypto.streamer import EncryptingStreamer
+from mailpile.crypto.streamer import EncryptingStreamer, DecryptingStreamer
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.search_sets import IdSet
 from mailpile.util import *
 
 
@@ -20,6 +25,9 @@ GLOBAL_OPTIMIZE_LOCK = PListLock()
 GLOBAL_GPL_LOCK = PListRLock()
 GLOBAL_GPL = None
 
+GLOBAL_SEGMENTS_LOCK = PListRLock()
+GLOBAL_SEGMENTS = None
+
 PLC_CACHE_LOCK = PListLock()
 PLC_CACHE = {}
 
@@ -32,6 +40,58 @@ TIMERS = {
 }
 
 
+def _encode_varints(out, numbers, delta=False):
+    """
+    Append numbers to a list of bytes as LEB128 varints, optionally
+    encoding each (sorted) number as the delta from the one before.
+
+    >>> out = []
+    >>> _encode_varints(out, [1, 300, 301], delta=True)
+    >>> ''.join(out).encode('hex')
+    '01ab0201'
+    """
+    last = 0
+    for n in numbers:
+        if delta:
+            n, last = n - last, n
+        while n > 0x7f:
+            out.append(chr(0x80 | (n & 0x7f)))
+            n >>= 7
+        out.append(chr(n))
+
+
+def _decode_varints(data, pos, count, delta=False):
+    """
+    Decode count varints from a bytearray, returning the new position
+    and a compact array of integers.
+
+    >>> _decode_varints(bytearray('\\x01\\xab\\x02\\x01'), 0, 3, delta=True)
+    (4, array('i', [1, 300, 301]))
+    """
+    out = array('i')
+    last = 0
+    for i in xrange(0, count):
+        value = shift = 0
+        b = data[pos]
+        while b & 0x80:
+            value |= (b & 0x7f) << shift
+            shift += 7
+            pos += 1
+            b = data[pos]
+        value |= b << shift
+        pos += 1
+        if delta:
+            last = value = last + value
+        out.append(value)
+    return pos, out
+
+
+def _doc_ids(values):
+    """Message IDs may be given to us as ints or base-36 strings."""
+    return [(int(v, 36) if isinstance(v, (str, unicode)) else int(v))
+            for v in values]
+
+
 def PLC_CACHE_FlushAndClean(session, min_changes=0, keep=5, runtime=None):
     def save(plc):
         job_name = _('Save PLC %s') % plc.sig
@@ -76,6 +136,16 @@ class PostingListContainer(object):
     MAX_ITEMS = int((60 * 1024) / 5)  # Target size of about 60KB
     MAX_HASH_LEN = 24
 
+    # The on-disk format is binary and versioned: the magic, a version
+    # byte and a flags byte, followed by (optionally zlib compressed)
+    # records of: varint sig length, sig, varint count, delta-encoded
+    # varint message IDs. Older containers are tab-separated text.
+    BINARY_MAGIC = '\x00MPPL'
+    BINARY_VERSION = 2
+    FLAG_ZLIB = 0x01
+    COMPRESS_MIN = 512
+    MIGRATION_MARKER = 'plc-format.dat'
+
     @classmethod
     def Load(cls, session, sig, uncached_cb=None):
         fn, sig = cls._GetFilenameAndSig(session.config, sig)
@@ -97,7 +167,8 @@ class PostingListContainer(object):
         self.lock = PListRLock()
         self.sig = sig
         self.fd = fd
-        self.words = {sig: set()}
+        self.words = {sig: array('i')}
+        self.legacy = False
 
         self.changes = 0
         self._load()
@@ -115,8 +186,11 @@ class PostingListContainer(object):
             return self._unlocked_remove(*args, **kwargs)
 
     def _deleted_set(self):
-        # FIXME!
-        return set()
+        segments = GLOBAL_SEGMENTS
+        return segments.tombstones if segments else None
+
+    def _outfile(self):
+        return self._SaveFile(self.config, self.sig)
 
     def save(self, split=True):
         if not self.changes:
@@ -130,14 +204,10 @@ class PostingListContainer(object):
 
         t = [time.time()]
         encryption_key = self.config.master_key
-        outfile = self._SaveFile(self.config, self.sig)
+        outfile = self._outfile()
         with self.lock:
             # Optimizing for fast loads, so deletion only happens on save.
-            del_set = self._deleted_set()
-            output = '\n'.join('\t'.join(l) for l
-                               in ([sig] + [str(v) for v in (values-del_set)]
-                                   for sig, values in self.words.iteritems())
-                               if len(l) > 1)
+            output = self._render(self._deleted_set())
             t.append(time.time())
 
             if not output:
@@ -160,6 +230,7 @@ class PostingListContainer(object):
 
             t.append(time.time())
             self.changes = 0
+            self.legacy = False
 
         if len(t) == 3:
             TIMERS['render'] += t[1] - t[0]
@@ -203,6 +274,52 @@ class PostingListContainer(object):
 
         return splits
 
+    def _render(self, del_set):
+        records = []
+        for sig, values in sorted(self.words.iteritems()):
+            if del_set:
+                values = [v for v in values if v not in del_set]
+            if values:
+                # Signatures of unicode words are unicode, but always ASCII;
+                # mixing them with the varint bytes would fail to join.
+                sig = str(sig)
+                _encode_varints(records, [len(sig)])
+                records.append(sig)
+                _encode_varints(records, [len(values)])
+                _encode_varints(records, values, delta=True)
+        if not records:
+            return ''
+
+        flags, body = 0, ''.join(records)
+        if len(body) > self.COMPRESS_MIN:
+            compressed = zlib.compress(body)
+            if len(compressed) < len(body):
+                flags, body = self.FLAG_ZLIB, compressed
+        return (self.BINARY_MAGIC +
+                struct.pack('<BB', self.BINARY_VERSION, flags) +
+                body)
+
+    def _unlocked_parse_binary(self, data):
+        hlen = len(self.BINARY_MAGIC) + 2
+        version, flags = struct.unpack('<BB', data[hlen-2:hlen])
+        if version != self.BINARY_VERSION:
+            raise ValueError('Unknown posting list version: %s' % version)
+        body = data[hlen:]
+        if flags & self.FLAG_ZLIB:
+            body = zlib.decompress(body)
+        body = bytearray(body)
+
+        pos = 0
+        while pos < len(body):
+            pos, (slen, ) = _decode_varints(body, pos, 1)
+            sig, pos = str(body[pos:pos+slen]), pos + slen
+            pos, (count, ) = _decode_varints(body, pos, 1)
+            pos, values = _decode_varints(body, pos, count, delta=True)
+            if sig in self.words and self.words[sig]:
+                self._unlocked_add(sig, values)
+            else:
+                self.words[sig] = values
+
     def _load(self):
         t0 = time.time()
         if not self.fd:
@@ -213,11 +330,31 @@ class PostingListContainer(object):
                 return
         with self.lock, self.fd:
             try:
-                decrypt_and_parse_lines(self.fd,
-                                        self._unlocked_parse_lines,
-                                        self.config)
+                data = self.fd.read(64)
+                if data.startswith(self.BINARY_MAGIC):
+                    self._unlocked_parse_binary(data + self.fd.read())
+                elif data.startswith(DecryptingStreamer.BEGIN_MED2):
+                    self.fd.seek(0)
+                    with DecryptingStreamer(self.fd,
+                                            mep_key=self.config.master_key,
+                                            name='PLC/%s' % self.sig
+                                            ) as streamer:
+                        data = streamer.read()
+                        streamer.verify(_raise=IOError)
+                    if data.startswith(self.BINARY_MAGIC):
+                        self._unlocked_parse_binary(data)
+                    else:
+                        self.legacy = True
+                        self._unlocked_parse_lines(data.splitlines())
+                else:
+                    # Legacy text format, this gets upgraded on save.
+                    self.legacy = bool(data)
+                    self.fd.seek(0)
+                    decrypt_and_parse_lines(self.fd,
+                                            self._unlocked_parse_lines,
+                                            self.config)
                 self.changes = 0
-            except (ValueError, IOError):
+            except (ValueError, IOError, zlib.error, IndexError):
                 self.session.ui.warning('load(%s) %s'
                                         % (self.sig, sys.exc_info()))
                 if self.config.sys.debug:
@@ -230,24 +367,116 @@ class PostingListContainer(object):
         for line in lines:
             words = line.strip().split('\t')
             if len(words) > 1:
-                self._unlocked_add(words[0], words[1:])
+                self._unlocked_add(str(words[0]), words[1:])
 
     def _unlocked_add(self, sig, values):
-        wset = set(values)
-        self.changes += len(wset)
-        if sig in self.words:
-            self.words[sig] |= wset
+        # Posting lists are kept as sorted arrays of ints; small updates
+        # are inserted in place, large ones merged.
+        values = _doc_ids(values)
+        self.changes += len(values)
+        current = self.words.get(sig)
+        if not current:
+            self.words[sig] = array('i', sorted(set(values)))
+        elif len(values) < 16:
+            for v in values:
+                i = bisect_left(current, v)
+                if i == len(current) or current[i] != v:
+                    current.insert(i, v)
         else:
-            self.words[sig] = wset
+            self.words[sig] = array('i', sorted(set(current) | set(values)))
 
     def _unlocked_remove(self, sig, values):
-        wset = set(values)
-        self.changes += len(wset)
-        if sig in self.words:
-            self.words[sig] -= wset
-            if not self.words[sig]:
+        values = _doc_ids(values)
+        self.changes += len(values)
+        current = self.words.get(sig)
+        if current:
+            for v in values:
+                i = bisect_left(current, v)
+                if i < len(current) and current[i] == v:
+                    del current[i]
+            if not current:
                 del self.words[sig]
 
+    @classmethod
+    def MigrateAll(cls, session, runtime=None):
+        """
+        Rewrite any posting list containers still in the old text format,
+        a directory at a time. Progress is recorded in a marker file, so
+        this can be run as a background job until it is done.
+        """
+        config = session.config
+        marker = os.path.join(config.workdir, cls.MIGRATION_MARKER)
+        try:
+            with open(marker, 'r') as fd:
+                done = set(fd.read().split())
+        except (IOError, OSError):
+            done = set()
+        if 'done' in done:
+            return True
+
+        startt = time.time()
+        basedir = os.path.dirname(config.postinglist_dir(''))
+        for subdir in sorted(os.listdir(basedir)):
+            if subdir in done:
+                continue
+            for sig in sorted(os.listdir(os.path.join(basedir, subdir))):
+                if mailpile.util.QUITTING:
+                    return False
+                if cls._Migrate(session, sig):
+                    play_nice_with_threads()
+            done.add(subdir)
+            with open(marker, 'w') as fd:
+                fd.write('\n'.join(sorted(done)))
+            if runtime and startt + runtime < time.time():
+                return False
+
+        with open(marker, 'w') as fd:
+            fd.write('done\n')
+        session.ui.mark(_('Upgraded search index to the binary format'))
+        return True
+
+    @classmethod
+    def _Migrate(cls, session, sig):
+        # Containers in the cache are in use, so those are upgraded in
+        # place. Others are loaded and saved without going through the
+        # cache, which would evict the ones people are actually using;
+        # we hold the cache lock meanwhile, so nobody else loads them.
+        with PLC_CACHE_LOCK:
+            cached = PLC_CACHE.get(sig)
+            if cached is None:
+                return cls(session, sig)._upgrade()
+        with cached[1].lock:
+            return cached[1]._upgrade()
+
+    @classmethod
+    def _Purge(cls, session, sig, dead):
+        # As with _Migrate, cached containers are purged in place.
+        with PLC_CACHE_LOCK:
+            cached = PLC_CACHE.get(sig)
+            if cached is None:
+                return cls(session, sig)._purge(dead)
+        with cached[1].lock:
+            return cached[1]._purge(dead)
+
+    def _purge(self, dead):
+        purged = False
+        for sig, values in self.words.items():
+            if any(v in dead for v in values):
+                self.words[sig] = array('i', (v for v in values
+                                              if v not in dead))
+                purged = True
+        if purged:
+            self.changes += 1
+            self.save(split=False)
+        return purged
+
+    def _upgrade(self):
+        if self.legacy:
+            self.changes += 1
+            self.save(split=False)
+            return True
+        return False
+
     @classmethod
     def _SaveFile(cls, config, sig):
         return os.path.join(config.postinglist_dir(sig), sig)
@@ -273,6 +502,276 @@ class PostingListContainer(object):
         return (None, None)
 
 
+class PostingListSegment(PostingListContainer):
+    """An immutable, sorted run of posting lists; see PostingListSegments."""
+
+    def __init__(self, session, path, words=None):
+        self.path = path
+        name = os.path.basename(path)
+        fd = open(path, 'rb') if (words is None) else None
+        PostingListContainer.__init__(self, session, name, fd=fd)
+        del self.words[name]
+        if words is not None:
+            self.words = words
+            self.changes = 1
+
+    def _load(self):
+        if self.fd:
+            PostingListContainer._load(self)
+
+    def _outfile(self):
+        return self.path
+
+
+class PostingListSegments(object):
+    #
+    # The global posting list is a small log-structured merge tree:
+    #
+    #   - New keywords go to the journal (kw-journal.dat) and GLOBAL_GPL.
+    #   - When that grows, it is frozen into an immutable level 0 segment,
+    #     a sorted PostingListSegment file in kw-segments/.
+    #   - Once a level has `gpl_fanout` segments, they are merged into one
+    #     segment on the level below. Segments on the last of `gpl_levels`
+    #     levels get merged into the PostingListContainers instead.
+    #
+    # So each keyword is written about gpl_levels+1 times, and a search
+    # reads at most gpl_fanout segments per level on top of one PLC.
+    #
+    # Deleted messages are recorded as tombstones, which filter search
+    # results and are purged from segments and PLCs as they get written.
+    # The tombstone file is a log which deletions append to. A forced
+    # optimization merges everything into the PLCs, then compact() purges
+    # the tombstoned IDs from every PLC, after which they can be dropped.
+    #
+    # Merges are crash-safe: outputs are renamed into place before inputs
+    # are deleted, and adding the same keywords twice is harmless.
+    #
+    DIRNAME = 'kw-segments'
+    TOMBSTONES = 'kw-tombstones.dat'
+    FREEZE_MIN = 10240
+
+    @classmethod
+    def Get(cls, session):
+        global GLOBAL_SEGMENTS
+        with GLOBAL_SEGMENTS_LOCK:
+            path = os.path.join(session.config.workdir, cls.DIRNAME)
+            if GLOBAL_SEGMENTS is None or GLOBAL_SEGMENTS.path != path:
+                GLOBAL_SEGMENTS = cls(session, path)
+            return GLOBAL_SEGMENTS
+
+    def __init__(self, session, path):
+        self.session = session
+        self.config = session.config
+        self.path = path
+        self.lock = PListRLock()
+        self.levels = {}
+        self.seq = 0
+        self.tombstones = IdSet()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, self.TOMBSTONES), 'rb') as fd:
+                ids, data = array('i'), fd.read()
+                # A crash mid-append may have left a partial ID behind
+                ids.fromstring(data[:len(data) - len(data) % ids.itemsize])
+                self.tombstones = IdSet(ids)
+        except (IOError, OSError):
+            pass
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            os.mkdir(self.path)
+            names = []
+        segments = []
+        for fn in names:
+            if fn.endswith('.tmp'):
+                # Left behind by a crash; the inputs are all still here.
+                safe_remove(os.path.join(self.path, fn))
+                continue
+            try:
+                level, seq = fn[:-len('.seg')].split('-')
+                if fn.endswith('.seg'):
+                    segments.append((int(seq, 36), int(level), fn))
+            except ValueError:
+                pass
+        for seq, level, fn in sorted(segments):
+            try:
+                seg = PostingListSegment(self.session,
+                                         os.path.join(self.path, fn))
+                self.levels.setdefault(level, []).append(seg)
+                self.seq = max(self.seq, seq)
+            except (IOError, OSError):
+                self.session.ui.warning('load(%s) %s' % (fn, sys.exc_info()))
+
+    def __len__(self):
+        return sum(len(segs) for segs in self.levels.values())
+
+    def count(self, sig):
+        """Count the hits in all segments, not allowing for overlaps."""
+        with self.lock:
+            segments = [s for segs in self.levels.values() for s in segs]
+        return sum(len(seg.words.get(sig, [])) for seg in segments)
+
+    def hits(self, sig):
+        with self.lock:
+            segments = [s for segs in self.levels.values() for s in segs]
+        hits = set()
+        for seg in segments:
+            hits |= set(seg.words.get(sig, []))
+        return hits
+
+    def delete(self, mail_ids):
+        """Record tombstones for deleted messages."""
+        with self.lock:
+            new = IdSet(_doc_ids(mail_ids)) - self.tombstones
+            if not new:
+                return
+            with open(os.path.join(self.path, self.TOMBSTONES), 'ab') as fd:
+                fd.write(new.tostring())
+            self.tombstones = self.tombstones | new
+
+    def _write_tombstones(self):
+        with self.lock:
+            fn = os.path.join(self.path, self.TOMBSTONES)
+            if self.tombstones:
+                with open(fn + '.tmp', 'wb') as fd:
+                    fd.write(self.tombstones.tostring())
+                os.rename(fn + '.tmp', fn)
+            else:
+                safe_remove(fn)
+
+    def _purged(self, words):
+        # Drop tombstoned IDs from a dict of sorted posting lists
+        dead = self.tombstones
+        if not dead:
+            return words
+        purged = {}
+        for sig, values in words.iteritems():
+            values = array('i', (v for v in values if v not in dead))
+            if values:
+                purged[sig] = values
+        return purged
+
+    def _write_segment(self, level, words):
+        with self.lock:
+            self.seq += 1
+            fn = os.path.join(self.path, '%d-%s.seg' % (level, b36(self.seq)))
+        seg = PostingListSegment(self.session, fn + '.tmp', words)
+        seg.save(split=False)
+        seg.path = fn
+        if os.path.exists(fn + '.tmp'):
+            os.rename(fn + '.tmp', fn)
+        return seg
+
+    def _replace(self, level, old, new_level=None, new=None):
+        with self.lock:
+            self.levels[level] = [s for s in self.levels.get(level, [])
+                                  if s not in old]
+            if new is not None and new.words:
+                self.levels.setdefault(new_level, []).append(new)
+        for seg in old:
+            safe_remove(seg.path)
+
+    def freeze(self, words):
+        """Write out the in-memory GPL as a level 0 segment."""
+        words = self._purged(dict(
+            (sig, array('i', sorted(set(_doc_ids(values)))))
+            for sig, values in words.iteritems() if values))
+        if words:
+            self._replace(0, [], 0, self._write_segment(0, words))
+        return len(words)
+
+    def _merged(self, segments):
+        words = {}
+        for seg in segments:
+            for sig, values in seg.words.iteritems():
+                if sig in words:
+                    words[sig] = array('i', sorted(set(words[sig]) |
+                                                   set(values)))
+                else:
+                    words[sig] = values
+        return self._purged(words)
+
+    def merge(self, force=False, runtime=None):
+        """
+        Merge any levels which are full (or all levels, if forced) until
+        done or we run out of time. Returns the number of segments merged.
+        """
+        fanout = max(2, self.config.sys.gpl_fanout)
+        levels = max(1, self.config.sys.gpl_levels)
+        deadline = runtime and (time.time() + runtime)
+        merged = 0
+        for level in range(0, levels):
+            with self.lock:
+                segments = list(self.levels.get(level, []))
+            if not segments or (len(segments) < fanout and not force):
+                continue
+            if mailpile.util.QUITTING:
+                break
+            if level + 1 < levels:
+                if len(segments) > 1 or force:
+                    self.session.ui.mark(_('Merging %d search index segments'
+                                           ) % len(segments))
+                    new = self._write_segment(level + 1,
+                                              self._merged(segments))
+                    self._replace(level, segments, level + 1, new)
+                    merged += len(segments)
+            else:
+                merged += self._merge_into_plcs(level, segments, deadline)
+            play_nice_with_threads()
+            if deadline and deadline < time.time():
+                break
+        return merged
+
+    def _merge_into_plcs(self, level, segments, deadline):
+        words = self._merged(segments)
+        sigs = sorted(words.keys())
+        count = 0
+        for sig in sigs:
+            if (count % 97) == 0:
+                PLC_CACHE_FlushAndClean(self.session, min_changes=100000)
+                self.session.ui.mark(_('Updating search index... %d%%'
+                                       ) % (count * 100 / len(sigs)))
+            PostingList.Append(self.session, sig, words.pop(sig), sig=sig)
+            count += 1
+            if mailpile.util.QUITTING:
+                break
+            if deadline and deadline < time.time():
+                break
+        PLC_CACHE_FlushAndClean(self.session)
+
+        # Whatever we did not get to stays behind as a smaller segment.
+        remains = words and self._write_segment(level, words) or None
+        self._replace(level, segments, level, remains)
+        return len(segments)
+
+    def compact(self):
+        """
+        Purge tombstoned IDs from every PLC and then forget them, so the
+        tombstones don't grow forever. This only works once everything
+        has been merged into the PLCs. Returns the number dropped.
+        """
+        with GLOBAL_GPL_LOCK, self.lock:
+            if len(self) or GLOBAL_GPL or not self.tombstones:
+                return 0
+            dead = self.tombstones
+        basedir = os.path.dirname(self.config.postinglist_dir(''))
+        for subdir in sorted(os.listdir(basedir)):
+            for sig in sorted(os.listdir(os.path.join(basedir, subdir))):
+                if mailpile.util.QUITTING:
+                    return 0
+                if PostingListContainer._Purge(self.session, sig, dead):
+                    play_nice_with_threads()
+        with self.lock:
+            # Anything deleted meanwhile stays.
+            self.tombstones = self.tombstones - dead
+            self._write_tombstones()
+        self.session.ui.mark(_('Dropped %d search index tombstones'
+                               ) % len(dead))
+        return len(dead)
+
+
 class NewPostingList(object):
     """A posting list is a map of search terms to message IDs."""
 
@@ -297,7 +796,7 @@ class NewPostingList(object):
             self.plc = PostingListContainer.Load(self.session, self.sig)
 
     def hits(self):
-        return self.plc.get(self.sig) or set()
+        return self.plc.get(self.sig) or array('i')
 
     def append(self, *eids):
         self.plc.add(self.sig, eids)
@@ -578,47 +1077,35 @@ class GlobalPostingList(OldPostingList):
 
     @classmethod
     def _Optimize(cls, session, idx,
-                  force=False, lazy=False, quick=False, ratio=1.0, runtime=0):
-        starttime = time.time()
-        count = 0
-        global GLOBAL_GPL
-        if (GLOBAL_GPL and (not lazy or len(GLOBAL_GPL) > 10240)):
-            # Processing keys in order is more efficient, as it lets things
-            # accumulate in the PLC_CACHE.
-            keys = sorted(GLOBAL_GPL.keys())
-            if ratio:
-                keyn = int(len(keys) * ratio)
-                start = random.randint(0, len(keys))
-                # This lets the selection wrap around to the beginning,
-                # so we don't have a bias against writing out the first
-                # keys compared with the others.
-                keys += keys
-                keys = keys[start:start+keyn]
-
-            pls = GlobalPostingList(session, '')
-            for sig in keys:
-                if (count % 7) == 0:
-                    PLC_CACHE_FlushAndClean(session, min_changes=100000)
-                if (count % 97) == 0:
-                    session.ui.mark(('Updating search index... %d%% (%s)'
-                                     ) % (count * 100 / len(keys), sig))
-
-                # If we're doing a full optimize later, we disable the
-                # compaction here. Otherwise it follows the normal
-                # rules (compacts as necessary).
-                pls._migrate(sig, compact=quick)
-                count += 1
-                if mailpile.util.QUITTING:
-                    break
-                if runtime and starttime + (0.80 * runtime) < time.time():
-                    break
-            PLC_CACHE_FlushAndClean(session)
-            pls.save()
+                  force=False, lazy=False, quick=False, runtime=0):
+        """
+        Freeze the journal into a new segment if it is big enough (or
+        always, unless lazy), then run any merges which are due. A quick
+        optimization does not merge, a forced one merges everything into
+        the PostingListContainers.
+        """
+        segments = PostingListSegments.Get(session)
+        with GLOBAL_POSTING_LOCK, GLOBAL_GPL_LOCK:
+            # Appends take the posting lock, so nothing sneaks into the
+            # journal between writing the segment and truncating it.
+            if (GLOBAL_GPL and
+                    (not lazy or len(GLOBAL_GPL) > segments.FREEZE_MIN)):
+                session.ui.mark(_('Freezing %d keywords') % len(GLOBAL_GPL))
+                segments.freeze(GLOBAL_GPL)
+                open(cls.SaveFile(session, 'ALL'), 'wb').close()
+                GLOBAL_GPL.clear()
 
         if quick or mailpile.util.QUITTING:
-            return count
-        else:
-            return OldPostingList._Optimize(session, idx, force=force)
+            return 0
+        merged = segments.merge(force=force, runtime=runtime)
+        if force:
+            segments.compact()
+        return merged
+
+    @classmethod
+    def Delete(cls, session, mail_ids):
+        """Forget all keywords for a set of (deleted) messages."""
+        PostingListSegments.Get(session).delete(mail_ids)
 
     @classmethod
     def SaveFile(cls, session, prefix):
@@ -646,6 +1133,37 @@ class GlobalPostingList(OldPostingList):
             for mail_id in mail_ids:
                 GLOBAL_GPL[sig].add(mail_id)
 
+    @classmethod
+    def _AppendMany(cls, session, words):
+        """
+        Append a whole batch of keywords (a dict of signatures to lists of
+        message IDs) to the journal in a single, synced write, and then
+        to the in-memory GPL. A crash can lose the batch, but not corrupt
+        what was written before it.
+        """
+        sigs = sorted(words.keys())
+        data = ''.join('%s\t%s\n' % (sig, '\t'.join(words[sig]))
+                       for sig in sigs)
+        if not data:
+            return 0
+        with open(cls.SaveFile(session, 'ALL'), 'ab') as fd:
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd.fileno())
+        with GLOBAL_GPL_LOCK:
+            global GLOBAL_GPL
+            if GLOBAL_GPL is None:
+                GLOBAL_GPL = {}
+            for sig in sigs:
+                if sig not in GLOBAL_GPL:
+                    GLOBAL_GPL[sig] = set()
+                GLOBAL_GPL[sig] |= set(words[sig])
+        return len(sigs)
+
+    @classmethod
+    def AppendMany(cls, *args, **kwargs):
+        return cls.Lock(GLOBAL_POSTING_LOCK, cls._AppendMany, *args, **kwargs)
+
     def __init__(self, *args, **kwargs):
         with GLOBAL_GPL_LOCK:
             OldPostingList.__init__(self, *args, **kwargs)
@@ -667,24 +1185,93 @@ class GlobalPostingList(OldPostingList):
                 OldPostingList.load(self)
                 GLOBAL_GPL = self.WORDS
 
-    def _migrate(self, sig=None, compact=True):
-        with self.lock:
-            sig = sig or self.sig
-            if sig in self.WORDS and len(self.WORDS[sig]) > 0:
-                PostingList.Append(self.session, sig, self.WORDS[sig],
-                                   sig=sig, compact=compact)
-                del self.WORDS[sig]
-
     def remove(self, eids):
         PostingList(self.session, self.word).remove(eids).save()
         return OldPostingList.remove(self, eids)
 
+    def estimate(self):
+        """
+        Return an upper bound on the number of hits; this is much cheaper
+        than hits(), as no sets get built.
+        """
+        segments = PostingListSegments.Get(self.session)
+        return (len(PostingList(self.session, self.word).hits()) +
+                len(self.WORDS.get(self.sig, [])) +
+                segments.count(self.sig))
+
     def hits(self):
-        return (self.WORDS.get(self.sig, set())
-                | PostingList(self.session, self.word).hits())
+        segments = PostingListSegments.Get(self.session)
+        hits = set(PostingList(self.session, self.word).hits())
+        hits |= set(_doc_ids(self.WORDS.get(self.sig, [])))
+        hits |= segments.hits(self.sig)
+        if segments.tombstones:
+            hits -= segments.tombstones
+        return hits
+
+
+class KeywordBatch(object):
+    """
+    Collects keywords for many messages in RAM, so a bulk import can add
+    them to the global posting list a batch at a time, instead of taking
+    the global lock and appending to the journal once per word.
+
+    Keywords are not searchable until the batch is flushed. Flushing
+    happens automatically once the batch grows past max_kb (by a rough
+    estimate of its size in RAM).
+    """
+    ENTRY_BYTES = 64  # Rough per-signature overhead of the dict and list
+
+    def __init__(self, session, max_kb=None):
+        self.session = session
+        self.lock = PListRLock()
+        self.max_bytes = 1024 * (max_kb or
+                                 session.config.sys.keyword_buffer_kb)
+        self.words = {}
+        self.size = 0
+
+    def __len__(self):
+        return len(self.words)
+
+    def add(self, words, mail_id):
+        config = self.session.config
+        with self.lock:
+            for word in words:
+                try:
+                    sig = GlobalPostingList.WordSig(word, config)
+                except UnicodeDecodeError:
+                    # FIXME: we just ignore garbage
+                    continue
+                if sig in self.words:
+                    self.words[sig].append(mail_id)
+                else:
+                    self.words[sig] = [mail_id]
+                    self.size += len(sig) + self.ENTRY_BYTES
+                self.size += len(mail_id) + 8
+            full = (self.size > self.max_bytes)
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write out everything collected so far."""
+        with self.lock:
+            words, self.words, self.size = self.words, {}, 0
+            if not words:
+                return 0
+            # Holding our lock means batches are written in order.
+            return GlobalPostingList.AppendMany(self.session, words)
 
 
 if NEW_POSTING_LIST:
     PostingList = NewPostingList
 else:
     PostingList = OldPostingList
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,297 @@
+import sys
+import time
+
+import mailpile.util
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+from mailpile.util import *
+
+
+##[ Query planner ]###########################################################
+#
+# MailIndex.search() turns its search terms into a tree of plan nodes:
+#
+#   - terms are applied left to right,
+#   - a term starting with + is OR-ed with everything before it,
+#   - other terms are AND-ed (or with a -, AND-NOT-ed) with everything
+#     before them, back to the last +.
+#
+# Within an AND node the order of evaluation does not matter, so we go
+# cheapest first: by cost class, then by estimated number of results.
+# Estimates come from posting list and tag set sizes, and are upper
+# bounds. Terms implemented by plugins (dates, sizes, groups...) can't be
+# estimated and may look up dozens of keywords each, so they go last. As
+# soon as an intersection is empty, the remaining terms are skipped and
+# their posting lists never even get loaded.
+#
+# Evaluation needs two functions: hits(keyword), which returns the set of
+# messages with a keyword, and estimate(keyword), which cheaply returns an
+# upper bound on its size.
+#
+# Each node records what it estimated, what it found and how long that
+# took, for `search --explain`.
+#
+COST_CHEAP = 0
+COST_NORMAL = 1
+COST_EXPENSIVE = 2
+
+UNKNOWN = sys.maxint
+
+
+class PlanNode(object):
+    def __init__(self, label, cost=COST_NORMAL):
+        self.label = label
+        self.cost = cost
+        self.found = None
+        self.elapsed = 0.0
+        self.lookups = 0
+        self._estimate = None
+
+    def estimate(self, estimate):
+        if self._estimate is None:
+            self._estimate = self._estimated(estimate)
+        return self._estimate
+
+    def sort_key(self, estimate):
+        return (self.cost, self.estimate(estimate))
+
+    def evaluate(self, hits, estimate):
+        def counting_hits(keyword):
+            self.lookups += 1
+            return hits(keyword)
+        self.estimate(estimate)
+        t0 = time.time()
+        self.found = self._evaluate(counting_hits, estimate)
+        self.elapsed = time.time() - t0
+        return self.found
+
+    def explain(self, op='', depth=0):
+        """Return a list of dicts describing this node and its children."""
+        return [{
+            'depth': depth,
+            'op': op,
+            'term': self.label,
+            'cost': self.cost,
+            'estimate': (None if self._estimate in (None, UNKNOWN)
+                         else self._estimate),
+            'found': (None if (self.found is None) else len(self.found)),
+            'lookups': self.lookups,
+            'ms': round(1000 * self.elapsed, 3)
+        }]
+
+
+class KeywordNode(PlanNode):
+    """Messages which have all of a list of keywords."""
+    def __init__(self, label, keywords, empty, cost=COST_NORMAL):
+        PlanNode.__init__(self, label, cost=cost)
+        self.keywords = keywords
+        self.empty = empty
+
+    def _estimated(self, estimate):
+        if not self.keywords:
+            return 0
+        return min(estimate(kw) for kw in self.keywords)
+
+    def _evaluate(self, hits, estimate):
+        results = None
+        for kw in sorted(self.keywords, key=estimate):
+            if results is None:
+                results = hits(kw)
+            else:
+                results = results & hits(kw)
+            if not results:
+                break
+        return self.empty() if (results is None) else results
+
+
+class TermNode(PlanNode):
+    """A term evaluated by a function, e.g. one provided by a plugin."""
+    def __init__(self, label, function, estimate=None, cost=COST_EXPENSIVE):
+        PlanNode.__init__(self, label, cost=cost)
+        self.function = function
+        self.estimator = estimate
+
+    def _estimated(self, estimate):
+        if self.estimator is None:
+            return UNKNOWN
+        size = self.estimator(estimate)
+        return UNKNOWN if (size is None) else size
+
+    def _evaluate(self, hits, estimate):
+        return self.function(hits)
+
+
+class AndNode(PlanNode):
+    def __init__(self, children, negatives):
+        PlanNode.__init__(self, 'AND',
+                          cost=max(c.cost for c in children + negatives))
+        self.children = children
+        self.negatives = negatives
+
+    def _estimated(self, estimate):
+        return min(c.estimate(estimate) for c in self.children)
+
+    def _evaluate(self, hits, estimate):
+        # If anything is sure to be empty, so is the result.
+        for child in self.children:
+            if child.estimate(estimate) == 0:
+                return child.evaluate(hits, estimate)
+
+        key = lambda c: c.sort_key(estimate)
+        results = None
+        for child in sorted(self.children, key=key):
+            if results is None:
+                results = child.evaluate(hits, estimate)
+            else:
+                results = results & child.evaluate(hits, estimate)
+            if not results:
+                return results
+        for child in sorted(self.negatives, key=key):
+            results = results - child.evaluate(hits, estimate)
+            if not results:
+                break
+        return results
+
+    def evaluate(self, hits, estimate):
+        results = PlanNode.evaluate(self, hits, estimate)
+        self.lookups = sum(c.lookups for c in self.children + self.negatives)
+        return results
+
+    def explain(self, op='', depth=0):
+        rows = PlanNode.explain(self, op=op, depth=depth)
+        for child in self.children:
+            rows.extend(child.explain(op='', depth=depth + 1))
+        for child in self.negatives:
+            rows.extend(child.explain(op='-', depth=depth + 1))
+        return rows
+
+
+class OrNode(PlanNode):
+    def __init__(self, children):
+        PlanNode.__init__(self, 'OR', cost=max(c.cost for c in children))
+        self.children = children
+
+    def _estimated(self, estimate):
+        return min(UNKNOWN, sum(c.estimate(estimate) for c in self.children))
+
+    def _evaluate(self, hits, estimate):
+        results = self.children[0].evaluate(hits, estimate)
+        for child in self.children[1:]:
+            results = results | child.evaluate(hits, estimate)
+        return results
+
+    def evaluate(self, hits, estimate):
+        results = PlanNode.evaluate(self, hits, estimate)
+        self.lookups = sum(c.lookups for c in self.children)
+        return results
+
+    def explain(self, op='', depth=0):
+        rows = PlanNode.explain(self, op=op, depth=depth)
+        for i, child in enumerate(self.children):
+            rows.extend(child.explain(op=(i and '+' or ''), depth=depth + 1))
+        return rows
+
+
+def QueryPlan(terms):
+    """
+    Build a plan from a list of (op, node) pairs, where op is None, '+'
+    or '-', following the left-to-right rules described above.
+
+    >>> kw = lambda k: KeywordNode(k, [k], set)
+    >>> plan = QueryPlan([(None, kw('a')), ('+', kw('b')), (None, kw('c')),
+    ...                   ('-', kw('d'))])
+    >>> [(r['depth'], r['op'], r['term']) for r in plan.explain()]
+    [(0, '', 'AND'), (1, '', 'OR'), (2, '', 'a'), (2, '+', 'b'), (1, '', 'c'), (1, '-', 'd')]
+    """
+    node, i = terms[0][1], 1
+    while i < len(terms):
+        op, term = terms[i]
+        if op == '+':
+            if isinstance(node, OrNode):
+                node.children.append(term)
+                node.cost = max(node.cost, term.cost)
+            else:
+                node = OrNode([node, term])
+            i += 1
+            continue
+        children, negatives = [node], []
+        while i < len(terms) and terms[i][0] != '+':
+            op, term = terms[i]
+            (negatives if (op == '-') else children).append(term)
+            i += 1
+        node = AndNode(children, negatives)
+    return node
+
+
+def ExplainText(rows):
+    """
+    Render the output of a plan's explain() as text.
+
+    >>> print ExplainText([{'depth': 0, 'op': '', 'term': 'AND',
+    ...                     'estimate': 5, 'found': 0, 'lookups': 2,
+    ...                     'ms': 1.5},
+    ...                    {'depth': 1, 'op': '-', 'term': 'in:spam',
+    ...                     'estimate': None, 'found': None, 'lookups': 0,
+    ...                     'ms': 0}])
+    AND                  est=5      found=0      lookups=2    1.500ms
+      -in:spam           est=?      (skipped)
+    """
+    lines = []
+    for row in rows:
+        label = ('  ' * row['depth'] + row['op'] + row['term'])[:20]
+        est = '?' if (row['estimate'] is None) else row['estimate']
+        if row['found'] is None:
+            lines.append('%-20s est=%-6s (skipped)' % (label, est))
+        else:
+            lines.append('%-20s est=%-6s found=%-6s lookups=%-4d %.3fms'
+                         % (label, est, row['found'], row['lookups'],
+                            row['ms']))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    # Check the planner against a naive left-to-right evaluation, and
+    # check that empty intersections stop evaluation.
+    import random
+    keywords = dict((k, set(random.sample(range(0, 100), size)))
+                    for k, size in (('a', 50), ('b', 5), ('c', 0),
+                                    ('d', 30), ('e', 90)))
+    lookups = []
+
+    def hits(kw):
+        lookups.append(kw)
+        return set(keywords[kw])
+
+    estimate = lambda kw: len(keywords[kw])
+    for tries in range(0, 100):
+        terms = [(random.choice([None, '+', '-']), random.choice('abcde'))
+                 for i in range(0, random.randint(1, 6))]
+        terms[0] = (None, terms[0][1])
+        expected = set(keywords[terms[0][1]])
+        for op, kw in terms[1:]:
+            if op == '+':
+                expected |= keywords[kw]
+            elif op == '-':
+                expected -= keywords[kw]
+            else:
+                expected &= keywords[kw]
+        plan = QueryPlan([(op, KeywordNode(kw, [kw], set))
+                          for op, kw in terms])
+        assert(plan.evaluate(hits, estimate) == expected)
+
+    del lookups[:]
+    plan = QueryPlan([(None, KeywordNode('e', ['e'], set)),
+                      (None, TermNode('x', lambda h: h('a'))),
+                      (None, KeywordNode('c', ['c'], set)),
+                      ('-', KeywordNode('d', ['d'], set))])
+    assert(plan.evaluate(hits, estimate) == set())
+    assert(lookups == ['c'])
+    assert([r['found'] for r in plan.explain()] == [0, None, None, 0, None])
+
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
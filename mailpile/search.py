@@ -1,14 +1,21 @@
 import cStringIO
 import email
+import email.parser
+import lxml.etree
 import lxml.html
+import multiprocessing
 import re
 import rfc822
 import time
 import threading
 import traceback
+from array import array
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from urllib import quote, unquote
 
 import mailpile.util
+from mailpile.address_index import AddressIndex
 from mailpile.crypto.gpgi import GnuPG
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
@@ -17,7 +24,14 @@ from mailpile.mailutils import FormatMbxId, MBX_ID_LEN, NoSuchMailboxError
 from mailpile.mailutils import AddressHeaderParser
 from mailpile.mailutils import ExtractEmails, ExtractEmailAndName
 from mailpile.mailutils import Email, ParseMessage, HeaderPrint
-from mailpile.postinglist import GlobalPostingList
+from mailpile.metadata_index import ColumnarMetadataIndex, IndexCheckpoint
+from mailpile.metadata_index import IndexCipher
+from mailpile.postinglist import GlobalPostingList, KeywordBatch
+from mailpile.query_plan import QueryPlan, KeywordNode, TermNode
+from mailpile.query_plan import COST_CHEAP, COST_EXPENSIVE
+from mailpile.search_sets import IdSet, RangeIdSet
+from mailpile.thread_index import ThreadIndex
+from mailpile.tokenizer import Tokenizer
 from mailpile.ui import *
 from mailpile.util import *
 
@@ -25,6 +39,112 @@ from mailpile.util import *
 _plugins = PluginManager()
 
 
+##[ Parallel scanning ]########################################################
+#
+# Parsing messages and extracting keywords is CPU bound work which holds
+# the GIL, so large imports can farm it out to a pool of forked worker
+# processes. The workers only return keywords and snippets: all changes
+# to the index are still made by a single thread, in mailbox order, so
+# the end result is the same as that of a serial scan.
+#
+# Forking a process which is running threads is unsafe: locks held by the
+# other threads stay locked forever in the child. So the pool is started
+# by prepare_workers before any worker threads exist (or on demand, if
+# there are no worker threads at all) and kept until shutdown. The
+# workers' copy of the config is only a snapshot, so each job carries the
+# current settings along with the messages.
+#
+_PARALLEL_SCAN = {}
+
+
+def StartScanPool(config):
+    """
+    Start the pool of processes which parse new mail, if configured to.
+    This forks, so it must not be called while worker threads are running.
+    """
+    with config._lock:
+        if config.scan_pool is None:
+            procs = config.sys.scan_processes
+            if procs < 1:
+                procs = multiprocessing.cpu_count()
+            if procs > 1:
+                config.scan_pool = multiprocessing.Pool(
+                    procs, _parallel_scan_init, (config,))
+        return config.scan_pool
+
+
+def StopScanPool(config):
+    with config._lock:
+        pool, config.scan_pool = config.scan_pool, None
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+
+def _parallel_scan_init(config):
+    from mailpile.ui import Session, SilentInteraction
+    session = Session(config)
+    session.ui = SilentInteraction(config)
+    _PARALLEL_SCAN.update({
+        'session': session,
+        'index': MailIndex(config),
+        'settings': None
+    })
+
+
+def _parallel_read_message(job):
+    settings, mailbox_idx, messages = job
+    idx = _PARALLEL_SCAN['index']
+    session = _PARALLEL_SCAN['session']
+    if settings != _PARALLEL_SCAN['settings']:
+        session.config.parse_config(None, settings)
+        _PARALLEL_SCAN['settings'] = settings
+
+    results = []
+    for msg_mid, msg_id, msg_data in messages:
+        try:
+            msg = ParseMessage(cStringIO.StringIO(msg_data),
+                               pgpmime=session.config.prefs.index_encrypted,
+                               config=session.config)
+            msg_ts = idx._extract_date_ts(session, msg_mid, msg_id, msg, -1)
+            if msg_ts == -1:
+                # The date depends on the previous message, let the
+                # committer handle this one the slow way.
+                results.append(None)
+                continue
+            keywords, body_info = idx.read_message(
+                session, msg_mid, msg_id, msg, len(msg_data), msg_ts,
+                mailbox=mailbox_idx)
+            results.append((msg_ts, keywords, body_info))
+        except Exception:
+            # The committer reports this and retries the message itself
+            results.append(traceback.format_exc())
+    return results
+
+
+##[ Parallel loading ]#########################################################
+#
+# An encrypted mailpile.idx is a sequence of chunks, one per save, each of
+# which must be decrypted before its lines can be parsed. Decrypting and
+# pre-parsing chunks are independent of each other, so if sys.load_threads
+# allows, they are handed to a pool of threads. This is worth it because
+# the in-process AES releases the GIL while decrypting; forking would not
+# be safe, as get_index may load the index while other threads run.
+# Results are applied to the index by a single thread, in file order, so
+# rows which appear in more than one chunk still end up with the last
+# version written.
+#
+
+
+def _load_index_chunk(job, config):
+    encrypted, lines = job
+    if encrypted:
+        # As before, we don't raise on errors, in case only some of the
+        # chunks are corrupt - we want to read the rest of them.
+        lines = decrypt_chunk_lines(lines, config, _raise=False)
+    return MailIndex.ParseIndexLines(lines)
+
+
 class SearchResultSet:
     """
     Search results!
@@ -35,21 +155,158 @@ class SearchResultSet:
         self.set_results(results, exclude)
 
     def set_results(self, results, exclude):
+        results = IdSet.Coerce(results)
         self._results = {
-            'raw': set(results),
-            'excluded': set(exclude) & set(results)
+            'raw': results,
+            'excluded': IdSet.Coerce(exclude) & results
         }
         return self
 
     def __len__(self):
         return len(self._results.get('raw', []))
 
-    def as_set(self, order='raw'):
+    def as_ids(self, order='raw'):
+        """Return the results as an IdSet, without copying to a set."""
         return self._results[order] - self._results['excluded']
 
+    def as_set(self, order='raw'):
+        return set(self.as_ids(order=order))
+
     def excluded(self):
         return self._results['excluded']
 
+    def iter_sorted(self, how):
+        """Iterate through the results in a given order, lazily."""
+        return self._index.iter_sorted_results(self.as_ids(), how)
+
+    def sorted_results(self, how):
+        """Return the results as a lazily sorted list."""
+        return SortedResults(self._index, self.as_ids(), how)
+
+
+class SortedResults(object):
+    """
+    A list of search results, which only gets sorted (and have its
+    conversations collapsed) as far as somebody actually looks. Rendering
+    the first page of a huge result set does not need to sort all of it.
+
+    Anything other than reading treats this as a plain list, which
+    sorts everything first.
+    """
+    CHUNK = 64
+
+    def __init__(self, idx, ids, how):
+        self._index = idx
+        self._ids = ids
+        self._lock = SearchRLock()
+        self.how = how
+        self._reset()
+
+    def _reset(self):
+        self._list = []
+        self._iter = self._index.iter_sorted_results(self._ids, self.how)
+        self._len = None
+
+    def _fill(self, want=None):
+        with self._lock:
+            if self._iter is not None:
+                if want is None:
+                    self._list.extend(self._iter)
+                    self._iter = None
+                elif want > len(self._list):
+                    want = max(want - len(self._list), self.CHUNK)
+                    got = list(islice(self._iter, want))
+                    self._list.extend(got)
+                    if len(got) < want:
+                        self._iter = None
+            return self._list
+
+    def reorder(self, how):
+        """Change the sort order, returns False if no longer lazy."""
+        with self._lock:
+            if self._ids is None:
+                return False
+            self.how = how
+            self._reset()
+            return True
+
+    def copy(self):
+        with self._lock:
+            if self._ids is None:
+                return self._list[:]
+            return SortedResults(self._index, self._ids, self.how)
+
+    def __len__(self):
+        with self._lock:
+            if self._iter is None:
+                return len(self._list)
+            if self._len is None:
+                self._len = self._index.count_sorted_results(self._ids,
+                                                             self.how)
+            return self._len
+
+    def __nonzero__(self):
+        return bool(self._list) or bool(self._iter is not None and self._ids)
+
+    def __iter__(self):
+        pos = 0
+        while pos < len(self._fill(pos + 1)):
+            yield self._list[pos]
+            pos += 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key == slice(None, None, None):
+                return self.copy()
+            if (key.stop is None or key.stop < 0 or
+                    (key.start or 0) < 0):
+                return self._fill()[key]
+            return self._fill(key.stop)[key]
+        if key < 0:
+            return self._fill()[key]
+        return self._fill(key + 1)[key]
+
+    def __contains__(self, msg_idx):
+        if self._ids is not None:
+            if msg_idx not in self._ids:
+                return False
+            if 'flat' in self.how:
+                return True
+        return msg_idx in self._fill()
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        # This is used to fingerprint searches; keep it cheap.
+        if self._ids is None:
+            return repr(self._list)
+        return 'SortedResults(%s, %s)' % (self.how,
+                                          md5_hex(self._ids.tostring()))
+
+    def __reduce__(self):
+        return (list, (list(self), ))
+
+    def __setitem__(self, key, value):
+        self.__getattr__('__setitem__')(key, value)
+
+    def __delitem__(self, key):
+        self.__getattr__('__delitem__')(key)
+
+    def __getattr__(self, attr):
+        # Anything else (sort, reverse, append, ...) happens on a plain
+        # list, at which point we stop being lazy.
+        if attr.startswith('__') and attr not in ('__setitem__',
+                                                  '__delitem__'):
+            raise AttributeError(attr)
+        with self._lock:
+            self._fill()
+            self._ids = None
+            return getattr(self._list, attr)
+
 
 SEARCH_RESULT_CACHE = {}
 
@@ -107,22 +364,33 @@ class MailIndex(object):
 
     MAX_INCREMENTAL_SAVES = 25
 
+    # The classes used for sets of message index positions; see
+    # mailpile.search_sets for the interface they need to provide.
+    ID_SET = IdSet
+    ALL_SET = RangeIdSet
+
     def __init__(self, config):
         self.config = config
         self.interrupt = None
-        self.INDEX = []
+        self.INDEX = ColumnarMetadataIndex()
         self.INDEX_SORT = {}
         self.INDEX_THR = []
+        self.THREADS = ThreadIndex()
         self.PTRS = {}
         self.TAGS = {}
         self.MSGIDS = {}
         self.EMAILS = []
         self.EMAIL_IDS = {}
-        self.CACHE = {}
         self.MODIFIED = set()
         self.EMAILS_SAVED = 0
         self._scanned = {}
         self._saved_changes = 0
+        self._kw_batch = None
+        self._kw_batching = 0
+        self._addresses = None
+        self._address_scores = None
+        self.extraction_timing = {}
+        self._tokenizer = None
         self._lock = SearchRLock()
         self._save_lock = SearchRLock()
         self._prepare_sorting()
@@ -185,81 +453,259 @@ class MailIndex(object):
         d = self.get_body(msg_info)
         msg_info[self.MSG_BODY] = self.encode_body(d, **kwargs)
 
+    def _gpg_recipient(self):
+        gpgr = self.config.prefs.gpg_recipient
+        return gpgr if gpgr not in (None, '', '!CREATE') else None
+
+    def _index_key(self):
+        # If mailpile.idx is encrypted, the files derived from it must be
+        # too. Returns the key to use, '' for none, or None if we have no
+        # way to encrypt them and they must not be written at all.
+        if not self._gpg_recipient():
+            return ''
+        if self.config.master_key and IndexCipher.Available():
+            return self.config.master_key
+        return None
+
+    def _load_columns(self, session, fd):
+        key = self._index_key()
+        if key is None:
+            return 0
+        cmi = ColumnarMetadataIndex.Open(self.config.mailindex_columns_file(),
+                                         index_fd=fd, key=key)
+        if cmi is None:
+            return 0
+
+        if session:
+            session.ui.mark(_('Loading metadata columns...'))
+        self.INDEX = cmi
+        self.EMAILS = cmi.get_emails()
+        if self._load_checkpoint(session, cmi):
+            return cmi.idx_size
+
+        for eid, email in enumerate(self.EMAILS):
+            if email:
+                self.EMAIL_IDS[email.split()[0].lower()] = eid
+
+        count = len(cmi)
+        self.INDEX_THR = [-1] * count
+        for order in self.INDEX_SORT:
+            self.INDEX_SORT[order] = array('d', [0]) * count
+        self._sort_perms = {}
+        self._sort_gen += 1
+        for msg_idx in xrange(0, count):
+            msg_info = cmi.get_row(msg_idx)
+            if msg_info and len(msg_info) == self.MSG_FIELDS_V2:
+                self._update_msg_lookups(msg_idx, msg_info)
+
+        # Reading every row defeats the point of the columns, so make sure
+        # the next startup finds a checkpoint.
+        self.config.save_worker.add_unique_task(
+            session, 'Save metadata checkpoint',
+            lambda: self.save_checkpoint(session=session))
+        return cmi.idx_size
+
+    def _checkpoint_signature(self):
+        # Anything other than the metadata itself which the derived
+        # structures depend on goes here.
+        return md5_hex(repr((self.MSG_FIELDS_V2, self.ID_SET.__name__,
+                             sorted(self.SORT_ORDERS.keys()),
+                             self.SORT_KEY_VERSION,
+                             self._sort_freshness_tags,
+                             AddressIndex.HALF_LIFE))).decode('hex')
+
+    def _load_checkpoint(self, session, cmi):
+        generation = (len(cmi), cmi.idx_size, cmi.idx_md5)
+        sections = IndexCheckpoint.Read(
+            self.config.mailindex_checkpoint_file(),
+            generation, self._checkpoint_signature(), key=self._index_key())
+        if not sections:
+            return False
+        try:
+            count = len(cmi)
+            thr = IndexCheckpoint.Array('i', sections['thr'])
+            sort = {}
+            for order in self.INDEX_SORT:
+                sort[order] = IndexCheckpoint.Array('d',
+                                                    sections['sort:%s' % order])
+                if len(sort[order]) != count:
+                    return False
+            if len(thr) != count:
+                return False
+            perms = {}
+            for order in self.INDEX_SORT:
+                blob = sections.get('perm:%s' % order)
+                if blob is not None:
+                    perms[order] = IndexCheckpoint.Array('i', blob)
+                    if len(perms[order]) != count:
+                        return False
+            tags = {}
+            for name, blob in sections.iteritems():
+                if name.startswith('tag:'):
+                    tags[name[4:]] = self.ID_SET.FromSorted(
+                        IndexCheckpoint.Array('i', blob))
+            ptrs = IndexCheckpoint.UnpackDict(sections['ptrs'],
+                                              sections['ptrs.v'])
+            msgids = IndexCheckpoint.UnpackDict(sections['msgids'],
+                                                sections['msgids.v'])
+            email_ids = IndexCheckpoint.UnpackDict(sections['email_ids'],
+                                                   sections['email_ids.v'],
+                                                   encoding='utf-8')
+            dirty = IndexCheckpoint.Array('i', sections['dirty'])
+            parents = (IndexCheckpoint.Array('i', sections.get('thr.m', '')),
+                       IndexCheckpoint.Array('i', sections.get('thr.p', '')))
+            address_scores = None
+            if 'addr.score' in sections:
+                address_scores = (
+                    IndexCheckpoint.Array('i', sections['addr.rows'])[0],
+                    IndexCheckpoint.Array('d', sections['addr.score']))
+        except (KeyError, ValueError, IndexError):
+            return False
+
+        if session:
+            session.ui.mark(_('Loading metadata index checkpoint...'))
+        self.INDEX_THR = thr.tolist()
+        self.THREADS = ThreadIndex.FromRoots(self.INDEX_THR)
+        self.THREADS.set_parent_arrays(*parents)
+        self.INDEX_SORT = sort
+        self._sort_perms = perms
+        self._sort_gen += 1
+        self.TAGS = tags
+        self.PTRS = ptrs
+        self.MSGIDS = msgids
+        self.EMAIL_IDS = email_ids
+        self._address_scores = address_scores
+
+        # Messages which had unsaved changes when the checkpoint was
+        # written are re-derived from what is actually on disk.
+        for msg_idx in dirty:
+            msg_info = cmi.get_row(msg_idx)
+            if msg_info and len(msg_info) == self.MSG_FIELDS_V2:
+                self._update_msg_lookups(msg_idx, msg_info)
+        return True
+
+    def save_checkpoint(self, session=None):
+        """
+        Write out a checkpoint of the structures derived from the metadata
+        columns, so the next startup can skip rebuilding them.
+        """
+        checkpoint_file = self.config.mailindex_checkpoint_file()
+        key = self._index_key()
+        if key is None:
+            safe_remove(checkpoint_file)
+            return False
+
+        with self._save_lock:
+            # In a locked section we just copy our data
+            with self._lock:
+                base, overlay, tail = self.INDEX.snapshot()
+                if not base:
+                    return False
+                count = base.count
+                generation = (count, self.INDEX.idx_size, self.INDEX.idx_md5)
+                email_count = self.INDEX._email_count
+                dirty = set(overlay.keys()) | self.MODIFIED
+                thr = array('i', self.INDEX_THR[:count])
+                parents = self.THREADS.parent_arrays()
+                sort = dict((o, a[:count]) for o, a in self.INDEX_SORT.items())
+                perms = dict((o, p[:]) for o, p in self._sort_perms.items())
+                tags = dict((t, s.below(count)) for t, s in self.TAGS.items())
+                ptrs = dict(self.PTRS)
+                msgids = dict(self.MSGIDS)
+                email_ids = dict(self.EMAIL_IDS)
+                ai = self._addresses
+                if ai is not None:
+                    address_rows = len(self.INDEX)
+                    address_scores = array('d', (
+                        ai.rank(eid) for eid in xrange(0, email_count)))
+
+            if session:
+                session.ui.mark(_('Saving metadata index checkpoint...'))
+            sections = [('thr', thr.tostring()),
+                        ('thr.m', parents[0].tostring()),
+                        ('thr.p', parents[1].tostring()),
+                        ('dirty', array('i', sorted(p for p in dirty
+                                                    if p < count)).tostring())]
+            for order, keys in sort.iteritems():
+                sections.append(('sort:%s' % order, keys.tostring()))
+            for order, perm in perms.iteritems():
+                if len(perm) > count:
+                    perm = array('i', (p for p in perm if p < count))
+                sections.append(('perm:%s' % order, perm.tostring()))
+            for tid, tagged in tags.iteritems():
+                sections.append(('tag:%s' % tid, tagged.tostring()))
+            if ai is not None:
+                sections.extend([
+                    ('addr.rows', array('i', [address_rows]).tostring()),
+                    ('addr.score', address_scores.tostring())])
+            try:
+                for name, d, limit, enc in (
+                        ('ptrs', ptrs, count, None),
+                        ('msgids', msgids, count, None),
+                        ('email_ids', email_ids, email_count, 'utf-8')):
+                    keys, values = IndexCheckpoint.PackDict(
+                        dict((k, v) for k, v in d.iteritems() if v < limit),
+                        encoding=enc)
+                    sections.extend([(name, keys), (name + '.v', values)])
+            except ValueError:
+                safe_remove(checkpoint_file)
+                return False
+
+            return IndexCheckpoint.Write(checkpoint_file, generation,
+                                         self._checkpoint_signature(),
+                                         sections, key=key)
+
+    def save_columns(self, session=None):
+        columns_file = self.config.mailindex_columns_file()
+        key = self._index_key()
+        if key is None:
+            # Never leave plain-text metadata around if the user asked
+            # for it to be encrypted.
+            safe_remove(columns_file)
+            return False
+
+        with self._save_lock:
+            with self._lock:
+                emails = self.EMAILS[:self.EMAILS_SAVED]
+            with open(self.config.mailindex_file(), 'rb') as fd:
+                fd.seek(0, 2)
+                idx_size = fd.tell()
+                idx_md5 = ColumnarMetadataIndex.IndexChecksum(fd, idx_size)
+            if session:
+                session.ui.mark(_('Saving metadata columns...'))
+            return self.INDEX.write(columns_file, emails,
+                                    idx_size=idx_size, idx_md5=idx_md5,
+                                    key=key)
+
     def load(self, session=None):
-        self.INDEX = []
-        self.CACHE = {}
+        self.INDEX = ColumnarMetadataIndex()
+        self.INDEX_THR = []
+        self.THREADS = ThreadIndex()
+        self._prepare_sorting()
         self.PTRS = {}
         self.MSGIDS = {}
         self.EMAILS = []
         self.EMAIL_IDS = {}
+        self._addresses = None
+        self._address_scores = None
         CachedSearchResultSet.DropCaches()
         bogus_lines = []
 
-        def process_lines(lines):
-            for line in lines:
-                line = line.strip()
-                if line[:1] in ('#', ''):
-                    pass
-                elif line[:1] == '@':
-                    try:
-                        pos, email = line[1:].split('\t', 1)
-                        pos = int(pos, 36)
-                        while len(self.EMAILS) < pos + 1:
-                            self.EMAILS.append('')
-                        unquoted_email = unquote(email).decode('utf-8')
-                        self.EMAILS[pos] = unquoted_email
-                        self.EMAIL_IDS[unquoted_email.split()[0].lower()] = pos
-                    except (ValueError, IndexError, TypeError):
-                        bogus_lines.append(line)
-                else:
-                    bogus = False
-                    words = line.split('\t')
-
-                    # Migration: converting old metadata into new!
-                    if len(words) != self.MSG_FIELDS_V2:
-
-                        # V1 -> V2 adds MSG_CC and MSG_KB
-                        if len(words) == self.MSG_FIELDS_V1:
-                            words[self.MSG_CC:self.MSG_CC] = ['']
-                            words[self.MSG_KB:self.MSG_KB] = ['0']
-
-                        # Add V2 -> V3 here, etc. etc.
-
-                        if len(words) == self.MSG_FIELDS_V2:
-                            line = '\t'.join(words)
-                        else:
-                            bogus = True
-
-                    if not bogus:
-                        try:
-                            pos = int(words[self.MSG_MID], 36)
-                            self.set_msg_at_idx_pos(pos, words,
-                                                    original_line=line)
-                        except ValueError:
-                            bogus = True
-
-                    if bogus:
-                        bogus_lines.append(line)
-                        if len(bogus_lines) > max(0.02 * len(self.INDEX), 50):
-                            raise Exception(_('Your metadata index is '
-                                              'either too old, too new '
-                                              'or corrupt!'))
-                        elif session and 1 == len(bogus_lines) % 100:
-                            session.ui.error(_('Corrupt data in metadata '
-                                               'index! Trying to cope...'))
-
         if session:
             session.ui.mark(_('Loading metadata index...'))
+        migrate = False
         try:
             import mailpile.mail_source
             with self._save_lock, self._lock:
                 with open(self.config.mailindex_file(), 'r') as fd:
-                    # We don't raise on errors, in case only some of the chunks
-                    # are corrupt - we want to read the rest of them.
+                    # If we have up-to-date columns, we only need to replay
+                    # whatever has been appended to mailpile.idx since.
+                    offset = self._load_columns(session, fd)
+                    migrate = (offset == 0)
+                    fd.seek(offset)
+
                     # FIXME: Differentiate between partial index and no index?
-                    decrypt_and_parse_lines(fd, process_lines, self.config,
-                                            newlines=True, decode=False,
-                                            _raise=False)
+                    self._load_index_lines(session, fd, bogus_lines)
         except IOError:
             if session:
                 session.ui.warning(_('Metadata index not found: %s'
@@ -284,19 +730,160 @@ class MailIndex(object):
                                ) % len(self.INDEX))
         self.EMAILS_SAVED = len(self.EMAILS)
 
+        # One-time migration: write out the columns so the next startup
+        # does not need to parse the whole of mailpile.idx.
+        if migrate and self.INDEX and self._index_key() is not None:
+            self.config.save_worker.add_unique_task(
+                session, 'Save metadata columns',
+                lambda: self.save_columns(session=session))
+
+        self.config.merge_worker.add_unique_task(
+            session, 'Index addresses',
+            lambda: self._build_address_index(session))
+
+    PARALLEL_LOAD_MIN = 4
+    PARALLEL_LOAD_BATCH = 64
+
+    @classmethod
+    def ParseIndexLines(cls, lines):
+        """
+        Parse lines from mailpile.idx, without touching the index itself.
+        Returns lists of (pos, e-mail, e-mail ID) and (pos, line) tuples,
+        along with a list of any lines which could not be parsed.
+
+        >>> row = '\\t'.join(['2'] + ['x'] * 12)
+        >>> emails, rows, bogus = MailIndex.ParseIndexLines(
+        ...     ['# Hi\\n', '@A\\tbre%40x.is\\n', row + '\\n', 'Bogus!\\n'])
+        >>> emails, rows == [(2, row)], bogus
+        ([(10, u'bre@x.is', u'bre@x.is')], True, ['Bogus!'])
+        """
+        emails, rows, bogus_lines = [], [], []
+        for line in lines:
+            line = line.strip()
+            if line[:1] in ('#', ''):
+                pass
+            elif line[:1] == '@':
+                try:
+                    pos, email = line[1:].split('\t', 1)
+                    email = unquote(email).decode('utf-8')
+                    emails.append((int(pos, 36), email,
+                                   email.split()[0].lower()))
+                except (ValueError, IndexError, TypeError):
+                    bogus_lines.append(line)
+            else:
+                words = line.split('\t')
+
+                # Migration: converting old metadata into new!
+                if len(words) != cls.MSG_FIELDS_V2:
+
+                    # V1 -> V2 adds MSG_CC and MSG_KB
+                    if len(words) == cls.MSG_FIELDS_V1:
+                        words[cls.MSG_CC:cls.MSG_CC] = ['']
+                        words[cls.MSG_KB:cls.MSG_KB] = ['0']
+
+                    # Add V2 -> V3 here, etc. etc.
+
+                    if len(words) == cls.MSG_FIELDS_V2:
+                        line = '\t'.join(words)
+                    else:
+                        bogus_lines.append(line)
+                        continue
+
+                try:
+                    rows.append((int(words[cls.MSG_MID], 36), line))
+                except ValueError:
+                    bogus_lines.append(line)
+        return emails, rows, bogus_lines
+
+    def _apply_index_lines(self, session, parsed, bogus_lines):
+        emails, rows, bogus = parsed
+        for pos, email, email_id in emails:
+            while len(self.EMAILS) < pos + 1:
+                self.EMAILS.append('')
+            self.EMAILS[pos] = email
+            self.EMAIL_IDS[email_id] = pos
+
+        if rows:
+            self._grow_index(max(pos for pos, line in rows) + 1)
+        for pos, line in rows:
+            try:
+                self.set_msg_at_idx_pos(pos, line.split('\t'),
+                                        original_line=line)
+            except ValueError:
+                bogus.append(line)
+
+        for line in bogus:
+            bogus_lines.append(line)
+            if len(bogus_lines) > max(0.02 * len(self.INDEX), 50):
+                raise Exception(_('Your metadata index is '
+                                  'either too old, too new '
+                                  'or corrupt!'))
+            elif session and 1 == len(bogus_lines) % 100:
+                session.ui.error(_('Corrupt data in metadata '
+                                   'index! Trying to cope...'))
+
+    def _load_index_lines(self, session, fd, bogus_lines):
+        threads = self.config.sys.load_threads
+        if threads < 1:
+            threads = multiprocessing.cpu_count()
+
+        def load_chunk(job):
+            try:
+                return _load_index_chunk(job, self.config)
+            except Exception:
+                # We retry this one below, reporting whatever went wrong
+                return None
+
+        def apply_batch(batch, results):
+            for job, parsed in zip(batch, results or [None] * len(batch)):
+                if parsed is None:
+                    parsed = _load_index_chunk(job, self.config)
+                self._apply_index_lines(session, parsed, bogus_lines)
+
+        # We only bother with a pool of workers if there are a few
+        # encrypted chunks to decrypt. While the workers are busy, the
+        # results of the previous batch get applied to the index.
+        chunks = split_encrypted_chunks(fd)
+        pool, pending = None, None
+        try:
+            while True:
+                batch = list(islice(chunks, self.PARALLEL_LOAD_BATCH))
+                if not batch:
+                    break
+                if (pool is None and threads > 1 and
+                        len([e for e, l in batch if e]) >=
+                        self.PARALLEL_LOAD_MIN):
+                    if session:
+                        session.ui.mark(_('Decrypting metadata index '
+                                          'using %d threads') % threads)
+                    pool = ThreadPool(threads)
+                results = pool and pool.imap(load_chunk, batch)
+                if pending:
+                    apply_batch(*pending)
+                pending = (batch, results)
+            if pending:
+                apply_batch(*pending)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
     def update_msg_tags(self, msg_idx_pos, msg_info):
         tags = set(self.get_tags(msg_info=msg_info))
         with self._lock:
             for tid in (set(self.TAGS.keys()) - tags):
-                self.TAGS[tid] -= set([msg_idx_pos])
+                self.TAGS[tid].discard(msg_idx_pos)
             for tid in tags:
                 if tid not in self.TAGS:
-                    self.TAGS[tid] = set()
+                    self.TAGS[tid] = self.ID_SET()
                 self.TAGS[tid].add(msg_idx_pos)
 
     def save_changes(self, session=None):
         self._save_lock.acquire()
         try:
+            # Messages must not reach disk before their keywords do.
+            self.flush_keywords()
+
             # In a locked section, check what needs to be done!
             with self._lock:
                 mods, self.MODIFIED = self.MODIFIED, set()
@@ -346,6 +933,7 @@ class MailIndex(object):
     def save(self, session=None):
         try:
             self._save_lock.acquire()
+            self.flush_keywords()
             with self._lock:
                 old_mods, self.MODIFIED = self.MODIFIED, set()
                 old_emails_saved = self.EMAILS_SAVED
@@ -384,6 +972,10 @@ class MailIndex(object):
             os.rename(newfile, idxfile)
 
             self._saved_changes = 0
+            if self.save_columns(session=session):
+                self.config.save_worker.add_unique_task(
+                    session, 'Save metadata checkpoint',
+                    lambda: self.save_checkpoint(session=session))
             if session:
                 session.ui.mark(_("Saved metadata index"))
         except:
@@ -398,7 +990,7 @@ class MailIndex(object):
     def update_ptrs_and_msgids(self, session):
         session.ui.mark(_('Updating high level indexes'))
         for offset in range(0, len(self.INDEX)):
-            message = self.l2m(self.INDEX[offset])
+            message = self.INDEX.get_row(offset) or []
             if len(message) == self.MSG_FIELDS_V2:
                 self.MSGIDS[message[self.MSG_ID]] = offset
                 for msg_ptr in message[self.MSG_PTRS].split(','):
@@ -617,9 +1209,34 @@ class MailIndex(object):
             })
         return progress
 
-    def scan_mailbox(self, session, mailbox_idx, mailbox_fn, mailbox_opener,
-                     process_new=None, apply_tags=None, stop_after=None,
-                     editable=False, event=None):
+    def _begin_keyword_batch(self, session):
+        with self._lock:
+            if self._kw_batch is None:
+                self._kw_batch = KeywordBatch(session)
+            self._kw_batching += 1
+
+    def _end_keyword_batch(self):
+        with self._lock:
+            self._kw_batching -= 1
+        self.flush_keywords()
+
+    def flush_keywords(self):
+        """Write any keywords buffered by a bulk scan to the GPL."""
+        batch = self._kw_batch
+        return batch.flush() if batch else 0
+
+    def scan_mailbox(self, session, *args, **kwargs):
+        # While scanning, keywords are written to the global posting list
+        # in batches, not one word at a time.
+        self._begin_keyword_batch(session)
+        try:
+            return self._scan_mailbox(session, *args, **kwargs)
+        finally:
+            self._end_keyword_batch()
+
+    def _scan_mailbox(self, session, mailbox_idx, mailbox_fn, mailbox_opener,
+                      process_new=None, apply_tags=None, stop_after=None,
+                      editable=False, event=None):
         mailbox_idx = FormatMbxId(mailbox_idx)
         progress = self._get_scan_progress(mailbox_idx,
                                            event=event, reset=True)
@@ -634,6 +1251,7 @@ class MailIndex(object):
             session.ui.mark(message)
             return code
 
+        no_new_mail = _('%s: No new mail in: %s')
         try:
             mbox = mailbox_opener(session, mailbox_idx)
             if mbox.editable != editable:
@@ -642,6 +1260,18 @@ class MailIndex(object):
             else:
                 session.ui.mark(_('%s: Checking: %s'
                                   ) % (mailbox_idx, mailbox_fn))
+
+                # If the mailbox can tell us cheaply that nothing has
+                # changed since our last complete scan, we are done.
+                get_token = getattr(mbox, 'get_change_token', None)
+                change_token = get_token and get_token()
+                if change_token is not None:
+                    change_token = 'token:%s' % change_token
+                    if change_token == self._scanned.get(mailbox_idx):
+                        return finito(0, no_new_mail % (mailbox_idx,
+                                                        mailbox_fn),
+                                      complete=True)
+
                 mbox.update_toc()
         except (IOError, OSError, ValueError, NoSuchMailboxError), e:
             if 'rescan' in session.config.sys.debug:
@@ -657,8 +1287,9 @@ class MailIndex(object):
         messages = sorted(mbox.keys())
         messages_md5 = md5_hex(str(messages))
         if messages_md5 == self._scanned.get(mailbox_idx, ''):
-            return finito(0, _('%s: No new mail in: %s'
-                               ) % (mailbox_idx, mailbox_fn),
+            if change_token is not None:
+                self._scanned[mailbox_idx] = change_token
+            return finito(0, no_new_mail % (mailbox_idx, mailbox_fn),
                           complete=True)
 
         parse_fmt1 = _('%s: Reading your mail: %d%% (%d/%d message)')
@@ -675,14 +1306,33 @@ class MailIndex(object):
 
         # Figure out which messages exist at all (so we can remove
         # stale pointers later on).
+        new_msgs = []
+        msg_ptrs = []
         for ui in range(0, len(messages)):
             msg_ptr = mbox.get_msg_ptr(mailbox_idx, messages[ui])
+            msg_ptrs.append(msg_ptr)
             existing_ptrs.add(msg_ptr)
+            if msg_ptr not in self.PTRS:
+                new_msgs.append((messages[ui], msg_ptr))
             if (ui % 317) == 0:
                 play_nice_with_threads()
 
         added = updated = 0
         last_date = long(time.time())
+        procs = session.config.sys.scan_processes
+        if procs < 1:
+            procs = multiprocessing.cpu_count()
+        if procs > 1 and len(new_msgs) >= self.PARALLEL_SCAN_MIN:
+            # Anything left undone will be picked up by the loop below.
+            last_date, added, updated = self._scan_parallel(
+                session, mailbox_idx, mbox, new_msgs,
+                last_date=last_date,
+                process_new=process_new,
+                apply_tags=apply_tags,
+                stop_after=stop_after,
+                editable=editable,
+                event=event,
+                progress=progress)
         not_done_yet = 'NOT DONE YET'
         for ui in range(0, len(messages)):
             if mailpile.util.QUITTING or self.interrupt:
@@ -694,7 +1344,7 @@ class MailIndex(object):
                 break
 
             i = messages[ui]
-            msg_ptr = mbox.get_msg_ptr(mailbox_idx, i)
+            msg_ptr = msg_ptrs[ui]
             if msg_ptr in self.PTRS:
                 if (ui % 317) == 0:
                     session.ui.mark(parse_status(ui))
@@ -735,7 +1385,10 @@ class MailIndex(object):
         })
         play_nice_with_threads()
 
-        self._scanned[mailbox_idx] = messages_md5
+        if change_token is not None and messages_md5 != not_done_yet:
+            self._scanned[mailbox_idx] = change_token
+        else:
+            self._scanned[mailbox_idx] = messages_md5
         short_fn = '/'.join(mailbox_fn.split('/')[-2:])
         return finito(added,
                       _('%s: Indexed mailbox: ...%s (%d new, %d updated)'
@@ -744,6 +1397,123 @@ class MailIndex(object):
                       updated=updated,
                       complete=(messages_md5 != not_done_yet))
 
+    PARALLEL_SCAN_MIN = 64
+    PARALLEL_SCAN_BATCH = 256
+    PARALLEL_SCAN_CHUNK = 16
+
+    def _scan_parallel(self, session, mailbox_idx, mbox, new_msgs,
+                       last_date=None, stop_after=None, progress=None,
+                       **kwargs):
+        """
+        Parse new messages using the pool of worker processes, committing
+        them to the index in order on the scan worker. Each batch is
+        handed to the pool before the previous one is committed, so
+        reading, parsing and committing overlap.
+        """
+        config = session.config
+        pool = config.scan_pool
+        if pool is None and not config.daemons_started():
+            pool = StartScanPool(config)
+        if pool is None:
+            return last_date, 0, 0
+
+        state = {'last_date': last_date, 'added': 0, 'updated': 0}
+
+        def reserve(batch):
+            # Messages get their rows up front, just like in a serial
+            # scan, so the workers can be told their real MIDs.
+            jobs = []
+            for msg_key, msg_ptr, msg_data in batch:
+                if msg_ptr in self.PTRS:
+                    continue
+                msg = email.parser.Parser().parsestr(msg_data,
+                                                     headersonly=True)
+                msg_id = self.get_msg_id(msg, msg_ptr)
+                with self._lock:
+                    if msg_id in self.MSGIDS:
+                        self._update_location(session, self.MSGIDS[msg_id],
+                                              msg_ptr)
+                        state['updated'] += 1
+                        progress['updated'] += 1
+                        continue
+                    msg_idx_pos, msg_info = self._add_incoming_placeholder(
+                        msg_ptr, msg_id, len(msg_data), msg,
+                        state['last_date'] + 1)
+                jobs.append((msg_key, msg_ptr, msg_data, msg, msg_id,
+                             msg_idx_pos))
+            return jobs
+
+        def commit(jobs, results):
+            def _commit():
+                for (msg_key, msg_ptr, msg_data, msg, msg_id, msg_idx_pos
+                     ) in jobs:
+                    try:
+                        parsed = results.next()
+                    except Exception:
+                        parsed = traceback.format_exc()
+                    if isinstance(parsed, str):
+                        session.ui.warning(
+                            _('Parsing message %s/%s failed, retrying: %s'
+                              ) % (mailbox_idx, msg_key,
+                                   parsed.strip().splitlines()[-1]))
+                        parsed = None
+                    if parsed is None:
+                        try:
+                            msg = ParseMessage(
+                                cStringIO.StringIO(msg_data),
+                                pgpmime=config.prefs.index_encrypted,
+                                config=config)
+                        except (IOError, OSError, ValueError, IndexError,
+                                KeyError):
+                            progress['errors'].append(msg_key)
+                    msg_info = self._index_incoming_message(
+                        session, msg_id, msg_ptr, len(msg_data), msg,
+                        state['last_date'] + 1, mailbox_idx,
+                        kwargs.get('process_new'), kwargs.get('apply_tags'),
+                        read_results=parsed, msg_idx_pos=msg_idx_pos)
+                    state['last_date'] = long(msg_info[self.MSG_DATE], 36)
+                    state['added'] += 1
+                    progress['added'] += 1
+                    play_nice_with_threads()
+            config.scan_worker.do(
+                session, 'scan:%s/parallel' % mailbox_idx, _commit)
+
+        def results_of(work):
+            for chunk in pool.imap(_parallel_read_message, work):
+                for parsed in chunk:
+                    yield parsed
+
+        session.ui.mark(_('%s: Parsing %d messages in parallel'
+                          ) % (mailbox_idx, len(new_msgs)))
+        settings = config.as_config_bytes()
+        pending = None
+        for b in range(0, len(new_msgs), self.PARALLEL_SCAN_BATCH):
+            if (mailpile.util.QUITTING or self.interrupt or
+                    (stop_after and state['added'] >= stop_after)):
+                break
+            batch = []
+            for msg_key, msg_ptr in new_msgs[b:b + self.PARALLEL_SCAN_BATCH]:
+                try:
+                    msg_data = mbox.get_file(msg_key).read()
+                    batch.append((msg_key, msg_ptr, msg_data))
+                except (IOError, OSError, ValueError, IndexError, KeyError):
+                    pass
+            jobs = config.scan_worker.do(
+                session, 'scan:%s/reserve' % mailbox_idx,
+                lambda: reserve(batch))
+            chunk = self.PARALLEL_SCAN_CHUNK
+            work = [(settings, mailbox_idx,
+                     [(b36(j[5]), j[4], j[2]) for j in jobs[c:c + chunk]])
+                    for c in range(0, len(jobs), chunk)]
+            results = results_of(work)
+            if pending:
+                commit(*pending)
+            pending = (jobs, results)
+        if pending:
+            commit(*pending)
+
+        return state['last_date'], state['added'], state['updated']
+
     def scan_one_message(self, session, mailbox_idx, mbox, msg_mbox_key,
                          wait=False, **kwargs):
         args = [session, mailbox_idx, mbox, msg_mbox_key]
@@ -760,7 +1530,8 @@ class MailIndex(object):
                        mailbox_idx, mbox, msg_mbox_idx,
                        msg_ptr=None, msg_data=None, last_date=None,
                        process_new=None, apply_tags=None, stop_after=None,
-                       editable=False, event=None, progress=None):
+                       editable=False, event=None, progress=None,
+                       read_results=None):
         added = updated = 0
         msg_ptr = msg_ptr or mbox.get_msg_ptr(mailbox_idx, msg_mbox_idx)
         last_date = last_date or long(time.time())
@@ -775,9 +1546,13 @@ class MailIndex(object):
                 msg_fd = cStringIO.StringIO(msg_data)
             else:
                 msg_fd = mbox.get_file(msg_mbox_idx)
-            msg = ParseMessage(msg_fd,
-                               pgpmime=session.config.prefs.index_encrypted,
-                               config=session.config)
+            if read_results is not None:
+                # The body has already been processed, headers will do.
+                msg = email.parser.Parser().parse(msg_fd, headersonly=True)
+            else:
+                pgpmime = session.config.prefs.index_encrypted
+                msg = ParseMessage(msg_fd, pgpmime=pgpmime,
+                                   config=session.config)
         except (IOError, OSError, ValueError, IndexError, KeyError):
             if session.config.sys.debug:
                 traceback.print_exc()
@@ -794,7 +1569,8 @@ class MailIndex(object):
         else:
             msg_info = self._index_incoming_message(
                 session, msg_id, msg_ptr, msg_fd.tell(), msg,
-                last_date + 1, mailbox_idx, process_new, apply_tags)
+                last_date + 1, mailbox_idx, process_new, apply_tags,
+                read_results=read_results)
             last_date = long(msg_info[self.MSG_DATE], 36)
             added += 1
 
@@ -833,10 +1609,15 @@ class MailIndex(object):
     def _extract_info_and_index(self, session, mailbox_idx,
                                 msg_mid, msg_id,
                                 msg_size, msg, default_date,
+                                read_results=None,
                                 **index_kwargs):
         # Extract info from the message headers
         msg_ts = self._extract_date_ts(session, msg_mid, msg_id, msg,
                                        default_date)
+        if read_results is not None:
+            # Dates which need a default are never parsed in parallel,
+            # so read_results[0] is always the same as msg_ts.
+            index_kwargs['read_results'] = read_results[1:]
         msg_to = AddressHeaderParser(msg.get('to', ''))
         msg_cc = (AddressHeaderParser(msg.get('cc', '')) +
                   AddressHeaderParser(msg.get('bcc', '')))
@@ -859,14 +1640,23 @@ class MailIndex(object):
 
         return (msg_ts, msg_to, msg_cc, msg_subj, msg_body, tags)
 
+    def _add_incoming_placeholder(self, msg_ptr, msg_id, msg_size, msg,
+                                  default_date):
+        return self.add_new_msg(
+            msg_ptr, msg_id, default_date, self.hdr(msg, 'from'), [], [],
+            msg_size, _('(processing message ...)'), '', [])
+
     def _index_incoming_message(self, session,
                                 msg_id, msg_ptr, msg_size, msg, default_date,
-                                mailbox_idx, process_new, apply_tags):
+                                mailbox_idx, process_new, apply_tags,
+                                read_results=None, msg_idx_pos=None):
         # First, add the message to the index so we can index terms to
-        # the right MID.
-        msg_idx_pos, msg_info = self.add_new_msg(
-            msg_ptr, msg_id, default_date, self.hdr(msg, 'from'), [], [],
-            msg_size, _('(processing message ...)'), '', [])
+        # the right MID (parallel scans have done this already).
+        if msg_idx_pos is None:
+            msg_idx_pos, msg_info = self._add_incoming_placeholder(
+                msg_ptr, msg_id, msg_size, msg, default_date)
+        else:
+            msg_info = self.get_msg_at_idx_pos(msg_idx_pos)
         msg_mid = b36(msg_idx_pos)
 
         # Now actually go parse it and update the search index
@@ -876,6 +1666,7 @@ class MailIndex(object):
                                           default_date,
                                           process_new=process_new,
                                           apply_tags=apply_tags,
+                                          read_results=read_results,
                                           incoming=True)
 
         # Finally, update the metadata index with whatever we learned
@@ -889,6 +1680,7 @@ class MailIndex(object):
 
         self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
         self.set_conversation_ids(msg_info[self.MSG_MID], msg)
+        self.address_seen(msg_idx_pos)
         return msg_info
 
     def index_email(self, session, email):
@@ -927,109 +1719,141 @@ class MailIndex(object):
         for tag_id in tags:
             self.add_tag(session, tag_id, msg_idxs=[email.msg_idx_pos])
 
-    def set_conversation_ids(self, msg_mid, msg, subject_threading=True):
-        msg_thr_mid = None
-        refs = set((self.hdr(msg, 'references') + ' ' +
-                    self.hdr(msg, 'in-reply-to')
-                    ).replace(',', ' ').strip().split())
-        for ref_id in [self.encode_msg_id(r) for r in refs if r]:
+    #
+    # Threading: each row names the root of its thread (MSG_THREAD_MID),
+    # and self.THREADS (see mailpile.thread_index) tracks which messages
+    # are in which thread, how they reply to each other and which subjects
+    # were recently used, so none of this requires scanning or rewriting
+    # other rows. MSG_REPLIES is no longer maintained; it is only kept so
+    # the metadata format stays the same.
+    #
+    SUBJECT_THREADING_MAX_AGE = 5 * 24 * 3600
+    SUBJECT_SEED_MAX = 10000
+
+    def _seed_subject_threading(self):
+        # Note the subjects of recent messages, as subject threading will
+        # only consider those. Messages indexed from now on are noted as
+        # they are threaded.
+        self.THREADS.subjects_seeded = True
+        newest = None
+        for msg_idx in xrange(len(self.INDEX) - 1,
+                              max(-1, len(self.INDEX) - self.SUBJECT_SEED_MAX),
+                              -1):
+            msg_info = self.get_msg_at_idx_pos(msg_idx)
             try:
-                # Get conversation ID ...
-                ref_idx_pos = self.MSGIDS[ref_id]
-                msg_thr_mid = self.get_msg_at_idx_pos(ref_idx_pos
-                                                      )[self.MSG_THREAD_MID]
-                # Update root of conversation thread
-                parent = self.get_msg_at_idx_pos(int(msg_thr_mid, 36))
-                replies = parent[self.MSG_REPLIES][:-1].split(',')
-                if msg_mid not in replies:
-                    replies.append(msg_mid)
-                parent[self.MSG_REPLIES] = ','.join(replies) + ','
-                self.set_msg_at_idx_pos(int(msg_thr_mid, 36), parent)
-                break
+                date = long(msg_info[self.MSG_DATE], 36)
+                newest = max(newest or date, date)
+                if newest - date > self.SUBJECT_THREADING_MAX_AGE:
+                    break
+                self.THREADS.note_subject(
+                    ThreadIndex.SubjectKey(msg_info[self.MSG_SUBJECT]),
+                    int(msg_info[self.MSG_THREAD_MID], 36), date)
             except (KeyError, ValueError, IndexError):
                 pass
 
+    def _set_thread(self, msg_idx, thr_idx):
+        msg_info = self.get_msg_at_idx_pos(msg_idx)
+        old_mid = msg_info[self.MSG_THREAD_MID]
+        msg_info[self.MSG_THREAD_MID] = b36(thr_idx)
+        self.set_msg_at_idx_pos(msg_idx, msg_info)
+        if old_mid and old_mid != b36(thr_idx):
+            self.config.command_cache.mark_dirty(
+                [u'%s:thread' % int(old_mid, 36)])
+
+    def merge_threads(self, thr_idx, other_idx):
+        """Move all the messages of one thread into another."""
+        with self._lock:
+            for msg_idx in ([other_idx] +
+                            list(self.THREADS.get_replies(other_idx))):
+                self._set_thread(msg_idx, thr_idx)
+
+    def set_conversation_ids(self, msg_mid, msg, subject_threading=True):
         msg_idx_pos = int(msg_mid, 36)
-        msg_info = self.get_msg_at_idx_pos(msg_idx_pos)
+        in_reply_to = self.hdr(msg, 'in-reply-to').replace(',', ' ').split()
+        references = self.hdr(msg, 'references').replace(',', ' ').split()
 
-        if subject_threading and not msg_thr_mid and not refs:
-            # Can we do plain GMail style subject-based threading?
-            # FIXME: Is this too aggressive? Make configurable?
-            subj = msg_info[self.MSG_SUBJECT].lower()
-            subj = subj.replace('re: ', '').replace('fwd: ', '')
-            date = long(msg_info[self.MSG_DATE], 36)
-            if subj.strip() != '':
-                for midx in reversed(range(max(0, msg_idx_pos - 250),
-                                           msg_idx_pos)):
-                    try:
-                        m_info = self.get_msg_at_idx_pos(midx)
-                        if m_info[self.MSG_SUBJECT
-                                  ].lower().replace('re: ', '') == subj:
-                            msg_thr_mid = m_info[self.MSG_THREAD_MID]
-                            parent = self.get_msg_at_idx_pos(int(msg_thr_mid,
-                                                                 36))
-                            replies = parent[self.MSG_REPLIES][:-1].split(',')
-                            if len(replies) < 100:
-                                if msg_mid not in replies:
-                                    replies.append(msg_mid)
-                                parent[self.MSG_REPLIES] = (','.join(replies)
-                                                            + ',')
-                                self.set_msg_at_idx_pos(int(msg_thr_mid, 36),
-                                                        parent)
-                                break
-                        if date - long(m_info[self.MSG_DATE],
-                                       36) > 5 * 24 * 3600:
-                            break
-                    except (KeyError, ValueError, IndexError):
-                        pass
-
-        if not msg_thr_mid:
-            # OK, we are our own conversation root.
-            msg_thr_mid = msg_mid
-
-        msg_info[self.MSG_THREAD_MID] = msg_thr_mid
-        self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
+        # The most direct parent is the In-Reply-To, or else the last of
+        # the References. If the references span multiple threads, they
+        # all get merged into the biggest of them.
+        with self._lock:
+            parent, roots = None, []
+            for ref_id in in_reply_to + list(reversed(references)):
+                ref_idx_pos = self.MSGIDS.get(self.encode_msg_id(ref_id))
+                if ref_idx_pos is None or ref_idx_pos == msg_idx_pos:
+                    continue
+                if parent is None:
+                    parent = ref_idx_pos
+                root = self.INDEX_THR[ref_idx_pos]
+                if root >= 0 and root != msg_idx_pos and root not in roots:
+                    roots.append(root)
+
+            msg_info = self.get_msg_at_idx_pos(msg_idx_pos)
+            thr_idx = None
+            if roots:
+                thr_idx = max(roots, key=self.THREADS.thread_size)
+                for root in roots:
+                    if root != thr_idx:
+                        self.merge_threads(thr_idx, root)
+                self.THREADS.set_parent(msg_idx_pos, parent)
+
+            subject_key = ThreadIndex.SubjectKey(msg_info[self.MSG_SUBJECT])
+            try:
+                date = long(msg_info[self.MSG_DATE], 36)
+            except ValueError:
+                date = 0
+
+            if (subject_threading and thr_idx is None and
+                    not (in_reply_to or references) and subject_key):
+                # Can we do plain GMail style subject-based threading?
+                # FIXME: Is this too aggressive? Make configurable?
+                if not self.THREADS.subjects_seeded:
+                    self._seed_subject_threading()
+                thr_idx = self.THREADS.find_subject(
+                    subject_key, date, self.SUBJECT_THREADING_MAX_AGE)
+                if thr_idx is not None:
+                    thr_idx = self.INDEX_THR[thr_idx]
+                    if thr_idx == msg_idx_pos or thr_idx < 0:
+                        thr_idx = None
+
+            if thr_idx is None:
+                # OK, we are our own conversation root.
+                thr_idx = msg_idx_pos
+
+            if self.THREADS.subjects_seeded:
+                self.THREADS.note_subject(subject_key, thr_idx, date)
+            msg_info[self.MSG_THREAD_MID] = b36(thr_idx)
+            self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
 
     def unthread_message(self, msg_mid):
+        """
+        Remove a message from its thread. If the message was the root of
+        the thread, the remaining messages stay together under a new root,
+        otherwise the message and any replies to it become a new thread.
+        """
         msg_idx_pos = int(msg_mid, 36)
-        msg_info = self.get_msg_at_idx_pos(msg_idx_pos)
-        par_idx_pos = int(msg_info[self.MSG_THREAD_MID], 36)
-
-        if par_idx_pos == msg_idx_pos:
-            # Message is head of thread, chop head off!
-            thread = msg_info[self.MSG_REPLIES][:-1].split(',')
-            msg_info[self.MSG_REPLIES] = ''
-            if msg_mid in thread:
-                thread.remove(msg_mid)
-            if thread and thread[0]:
-                head_mid = thread[0]
-                head_idx_pos = int(head_mid, 36)
-                head_info = self.get_msg_at_idx_pos(head_idx_pos)
-                head_info[self.MSG_REPLIES] = ','.join(thread) + ','
-                self.set_msg_at_idx_pos(head_idx_pos, head_info)
-                for msg_mid in thread:
-                    kid_idx_pos = int(thread[0], 36)
-                    kid_info = self.get_msg_at_idx_pos(head_idx_pos)
-                    kid_info[self.MSG_THREAD_MID] = head_mid
-                    kid.set_msg_at_idx_pos(head_idx_pos, head_info)
-        else:
-            # Message is a reply, remove it from thread
-            par_info = self.get_msg_at_idx_pos(par_idx_pos)
-            thread = par_info[self.MSG_REPLIES][:-1].split(',')
-            if msg_mid in thread:
-                thread.remove(msg_mid)
-                par_info[self.MSG_REPLIES] = ','.join(thread) + ','
-                self.set_msg_at_idx_pos(par_idx_pos, par_info)
-
-        msg_info[self.MSG_THREAD_MID] = msg_mid
-        self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
+        with self._lock:
+            thr_idx = self.INDEX_THR[msg_idx_pos]
+            if thr_idx == msg_idx_pos:
+                # Message is head of thread, chop head off!
+                thread = self.get_reply_idxs(msg_idx_pos)
+                for msg_idx in thread:
+                    self._set_thread(msg_idx, thread[0])
+            else:
+                # Message is a reply, split it and its replies off
+                kids = self.THREADS.descendants(msg_idx_pos, self.INDEX_THR)
+                for msg_idx in [msg_idx_pos] + kids:
+                    self._set_thread(msg_idx, msg_idx_pos)
+            self.THREADS.unlink(msg_idx_pos)
 
     def _add_email(self, email, name=None, eid=None):
-        if eid is None:
-            eid = len(self.EMAILS)
-            self.EMAILS.append('')
-        self.EMAILS[eid] = '%s (%s)' % (email, name or email)
-        self.EMAIL_IDS[email.lower()] = eid
+        with self._lock:
+            if eid is None:
+                eid = len(self.EMAILS)
+                self.EMAILS.append('')
+            self.EMAILS[eid] = '%s (%s)' % (email, name or email)
+            self.EMAIL_IDS[email.lower()] = eid
+            if self._addresses is not None:
+                self._addresses.add(eid, self.EMAILS[eid])
         # FIXME: This needs to get written out...
         return eid
 
@@ -1082,6 +1906,88 @@ class MailIndex(object):
             self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
             return msg_idx_pos, msg_info
 
+    #
+    # Autocompletion and address searches use an AddressIndex of the
+    # EMAILS list, ranked by how often and how recently we have seen each
+    # address in visible mail (not spam, trash or anything else hidden).
+    # Building it happens in the background after loading; until it is
+    # done, address_index() returns None and callers have to make do
+    # without. The scores are saved in the checkpoint, so only messages
+    # added since then need reading. Afterwards the index is kept up to
+    # date as new e-mail addresses are added, and as messages are
+    # received or sent (but not while they are still drafts).
+    #
+    def address_index(self):
+        return self._addresses
+
+    def _address_hiding_tags(self):
+        return set(t._key for t in (self.config.get_tags(flag_hides=True) +
+                                    self.config.get_tags(type='spam')))
+
+    def address_seen(self, msg_idx_pos):
+        """Rank the addresses in a message, unless it is hidden."""
+        with self._lock:
+            ai = self._addresses
+            if ai is None:
+                return
+            msg_info = self.get_msg_at_idx_pos(msg_idx_pos)
+            if self._address_hiding_tags() & set(self.get_tags(msg_info)):
+                return
+            try:
+                self._address_seen(ai, msg_info,
+                                   int(msg_info[self.MSG_DATE], 36))
+            except (ValueError, IndexError):
+                pass
+
+    def _address_seen(self, ai, msg_info, msg_ts):
+        email = ExtractEmailAndName(msg_info[self.MSG_FROM])[0]
+        eid = self.EMAIL_IDS.get((email or '').lower())
+        if eid is not None:
+            ai.seen(eid, msg_ts)
+        for field in (self.MSG_TO, self.MSG_CC):
+            for e in msg_info[field].split(','):
+                if e:
+                    ai.seen(int(e, 36), msg_ts)
+
+    def _build_address_index(self, session):
+        ai = AddressIndex()
+        hidden = self.ID_SET()
+        for tid in self._address_hiding_tags():
+            hidden |= self.TAGS.get(tid, [])
+
+        emails = len(self.EMAILS)
+        ai.add_many((eid, self.EMAILS[eid]) for eid in xrange(0, emails))
+
+        # Start with the scores from the checkpoint, if we have them
+        first, scores = self._address_scores or (0, [])
+        for eid, score in enumerate(scores[:emails]):
+            ai.set_rank(eid, score)
+
+        rows = len(self.INDEX)
+        for msg_idx in xrange(first, rows):
+            if mailpile.util.QUITTING:
+                return
+            if msg_idx % 1000 == 0:
+                play_nice_with_threads()
+            if msg_idx not in hidden:
+                msg_info = self.get_msg_at_idx_pos(msg_idx)
+                try:
+                    self._address_seen(ai, msg_info,
+                                       int(msg_info[self.MSG_DATE], 36))
+                except (ValueError, IndexError):
+                    pass
+
+        # Catch up with whatever changed while we were busy
+        with self._lock:
+            for eid in xrange(0, len(self.EMAILS)):
+                if eid >= emails or self.EMAILS[eid].lower() != ai.text[eid]:
+                    ai.add(eid, self.EMAILS[eid])
+            self._addresses = ai
+            for msg_idx in xrange(rows, len(self.INDEX)):
+                self.address_seen(msg_idx)
+            ai.rerank()
+            self._address_scores = None
+
     def filter_keywords(self, session, msg_mid, msg, keywords, incoming=True):
         keywordmap = {}
         msg_idx_list = [msg_mid]
@@ -1122,128 +2028,247 @@ class MailIndex(object):
                 else:
                     self.add_tag(session, tag_id, msg_idxs=set(msg_idxs))
 
-    def read_message(self, session,
-                     msg_mid, msg_id, msg, msg_size, msg_ts,
-                     mailbox=None):
-        keywords = []
-        snippet_text = snippet_html = ''
-        body_info = {}
-        payload = [None]
-        textparts = 0
+    ##[ Keyword extraction ]#################################################
+    #
+    # Reading a message for the index happens in stages:
+    #
+    #   1. decode:    walk the MIME tree once, noting each part's type,
+    #                 charset and attachment name (payloads are decoded
+    #                 lazily, at most once per part),
+    #   2. normalise: turn text parts into plain text; HTML is parsed once
+    #                 per part, and style and script elements are dropped,
+    #   3. tokenise:  split the text and headers into words, using the
+    #                 same Tokenizer as searches do, minus the stoplist,
+    #   4. plugins:   run the text, data and meta keyword extractors.
+    #
+    # The time spent in each stage is added up in self.extraction_timing,
+    # as (count, seconds) pairs, and logged per message if 'timing' is in
+    # sys.debug.
+    #
+    # When a multipart/alternative has a substantial text/plain version,
+    # the HTML version usually says the same thing with a lot more markup.
+    # Usually, but not always, so by default it is indexed too (the words
+    # end up in the same keyword set, so duplicates cost nothing). Setting
+    # prefs.index_skip_html skips parsing it, which is where most of the
+    # time went for newsletters.
+    #
+    HTML_ALTERNATIVE_MIN_TEXT = 256
+    HTML_SNIFF = ('<di', '<ht', '<p>', '<p ')
+    HTML_STRIP_ELEMENTS = ('script', 'style')
+
+    class _Part(object):
+        __slots__ = ('part', 'ctype', 'charset', 'att', 'alt', 'text',
+                     '_payload')
+
+        def __init__(self, part, ctype, charset, att, alt):
+            self.part, self.ctype, self.charset = part, ctype, charset
+            self.att, self.alt = att, alt
+            self.text = self._payload = None
+
+        def payload(self):
+            if self._payload is None:
+                self._payload = MailIndex.try_decode(
+                    self.part.get_payload(None, True), self.charset)
+            return self._payload
+
+    def tokenizer(self):
+        """Return the Tokenizer used for both indexing and searching."""
+        stemmer = (self.config.prefs.get('index_stemmer') or '').lower()
+        if self._tokenizer is None or self._tokenizer.stemmer_name != stemmer:
+            self._tokenizer = Tokenizer(stemmer=stemmer)
+        return self._tokenizer
+
+    @classmethod
+    def html_to_text(self, html):
+        """
+        Convert HTML to plain text, ignoring scripts and style sheets.
+
+        >>> MailIndex.html_to_text('<html><head><style>p {}</style></head>'
+        ...                        '<body><p>Hello <b>world</b></p></body>')
+        'Hello world'
+        """
+        tree = lxml.html.fromstring(html)
+        lxml.etree.strip_elements(tree, *self.HTML_STRIP_ELEMENTS,
+                                  with_tail=False)
+        return tree.text_content()
+
+    def _stage_done(self, stage, t0, times):
+        t1 = time.time()
+        count, elapsed = self.extraction_timing.get(stage, (0, 0.0))
+        self.extraction_timing[stage] = (count + 1, elapsed + t1 - t0)
+        times.append((stage, t1 - t0))
+        return t1
+
+    def _decode_parts(self, msg, keywords):
+        parts, alternatives = [], {}
         for part in msg.walk():
-            textpart = payload[0] = None
             ctype = part.get_content_type()
+            if ctype == 'multipart/alternative':
+                for sub in part.get_payload():
+                    alternatives[id(sub)] = part
+            if 'pgp' in ctype:
+                keywords.add('pgp:has')
+                keywords.add('crypto:has')
             charset = part.get_content_charset() or 'utf-8'
+            att = part.get_filename()
+            if att:
+                att = self.try_decode(att, charset)
+            parts.append(self._Part(part, ctype, charset, att,
+                                    alternatives.get(id(part))))
+        return parts
 
-            def _loader(p):
-                if payload[0] is None:
-                    payload[0] = self.try_decode(p.get_payload(None, True),
-                                                 charset)
-                return payload[0]
-
-            if ctype == 'text/plain':
-                textpart = _loader(part)
-                if textpart[:3] in ('<di', '<ht', '<p>', '<p '):
-                    ctype = 'text/html'
+    def _normalise_parts(self, session, msg_mid, msg_id, parts):
+        textparts = 0
+        plain_alternatives = set()
+        skip_html = self.config.prefs.get('index_skip_html', False)
+        for p in parts:
+            if p.ctype == 'text/plain':
+                text = p.payload()
+                if text[:3] in self.HTML_SNIFF:
+                    p.ctype = 'text/html'
                 else:
+                    p.text = text
                     textparts += 1
+                    if (p.alt is not None and
+                            len(text.strip()) >= self.HTML_ALTERNATIVE_MIN_TEXT):
+                        plain_alternatives.add(id(p.alt))
 
-            if ctype == 'text/html':
-                _loader(part)
-                if len(payload[0]) > 3:
-                    try:
-                        textpart = lxml.html.fromstring(payload[0]
-                                                        ).text_content()
-                    except:
-                        session.ui.warning(_('=%s/%s has bogus HTML.'
-                                             ) % (msg_mid, msg_id))
-                        textpart = payload[0]
-                else:
-                    textpart = payload[0]
-
-            if 'pgp' in part.get_content_type().lower():
-                keywords.append('pgp:has')
-                keywords.append('crypto:has')
+        for p in parts:
+            if p.ctype != 'text/html':
+                continue
+            if skip_html and id(p.alt) in plain_alternatives:
+                continue
+            html = p.payload()
+            if len(html) > 3:
+                try:
+                    p.text = self.html_to_text(html)
+                except:
+                    session.ui.warning(_('=%s/%s has bogus HTML.'
+                                         ) % (msg_mid, msg_id))
+                    p.text = html
+            else:
+                p.text = html
+        return textparts
 
-            att = part.get_filename()
-            if att:
-                att = self.try_decode(att, charset)
+    def _tokenise_parts(self, tok, parts, keywords):
+        for p in parts:
+            if p.att:
                 # FIXME: These should be tags!
-                keywords.append('attachment:has')
-                keywords.extend([t + ':att' for t
-                                 in re.findall(WORD_REGEXP, att.lower())])
-                textpart = (textpart or '') + ' ' + att
+                keywords.add('attachment:has')
+                keywords.update(t + ':att' for t
+                                in tok.tokenize(p.att, stem=False))
+                keywords.update(tok.tokenize(p.att))
+            if p.text:
+                keywords.update(tok.tokenize(p.text))
+
+    def _tokenise_headers(self, tok, msg, msg_id, mailbox, keywords):
+        # Only bare words get stemmed, the header:value keywords are
+        # searched for with the value folded but otherwise as typed.
+        charset = msg.get_content_charset() or 'utf-8'
+        keywords.add('%s:id' % msg_id)
+        keywords.update(tok.tokenize(self.hdr(msg, 'subject',
+                                              charset=charset)))
+        keywords.update(tok.tokenize(self.hdr(msg, 'from',
+                                              charset=charset)))
+        if mailbox:
+            keywords.add('%s:mailbox' % FormatMbxId(mailbox).lower())
+        keywords.add('%s:hp' % HeaderPrint(msg))
 
-            if textpart:
-                # FIXME: Does this lowercase non-ASCII characters correctly?
-                keywords.extend(re.findall(WORD_REGEXP, textpart.lower()))
+        seen = set()
+        for key in msg.keys():
+            key_lower = key.lower()
+            if key_lower in BORING_HEADERS or key_lower in seen:
+                continue
+            seen.add(key_lower)
+            value = self.hdr(msg, key, charset=charset).lower()
+            emails = ExtractEmails(value)
+            words = tok.tokenize(value, stem=False)
+            keywords.update('%s:%s' % (t, key_lower) for t in words)
+            keywords.update('%s:%s' % (e, key_lower) for e in emails)
+            keywords.update('%s:email' % e for e in emails)
+            if 'list' in key_lower:
+                keywords.update('%s:list' % t for t in words)
+        for key in EXPECTED_HEADERS:
+            if not msg[key]:
+                keywords.add('%s:missing' % key)
 
+    def _extract_from_parts(self, msg, parts, keywords):
+        snippet_text = snippet_html = ''
+        text_kw_extractors = _plugins.get_text_kw_extractors()
+        data_kw_extractors = _plugins.get_data_kw_extractors()
+        for p in parts:
+            textpart = p.text
+            if p.att:
+                textpart = (textpart or '') + ' ' + p.att
+            if textpart:
                 # NOTE: As a side effect here, the cryptostate plugin will
                 #       add a 'crypto:has' keyword which we check for below
                 #       before performing further processing.
-                for kwe in _plugins.get_text_kw_extractors():
-                    keywords.extend(kwe(self, msg, ctype, textpart))
+                for kwe in text_kw_extractors:
+                    keywords.update(kwe(self, msg, p.ctype, textpart))
 
-                if ctype == 'text/plain':
+                if p.ctype == 'text/plain':
                     snippet_text += textpart.strip() + '\n'
                 else:
                     snippet_html += textpart.strip() + '\n'
 
-            for extract in _plugins.get_data_kw_extractors():
-                keywords.extend(extract(self, msg, ctype, att, part,
-                                        lambda: _loader(part)))
+            for extract in data_kw_extractors:
+                keywords.update(extract(self, msg, p.ctype, p.att, p.part,
+                                        p.payload))
+        return snippet_text, snippet_html
+
+    def _extract_encrypted(self, session, msg, keywords):
+        e = Email(self, -1,
+                  msg_parsed=msg,
+                  msg_parsed_pgpmime=msg,
+                  msg_info=self.BOGUS_METADATA[:])
+        tree = e.get_message_tree(want=(e.WANT_MSG_TREE_PGP +
+                                        ('text_parts', )))
+
+        # Look for inline PGP parts, update our status if found
+        e.evaluate_pgp(tree, decrypt=session.config.prefs.index_encrypted,
+                             crypto_state_feedback=False)
+        msg.signature_info = tree['crypto']['signature']
+        msg.encryption_info = tree['crypto']['encryption']
+
+        # Index the contents, if configured to do so
+        if session.config.prefs.index_encrypted:
+            for text in [t['data'] for t in tree['text_parts']]:
+                keywords.update(self.tokenizer().tokenize(text))
+                for kwe in _plugins.get_text_kw_extractors():
+                    keywords.update(kwe(self, msg, 'text/plain', text))
+
+    def read_message(self, session,
+                     msg_mid, msg_id, msg, msg_size, msg_ts,
+                     mailbox=None):
+        keywords = set()
+        body_info = {}
+        times = []
+        t0 = time.time()
 
-        if textparts == 0:
-            keywords.append('text:missing')
+        parts = self._decode_parts(msg, keywords)
+        t0 = self._stage_done('decode', t0, times)
 
-        if 'crypto:has' in keywords:
-            e = Email(self, -1,
-                      msg_parsed=msg,
-                      msg_parsed_pgpmime=msg,
-                      msg_info=self.BOGUS_METADATA[:])
-            tree = e.get_message_tree(want=(e.WANT_MSG_TREE_PGP +
-                                            ('text_parts', )))
-
-            # Look for inline PGP parts, update our status if found
-            e.evaluate_pgp(tree, decrypt=session.config.prefs.index_encrypted,
-                                 crypto_state_feedback=False)
-            msg.signature_info = tree['crypto']['signature']
-            msg.encryption_info = tree['crypto']['encryption']
-
-            # Index the contents, if configured to do so
-            if session.config.prefs.index_encrypted:
-                for text in [t['data'] for t in tree['text_parts']]:
-                    keywords.extend(re.findall(WORD_REGEXP, text.lower()))
-                    for kwe in _plugins.get_text_kw_extractors():
-                        keywords.extend(kwe(self, msg, 'text/plain', text))
-
-        keywords.append('%s:id' % msg_id)
-        keywords.extend(re.findall(WORD_REGEXP,
-                                   self.hdr(msg, 'subject').lower()))
-        keywords.extend(re.findall(WORD_REGEXP,
-                                   self.hdr(msg, 'from').lower()))
-        if mailbox:
-            keywords.append('%s:mailbox' % FormatMbxId(mailbox).lower())
-        keywords.append('%s:hp' % HeaderPrint(msg))
+        if self._normalise_parts(session, msg_mid, msg_id, parts) == 0:
+            keywords.add('text:missing')
+        t0 = self._stage_done('normalise', t0, times)
 
-        for key in msg.keys():
-            key_lower = key.lower()
-            if key_lower not in BORING_HEADERS:
-                emails = ExtractEmails(self.hdr(msg, key).lower())
-                words = set(re.findall(WORD_REGEXP,
-                                       self.hdr(msg, key).lower()))
-                words -= STOPLIST
-                keywords.extend(['%s:%s' % (t, key_lower) for t in words])
-                keywords.extend(['%s:%s' % (e, key_lower) for e in emails])
-                keywords.extend(['%s:email' % e for e in emails])
-                if 'list' in key_lower:
-                    keywords.extend(['%s:list' % t for t in words])
-        for key in EXPECTED_HEADERS:
-            if not msg[key]:
-                keywords.append('%s:missing' % key)
+        tok = self.tokenizer()
+        self._tokenise_parts(tok, parts, keywords)
+        self._tokenise_headers(tok, msg, msg_id, mailbox, keywords)
+        t0 = self._stage_done('tokenise', t0, times)
 
+        snippet_text, snippet_html = self._extract_from_parts(msg, parts,
+                                                              keywords)
+        if 'crypto:has' in keywords:
+            self._extract_encrypted(session, msg, keywords)
         for extract in _plugins.get_meta_kw_extractors():
-            keywords.extend(extract(self, msg_mid, msg, msg_size, msg_ts))
+            keywords.update(extract(self, msg_mid, msg, msg_size, msg_ts))
+        t0 = self._stage_done('plugins', t0, times)
+
+        if 'timing' in self.config.sys.debug:
+            session.ui.debug('Read =%s: %s' % (msg_mid, ', '.join(
+                '%s=%.1fms' % (s, 1000 * e) for s, e in times)))
 
         # FIXME: Allow plugins to augment the body_info
 
@@ -1252,7 +2277,7 @@ class MailIndex(object):
         else:
             body_info['snippet'] = self.clean_snippet(snippet_html[:1024])
 
-        return (set(keywords) - STOPLIST), body_info
+        return (keywords - STOPLIST), body_info
 
     # FIXME: Here it would be nice to recognize more boilerplate junk in
     #        more languages!
@@ -1275,11 +2300,15 @@ class MailIndex(object):
 
     def index_message(self, session, msg_mid, msg_id, msg, msg_size, msg_ts,
                       mailbox=None, compact=True, filter_hooks=None,
-                      process_new=None, apply_tags=None, incoming=False):
-        keywords, snippet = self.read_message(session,
-                                              msg_mid, msg_id, msg,
-                                              msg_size, msg_ts,
-                                              mailbox=mailbox)
+                      process_new=None, apply_tags=None, incoming=False,
+                      read_results=None):
+        if read_results is not None:
+            keywords, snippet = read_results
+        else:
+            keywords, snippet = self.read_message(session,
+                                                  msg_mid, msg_id, msg,
+                                                  msg_size, msg_ts,
+                                                  mailbox=mailbox)
 
         # Apply the defaults for this mail source / mailbox.
         if apply_tags:
@@ -1302,54 +2331,80 @@ class MailIndex(object):
         if 'keywords' in self.config.sys.debug:
             print 'KEYWORDS: %s' % keywords
 
-        for word in keywords:
-            if (word.startswith('__') or
-                    # Tags are now handled outside the posting lists
-                    word.endswith(':tag') or word.endswith(':in')):
-                continue
-            try:
-                GlobalPostingList.Append(session, word, [msg_mid],
-                                         compact=compact)
-            except UnicodeDecodeError:
-                # FIXME: we just ignore garbage
-                pass
+        words = [w for w in keywords if not (
+            w.startswith('__') or
+            # Tags are now handled outside the posting lists
+            w.endswith(':tag') or w.endswith(':in'))]
+        if self._kw_batching > 0:
+            self._kw_batch.add(words, msg_mid)
+        else:
+            for word in words:
+                try:
+                    GlobalPostingList.Append(session, word, [msg_mid],
+                                             compact=compact)
+                except UnicodeDecodeError:
+                    # FIXME: we just ignore garbage
+                    pass
 
         self.config.command_cache.mark_dirty(set([u'mail:all']) | keywords)
         return keywords, snippet
 
+    def forget_keywords(self, session, msg_idxs):
+        """Remove a set of (deleted) messages from keyword searches."""
+        GlobalPostingList.Delete(session, msg_idxs)
+        self.config.command_cache.mark_dirty(
+            [u'mail:all'] + [u'%s:msg' % i for i in msg_idxs])
+        CachedSearchResultSet.DropCaches(msg_idxs=msg_idxs)
+
     def get_msg_at_idx_pos(self, msg_idx):
         try:
-            rv = self.CACHE.get(msg_idx)
-            if rv is None:
-                if len(self.CACHE) > 20000:
-                    self.CACHE = {}
-                rv = self.CACHE[msg_idx] = self.l2m(self.INDEX[msg_idx])
-            if len(rv) != self.MSG_FIELDS_V2:
+            rv = self.INDEX.get_row(msg_idx)
+            if not rv or len(rv) != self.MSG_FIELDS_V2:
                 raise ValueError()
             return rv
         except (IndexError, ValueError):
             return self.BOGUS_METADATA[:]
 
     def update_msg_sorting(self, msg_idx, msg_info):
-        for order, sorter in self.SORT_ORDERS.iteritems():
-            self.INDEX_SORT[order][msg_idx] = sorter(self, msg_info)
-
-    def set_msg_at_idx_pos(self, msg_idx, msg_info, original_line=None):
         with self._lock:
-            while len(self.INDEX) <= msg_idx:
+            for order, sorter in self.SORT_ORDERS.iteritems():
+                keys = self.INDEX_SORT[order]
+                key = sorter(self, msg_info)
+                perm = self._sort_perms.get(order)
+                if perm is None:
+                    keys[msg_idx] = key
+                    continue
+                text = None
+                if order in self.SORT_TEXT:
+                    text = self.SORT_TEXT[order](self, msg_info)
+                if keys[msg_idx] == key and (text is None or
+                        self._perm_in_place(order, msg_idx, text)):
+                    continue
+                del perm[self._perm_find(order, msg_idx)]
+                keys[msg_idx] = key
+                perm.insert(self._perm_pos(order, msg_idx, text), msg_idx)
+                self._sort_gen += 1
+
+    def _grow_index(self, size):
+        with self._lock:
+            while len(self.INDEX) < size:
                 self.INDEX.append('')
                 self.INDEX_THR.append(-1)
                 for order in self.INDEX_SORT:
                     self.INDEX_SORT[order].append(0)
+                    perm = self._sort_perms.get(order)
+                    if perm is not None:
+                        msg_pos = len(self.INDEX_SORT[order]) - 1
+                        perm.insert(self._perm_pos(order, msg_pos, u''),
+                                    msg_pos)
+                        self._sort_gen += 1
+
+    def set_msg_at_idx_pos(self, msg_idx, msg_info, original_line=None):
+        self._grow_index(msg_idx + 1)
 
         msg_thr_mid = msg_info[self.MSG_THREAD_MID]
         self.INDEX[msg_idx] = original_line or self.m2l(msg_info)
-        self.INDEX_THR[msg_idx] = int(msg_thr_mid, 36)
-        self.MSGIDS[msg_info[self.MSG_ID]] = msg_idx
-        for msg_ptr in msg_info[self.MSG_PTRS].split(','):
-            self.PTRS[msg_ptr] = msg_idx
-        self.update_msg_sorting(msg_idx, msg_info)
-        self.update_msg_tags(msg_idx, msg_info)
+        self._update_msg_lookups(msg_idx, msg_info)
 
         if not original_line:
             dirty_tags = [u'%s:in' % self.config.tags[t].slug for t in
@@ -1359,10 +2414,16 @@ class MailIndex(object):
                  u'%s:thread' % int(msg_thr_mid, 36)] + dirty_tags)
             CachedSearchResultSet.DropCaches(msg_idxs=[msg_idx])
             self.MODIFIED.add(msg_idx)
-            try:
-                del self.CACHE[msg_idx]
-            except KeyError:
-                pass
+
+    def _update_msg_lookups(self, msg_idx, msg_info):
+        thr_idx = int(msg_info[self.MSG_THREAD_MID], 36)
+        self.THREADS.move(msg_idx, self.INDEX_THR[msg_idx], thr_idx)
+        self.INDEX_THR[msg_idx] = thr_idx
+        self.MSGIDS[msg_info[self.MSG_ID]] = msg_idx
+        for msg_ptr in msg_info[self.MSG_PTRS].split(','):
+            self.PTRS[msg_ptr] = msg_idx
+        self.update_msg_sorting(msg_idx, msg_info)
+        self.update_msg_tags(msg_idx, msg_info)
 
     def get_conversation(self, msg_info=None, msg_idx=None):
         if not msg_info:
@@ -1375,10 +2436,18 @@ class MailIndex(object):
             return [msg_info]
 
     def get_replies(self, msg_info=None, msg_idx=None):
-        if not msg_info:
-            msg_info = self.get_msg_at_idx_pos(msg_idx)
-        return [self.get_msg_at_idx_pos(int(r, 36)) for r
-                in msg_info[self.MSG_REPLIES].split(',') if r]
+        if msg_idx is None:
+            msg_idx = int(msg_info[self.MSG_MID], 36)
+        return [self.get_msg_at_idx_pos(r) for r
+                in self.get_reply_idxs(msg_idx)]
+
+    def get_reply_idxs(self, msg_idx):
+        """Return the index positions of the replies to a thread, by date."""
+        with self._lock:
+            replies = list(self.THREADS.get_replies(msg_idx))
+            dates = self.INDEX_SORT['date']
+            replies.sort(key=lambda r: (dates[r], r))
+        return replies
 
     def get_tags(self, msg_info=None, msg_idx=None):
         if not msg_info:
@@ -1425,9 +2494,9 @@ class MailIndex(object):
                 eids.add(msg_idx)
         with self._lock:
             if tag_id in self.TAGS:
-                self.TAGS[tag_id] |= eids
+                self.TAGS[tag_id].update(eids)
             elif eids:
-                self.TAGS[tag_id] = eids
+                self.TAGS[tag_id] = self.ID_SET(eids)
         try:
             self.config.command_cache.mark_dirty(
                 [u'mail:all', u'%s:in' % self.config.tags[tag_id].slug] +
@@ -1478,7 +2547,7 @@ class MailIndex(object):
                 eids.add(msg_idx)
         with self._lock:
             if tag_id in self.TAGS:
-                self.TAGS[tag_id] -= eids
+                self.TAGS[tag_id].difference_update(eids)
         try:
             self.config.command_cache.mark_dirty(
                 [u'%s:in' % self.config.tags[tag_id].slug] +
@@ -1488,27 +2557,82 @@ class MailIndex(object):
             pass
         return removed
 
-    def search_tag(self, session, term, hits, recursion=0):
+    def _tag_keywords(self, term):
+        # Returns the keywords for a tag and its subtags, and its magic
+        # search terms (if any).
         t = term.split(':', 1)
         tag_id, tag = t[1], self.config.get_tag(t[1])
-        results = []
-        if tag:
-            tag_id = tag._key
-            for subtag in self.config.get_tags(parent=tag_id):
-                results.extend(hits('%s:in' % subtag._key))
-            if tag.magic_terms and recursion < 5:
-                results.extend(self.search(session, [tag.magic_terms],
-                                           recursion=recursion+1).as_set())
-        results.extend(hits('%s:in' % tag_id))
+        if not tag:
+            return ['%s:in' % tag_id], None
+        return (['%s:in' % tag._key] +
+                ['%s:in' % subtag._key
+                 for subtag in self.config.get_tags(parent=tag._key)],
+                tag.magic_terms)
+
+    def search_tag(self, session, term, hits, recursion=0):
+        keywords, magic_terms = self._tag_keywords(term)
+        results = self.ID_SET.Coerce(hits(keywords[0]))
+        for keyword in keywords[1:]:
+            results = results | hits(keyword)
+        if magic_terms and recursion < 5:
+            results = results | self.search(session, [magic_terms],
+                                            recursion=recursion+1
+                                            ).as_ids()
         return results
 
+    def _word_keywords(self, word):
+        # Search terms go through the same tokenizer as the indexed text,
+        # a term which splits into more than one word (CJK bigrams, mostly)
+        # matches messages containing all of them.
+        return [w for w in self.tokenizer().words(word) if w not in STOPLIST]
+
+    def _value_keywords(self, value, suffix):
+        tok = self.tokenizer()
+        if '@' not in value and tok.is_segmented(value):
+            words = tok.words(value, stem=False)
+        else:
+            words = [tok.fold(value)]
+        return ['%s:%s' % (w, suffix) for w in words]
+
+    def _plan_term(self, session, term, recursion):
+        # Turn a single (lowercased) search term into a query plan node;
+        # see mailpile.query_plan.
+        if term.startswith('body:'):
+            return KeywordNode(term, self._word_keywords(term[5:]),
+                               self.ID_SET)
+        elif term == 'all:mail':
+            return TermNode(term, lambda hits: self.ALL_SET(len(self.INDEX)),
+                            estimate=lambda e: len(self.INDEX),
+                            cost=COST_CHEAP)
+        elif term.startswith('in:'):
+            keywords, magic_terms = self._tag_keywords(term)
+            if magic_terms:
+                estimate, cost = None, COST_EXPENSIVE
+            else:
+                estimate, cost = (lambda e: sum(e(k) for k in keywords),
+                                  COST_CHEAP)
+            return TermNode(term,
+                            lambda hits: self.search_tag(session, term, hits,
+                                                         recursion=recursion),
+                            estimate=estimate, cost=cost)
+        elif ':' in term:
+            t = term.split(':', 1)
+            fnc = _plugins.get_search_term(t[0])
+            if fnc:
+                return TermNode(term, lambda hits: self.ID_SET.Coerce(
+                    fnc(self.config, self, term, hits)))
+            return KeywordNode(term, self._value_keywords(t[1], t[0]),
+                               self.ID_SET)
+        return KeywordNode(term, self._word_keywords(term), self.ID_SET)
+
     def search(self, session, searchterms,
-               keywords=None, order=None, recursion=0, context=None):
+               keywords=None, order=None, recursion=0, context=None,
+               explain=None):
         # Stash the raw search terms, decide if this is cached or not
         raw_terms = searchterms[:]
         if keywords is None:
             srs = CachedSearchResultSet(self, raw_terms)
-            if len(srs) > 0:
+            if len(srs) > 0 and explain is None:
                 return srs
         else:
             srs = SearchResultSet(self, raw_terms, [], [])
@@ -1516,15 +2640,32 @@ class MailIndex(object):
         # Choose how we are going to search
         if keywords is not None:
             def hits(term):
-                return [int(h, 36) for h in keywords.get(term, [])]
+                return self.ID_SET([int(h, 36)
+                                    for h in keywords.get(term, [])])
+
+            def estimate(term):
+                return len(keywords.get(term, []))
         else:
+            plists = {}
+
+            def plist(term):
+                if term not in plists:
+                    plists[term] = GlobalPostingList(session, term)
+                return plists[term]
+
             def hits(term):
                 if term.endswith(':in'):
-                    return self.TAGS.get(term.rsplit(':', 1)[0], [])
+                    return self.TAGS.get(term.rsplit(':', 1)[0],
+                                         self.ID_SET())
                 else:
                     session.ui.mark(_('Searching for %s') % term)
-                    return [int(h, 36) for h
-                            in GlobalPostingList(session, term).hits()]
+                    return self.ID_SET.Coerce(plist(term).hits())
+
+            def estimate(term):
+                if term.endswith(':in'):
+                    return len(self.TAGS.get(term.rsplit(':', 1)[0], []))
+                else:
+                    return plist(term).estimate()
 
         # Replace some GMail-compatible terms with what we really use
         if 'tags' in self.config:
@@ -1544,12 +2685,15 @@ class MailIndex(object):
             searchterms[:0] = ['all:mail']
 
         if context:
-            r = [(None, set(context))]
+            plan = [(None, TermNode(_('(context)'),
+                                    lambda hits: self.ID_SET(context),
+                                    estimate=lambda e: len(context),
+                                    cost=COST_CHEAP))]
         else:
-            r = []
+            plan = []
 
         for term in searchterms:
-            if term in STOPLIST:
+            if term.lower() in STOPLIST:
                 if session:
                     session.ui.warning(_('Ignoring common word: %s') % term)
                 continue
@@ -1559,43 +2703,19 @@ class MailIndex(object):
                 term = term[1:]
             else:
                 op = None
+            plan.append((op, self._plan_term(session, term.lower(),
+                                             recursion)))
 
-            r.append((op, []))
-            rt = r[-1][1]
-            term = term.lower()
-
-            if ':' in term:
-                if term.startswith('body:'):
-                    rt.extend(hits(term[5:]))
-                elif term == 'all:mail':
-                    rt.extend(range(0, len(self.INDEX)))
-                elif term.startswith('in:'):
-                    rt.extend(self.search_tag(session, term, hits,
-                                              recursion=recursion))
-                else:
-                    t = term.split(':', 1)
-                    fnc = _plugins.get_search_term(t[0])
-                    if fnc:
-                        rt.extend(fnc(self.config, self, term, hits))
-                    else:
-                        rt.extend(hits('%s:%s' % (t[1], t[0])))
-            else:
-                rt.extend(hits(term))
-
-        if r:
-            results = set(r[0][1])
-            for (op, rt) in r[1:]:
-                if op == '+':
-                    results |= set(rt)
-                elif op == '-':
-                    results -= set(rt)
-                else:
-                    results &= set(rt)
+        if plan:
+            plan = QueryPlan(plan)
+            results = plan.evaluate(hits, estimate)
             # Sometimes the scan gets aborted...
             if keywords is None:
-                results -= set([len(self.INDEX)])
+                results = results - [len(self.INDEX)]
+            if explain is not None:
+                explain.extend(plan.explain())
         else:
-            results = set()
+            results = self.ID_SET()
 
         # Unless we are searching for invisible things, remove them from
         # results by default.
@@ -1617,7 +2737,7 @@ class MailIndex(object):
                 exclude_terms = ([exclude_terms[0]] +
                                  ['+%s' % e for e in exclude_terms[1:]])
             # Recursing to pull the excluded terms from cache as well
-            exclude = self.search(session, exclude_terms).as_set()
+            exclude = self.search(session, exclude_terms).as_ids()
 
         srs.set_results(results, exclude)
         if session:
@@ -1637,26 +2757,271 @@ class MailIndex(object):
                 return ts + self.FRESHNESS_SORT_BOOST
         return ts
 
+    SORT_KEY_VERSION = 2
+    SORT_KEY_BYTES = 6  # Keys are stored as doubles
+    SUBJECT_PREFIX_RE = re.compile(r'^\s*((re|fwd?|aw|sv)\s*:\s*)+',
+                                   flags=re.IGNORECASE)
+
+    @classmethod
+    def _text_sort_key(cls, text):
+        """
+        Pack the first few bytes of a (folded) string into an int, so text
+        sorts are as cheap to store as dates. UTF-8 sorts the same way as
+        the code points it encodes, so keys never contradict the text;
+        ties are broken by comparing the full text, see _sort_text.
+
+        >>> key = MailIndex._text_sort_key
+        >>> zhuk, yabl = u'\\u0436\\u0443\\u043a', u'\\u044f\\u0431\\u043b'
+        >>> key(u'ab') < key(u'abc') < key(u'b') < key(zhuk) < key(yabl)
+        True
+        >>> key(yabl) < key(u'\\u65e5\\u672c'), key(u'\\u65e5') > 0
+        (True, True)
+        """
+        text = text.encode('utf-8')[:cls.SORT_KEY_BYTES]
+        return int(text.ljust(cls.SORT_KEY_BYTES, '\0').encode('hex'), 16)
+
+    def _subject_text(self, msg_info):
+        subject = self.SUBJECT_PREFIX_RE.sub('', msg_info[self.MSG_SUBJECT])
+        return self.tokenizer().fold(subject.strip())
+
+    def _from_text(self, msg_info):
+        return self.tokenizer().fold(
+            msg_info[self.MSG_FROM].lstrip('"\'').strip())
+
+    def _subject_sorter(self, msg_info):
+        return self._text_sort_key(self._subject_text(msg_info))
+
+    def _from_sorter(self, msg_info):
+        return self._text_sort_key(self._from_text(msg_info))
+
     FRESHNESS_SORT_BOOST = (5 * 24 * 3600)
     SORT_ORDERS = {
         'freshness': _freshness_sorter,
         'date': lambda s, mi: long(mi[s.MSG_DATE], 36),
-# FIXME: The following are disabled for now for being memory hogs
-#       'from': lambda s, mi: s.mi[s.MSG_FROM]),
-#       'subject': lambda s, mi: s.mi[s.MSG_SUBJECT]),
+        'from': _from_sorter,
+        'subject': _subject_sorter,
+        'size': lambda s, mi: long(mi[s.MSG_KB], 36),
+    }
+    SORT_TEXT = {
+        'from': _from_text,
+        'subject': _subject_text,
     }
 
     def _prepare_sorting(self):
         self._sort_freshness_tags = [tag._key for tag in
                                      self.config.get_tags(type='unread')]
         self.INDEX_SORT = {}
+        self._sort_perms = {}
+        self._sort_gen = 0
         for order, sorter in self.SORT_ORDERS.iteritems():
-            self.INDEX_SORT[order] = []
+            self.INDEX_SORT[order] = array('d')
+
+    #
+    # For each sort order we keep an array of numeric sort keys, indexed by
+    # message, and (once somebody has sorted by it) a permutation listing
+    # all the messages in order. The permutation is maintained
+    # incrementally as messages are added or change, and is saved in the
+    # checkpoint, so sorting a large result set is just a walk over the
+    # permutation, picking out the results.
+    #
+    # Messages are ordered by key, then for the text orders (SORT_TEXT) by
+    # the full folded text, then by index position. Keys of text orders
+    # are only prefixes, so the text gets read for messages with equal
+    # keys, and only those.
+    #
+    # Every change to a permutation bumps _sort_gen, so walks over it can
+    # tell they need to find their place again.
+    #
+    PERM_CHUNK = 1024
+
+    def _sort_text(self, order, msg_idx):
+        msg_info = self.INDEX.get_row(msg_idx)
+        if not msg_info or len(msg_info) != self.MSG_FIELDS_V2:
+            return u''
+        return self.SORT_TEXT[order](self, msg_info)
+
+    def _perm_pos(self, order, msg_idx, text=None):
+        # Where a message belongs in a permutation it is not in
+        keys, perm = self.INDEX_SORT[order], self._sort_perms[order]
+        key, lo, hi = keys[msg_idx], 0, len(perm)
+        texts = order in self.SORT_TEXT
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pidx = perm[mid]
+            pkey = keys[pidx]
+            if pkey == key and texts:
+                if text is None:
+                    text = self._sort_text(order, msg_idx)
+                less = (self._sort_text(order, pidx), pidx) < (text, msg_idx)
+            else:
+                less = (pkey < key) or (pkey == key and pidx < msg_idx)
+            if less:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _perm_bound(self, order, key, upper=False):
+        # The first position with a key not less than (or, if upper, more
+        # than) the one given.
+        keys, perm = self.INDEX_SORT[order], self._sort_perms[order]
+        lo, hi = 0, len(perm)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pkey = keys[perm[mid]]
+            if pkey < key or (upper and pkey == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _perm_find(self, order, msg_idx):
+        # Where a message is in a permutation: search for the run of
+        # messages with the same key, then within that.
+        key, perm = self.INDEX_SORT[order][msg_idx], self._sort_perms[order]
+        lo = self._perm_bound(order, key)
+        hi = self._perm_bound(order, key, upper=True)
+        return lo + perm[lo:hi].index(msg_idx)
+
+    def _perm_in_place(self, order, msg_idx, text):
+        # Is a message whose key has not changed still in the right place?
+        keys, perm = self.INDEX_SORT[order], self._sort_perms[order]
+        pos, key = self._perm_find(order, msg_idx), keys[msg_idx]
+        for npos, before in ((pos - 1, True), (pos + 1, False)):
+            if 0 <= npos < len(perm) and keys[perm[npos]] == key:
+                nidx = perm[npos]
+                ntext = (self._sort_text(order, nidx), nidx)
+                if (ntext < (text, msg_idx)) != before:
+                    return False
+        return True
+
+    def _break_ties(self, order, ordered):
+        # Sort runs of messages with equal keys by their text; the sort
+        # is stable, so ties beyond that stay in the order given.
+        if order not in self.SORT_TEXT or len(ordered) < 2:
+            return ordered
+        keys, i = self.INDEX_SORT[order], 0
+        while i < len(ordered):
+            key, j = keys[ordered[i]], i + 1
+            while j < len(ordered) and keys[ordered[j]] == key:
+                j += 1
+            if j - i > 1:
+                ordered[i:j] = sorted(ordered[i:j], key=lambda m:
+                                      self._sort_text(order, m))
+            i = j
+        return ordered
+
+    def _sort_permutation(self, order):
+        with self._lock:
+            perm = self._sort_perms.get(order)
+            if perm is None:
+                keys = self.INDEX_SORT[order]
+                perm = array('i', self._break_ties(order, sorted(
+                    xrange(0, len(keys)), key=keys.__getitem__)))
+                self._sort_perms[order] = perm
+                self._sort_gen += 1
+            return perm
+
+    def _walk_permutation(self, order, wanted, reverse=False):
+        # Walk the permutation a chunk at a time, without copying it. If it
+        # changed since the last chunk, go back to the first message with
+        # the key we last yielded and carry on from there, skipping
+        # anything already yielded.
+        keys, step = self.INDEX_SORT[order], -1 if reverse else 1
+        pos, gen, last_key, yielded = None, None, None, set()
+        while True:
+            with self._lock:
+                perm = self._sort_permutation(order)
+                if pos is None:
+                    pos = (len(perm) - 1) if reverse else 0
+                elif gen != self._sort_gen and last_key is not None:
+                    pos = self._perm_bound(order, last_key, upper=reverse)
+                    if reverse:
+                        pos -= 1
+                gen = self._sort_gen
+                if reverse:
+                    chunk = perm[max(0, pos - self.PERM_CHUNK + 1):pos + 1]
+                    chunk.reverse()
+                else:
+                    chunk = perm[pos:pos + self.PERM_CHUNK]
+            if pos < 0 or not chunk:
+                return
+            pos += step * len(chunk)
+            for msg_idx in chunk:
+                if msg_idx in wanted and msg_idx not in yielded:
+                    yielded.add(msg_idx)
+                    last_key = keys[msg_idx]
+                    yield msg_idx
+
+    def _iter_by_order(self, ids, order, reverse=False):
+        # Note: ids must be in ascending order, so ties sort consistently
+        keys = self.INDEX_SORT[order]
+        if len(ids) * 16 < len(keys):
+            # Sorting a small result set is cheaper than a full walk
+            ordered = self._break_ties(order,
+                                       sorted(ids, key=keys.__getitem__))
+            return reversed(ordered) if reverse else iter(ordered)
+        return self._walk_permutation(order, ids, reverse=reverse)
+
+    def _sort_by_order(self, results, order):
+        results[:] = list(self._iter_by_order(self.ID_SET.Coerce(results),
+                                              order))
+
+    def _collapse_threads(self, ordered):
+        # This filters away all but the first result in each conversation.
+        seen = set()
+        for msg_idx in ordered:
+            thr = self.INDEX_THR[msg_idx]
+            if thr not in seen:
+                seen.add(thr)
+                yield msg_idx
+
+    def iter_sorted_results(self, results, how):
+        """
+        Return an iterator over the results in the requested order, which
+        does as little work as possible until it is consumed. Raises a
+        ValueError if the sort order is unknown.
+        """
+        how = how or 'flat-unsorted'
+        reverse = how.startswith('rev')
+        ids = (self.ID_SET.Coerce(results) &
+               self.ALL_SET(len(self.INDEX_THR)))
+        if how.endswith('unsorted') or how.endswith('index'):
+            ordered = reversed(ids) if reverse else iter(ids)
+        elif how.endswith('random'):
+            now = time.time()
+            ordered = sorted(ids, key=lambda k: sha1b64('%s%s' % (now, k)))
+        else:
+            for order in self.INDEX_SORT:
+                if how.endswith(order):
+                    ordered = self._iter_by_order(ids, order, reverse)
+                    break
+            else:
+                raise ValueError(_('Unknown sort order: %s') % how)
+        if 'flat' not in how:
+            ordered = self._collapse_threads(ordered)
+        return ordered
+
+    def count_sorted_results(self, results, how):
+        """Count the results iter_sorted_results will yield."""
+        ids = (self.ID_SET.Coerce(results) &
+               self.ALL_SET(len(self.INDEX_THR)))
+        if 'flat' in (how or 'flat'):
+            return len(ids)
+        return len(set(self.INDEX_THR[r] for r in ids))
 
     def sort_results(self, session, results, how):
         if not results:
             return
 
+        if isinstance(results, SortedResults):
+            try:
+                if results.reorder(how):
+                    return True
+            except ValueError:
+                session.ui.warning(_('Unknown sort order: %s') % how)
+                return False
+
         count = len(results)
         how = how or 'flat-unsorted'
         session.ui.mark(_n('Sorting %d message by %s...',
@@ -1676,8 +3041,7 @@ class MailIndex(object):
                 for order in self.INDEX_SORT:
                     if how.endswith(order):
                         try:
-                            results.sort(
-                                key=self.INDEX_SORT[order].__getitem__)
+                            self._sort_by_order(results, order)
                         except IndexError:
                             say = session.ui.error
                             if session.config.sys.debug:
@@ -1691,8 +3055,7 @@ class MailIndex(object):
                             say(_('Please tell team@mailpile.is !'))
                             clean_results = [r for r in results
                                              if r >= 0 and r < len(self.INDEX)]
-                            clean_results.sort(
-                                key=self.INDEX_SORT[order].__getitem__)
+                            self._sort_by_order(clean_results, order)
                             results[:] = clean_results
                         did_sort = True
                         break
@@ -1709,14 +3072,8 @@ class MailIndex(object):
             results.reverse()
 
         if 'flat' not in how:
-            # This filters away all but the first result in each conversation.
             session.ui.mark(_('Collapsing conversations...'))
-            seen, r2 = {}, []
-            for i in range(0, len(results)):
-                if self.INDEX_THR[results[i]] not in seen:
-                    r2.append(results[i])
-                    seen[self.INDEX_THR[results[i]]] = True
-            results[:] = r2
+            results[:] = list(self._collapse_threads(results))
             session.ui.mark(_n('Sorted %d message by %s',
                                'Sorted %d messages by %s',
                                count
@@ -0,0 +1,339 @@
+from array import array
+from bisect import bisect_left
+
+import mailpile.util
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+from mailpile.util import *
+
+
+##[ Result set engine ]########################################################
+#
+# Search results, tag memberships and posting list hits are all sets of
+# message index positions. Rather than Python sets (~70 bytes per member),
+# we keep them as sorted arrays of ints and implement the set algebra on
+# those. The "everything" set used by all:mail is represented symbolically,
+# as a range minus some exclusions, so it never needs enumerating unless
+# somebody actually iterates over it.
+#
+# Both classes interoperate with plain Python sets, lists and generators,
+# so code treating these as sets keeps working. An alternate engine (a
+# compressed bitmap, say) just needs to provide the same interface and
+# be assigned to MailIndex.ID_SET and MailIndex.ALL_SET.
+#
+# Intersections gallop through the larger operand when sizes differ a lot,
+# otherwise we let C-level set operations do the heavy lifting.
+#
+GALLOP_RATIO = 8
+
+
+def _gallop(ids, value, lo):
+    """Find the insertion point for value in ids[lo:], galloping."""
+    step, hi, n = 1, lo, len(ids)
+    while hi < n and ids[hi] < value:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect_left(ids, value, lo, min(hi, n))
+
+
+def _intersect(small, large):
+    """
+    Intersect two sorted arrays, galloping through the larger one.
+
+    >>> _intersect(array('i', [3, 5, 90]), array('i', range(0, 100, 5)))
+    array('i', [5, 90])
+    """
+    if len(small) > len(large):
+        small, large = large, small
+    if not small:
+        return array('i')
+    if len(large) < GALLOP_RATIO * len(small):
+        return array('i', sorted(set(small) & set(large)))
+    out, pos, n = array('i'), 0, len(large)
+    for value in small:
+        pos = _gallop(large, value, pos)
+        if pos >= n:
+            break
+        if large[pos] == value:
+            out.append(value)
+    return out
+
+
+class IdSet(object):
+    """
+    A set of message index positions, kept as a sorted array of ints.
+
+    >>> a, b = IdSet([5, 1, 3]), IdSet([3, 4, 5, 6])
+    >>> list(a & b), list(a | b), list(a - b)
+    ([3, 5], [1, 3, 4, 5, 6], [1])
+    >>> a.add(2); a.discard(5); a
+    IdSet([1, 2, 3])
+    >>> sorted(set([1, 9]) | a), sorted(set([1, 9]) - a), 2 in a
+    ([1, 2, 3, 9], [9], True)
+    """
+    __slots__ = ('ids', )
+
+    @classmethod
+    def FromSorted(cls, ids):
+        """Wrap a copy of an already sorted, duplicate free sequence."""
+        ids_set = cls()
+        ids_set.ids = array('i', ids)
+        return ids_set
+
+    @classmethod
+    def Coerce(cls, other):
+        if isinstance(other, (IdSet, RangeIdSet)):
+            return other
+        return cls(other)
+
+    def __init__(self, ids=None):
+        if ids is None:
+            self.ids = array('i')
+        elif isinstance(ids, IdSet):
+            self.ids = array('i', ids.ids)
+        else:
+            self.ids = array('i', sorted(set(ids)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __nonzero__(self):
+        return len(self.ids) > 0
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __reversed__(self):
+        return reversed(self.ids)
+
+    def __contains__(self, value):
+        i = bisect_left(self.ids, value)
+        return (i < len(self.ids) and self.ids[i] == value)
+
+    def __eq__(self, other):
+        if isinstance(other, IdSet):
+            return self.ids == other.ids
+        try:
+            return set(self.ids) == set(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return 'IdSet(%s)' % list(self.ids)
+
+    def copy(self):
+        return IdSet(self)
+
+    def tostring(self):
+        return self.ids.tostring()
+
+    def first(self):
+        return self.ids[0] if self.ids else None
+
+    def last(self):
+        return self.ids[-1] if self.ids else None
+
+    def below(self, limit):
+        """Return the members smaller than limit."""
+        return IdSet.FromSorted(self.ids[:bisect_left(self.ids, limit)])
+
+    def add(self, value):
+        ids = self.ids
+        if not ids or ids[-1] < value:
+            ids.append(value)
+        else:
+            i = bisect_left(ids, value)
+            if ids[i] != value:
+                ids.insert(i, value)
+
+    def discard(self, value):
+        i = bisect_left(self.ids, value)
+        if i < len(self.ids) and self.ids[i] == value:
+            del self.ids[i]
+
+    def intersection(self, other):
+        if isinstance(other, RangeIdSet):
+            return other.intersection(self)
+        return IdSet.FromSorted(_intersect(self.ids, IdSet.Coerce(other).ids))
+
+    def union(self, other):
+        if isinstance(other, RangeIdSet):
+            return other.union(self)
+        other = IdSet.Coerce(other)
+        if not other.ids:
+            return self.copy()
+        if not self.ids:
+            return other.copy()
+        if self.ids[-1] < other.ids[0]:
+            return IdSet.FromSorted(self.ids + other.ids)
+        return IdSet.FromSorted(sorted(set(self.ids) | set(other.ids)))
+
+    def difference(self, other):
+        if isinstance(other, RangeIdSet):
+            return IdSet.FromSorted(v for v in self.ids if v not in other)
+        other = IdSet.Coerce(other)
+        if not other.ids or not self.ids:
+            return self.copy()
+        if len(self.ids) * GALLOP_RATIO < len(other.ids):
+            return IdSet.FromSorted(v for v in self.ids if v not in other)
+        remove = set(other.ids)
+        return IdSet.FromSorted(v for v in self.ids if v not in remove)
+
+    def update(self, other):
+        if not isinstance(other, IdSet):
+            other = IdSet(other)
+        if len(other.ids) < 16:
+            for v in other.ids:
+                self.add(v)
+        else:
+            self.ids = self.union(other).ids
+        return self
+
+    def difference_update(self, other):
+        if not isinstance(other, (IdSet, RangeIdSet)):
+            other = IdSet(other)
+        if len(other) < 16 and isinstance(other, IdSet):
+            for v in other.ids:
+                self.discard(v)
+        else:
+            self.ids = self.difference(other).ids
+        return self
+
+    __and__ = __rand__ = intersection
+    __or__ = __ror__ = union
+    __sub__ = difference
+    __ior__ = update
+    __isub__ = difference_update
+
+    def __iand__(self, other):
+        self.ids = self.intersection(other).ids
+        return self
+
+    def __rsub__(self, other):
+        return IdSet(other).difference(self)
+
+
+class RangeIdSet(object):
+    """
+    All message index positions in range(0, end), minus an excluded IdSet.
+
+    >>> everything = RangeIdSet(10)
+    >>> len(everything), len(everything - IdSet([1, 2, 30]))
+    (10, 8)
+    >>> everything & IdSet([3, 12]), 3 in everything
+    (IdSet([3]), True)
+    >>> list((everything - [0, 1, 2, 3, 4, 5, 6]) | [5, 11])
+    [5, 7, 8, 9, 11]
+    """
+    __slots__ = ('end', 'excluded')
+
+    def __init__(self, end, excluded=None):
+        self.end = max(0, end)
+        self.excluded = excluded.below(self.end) if excluded else IdSet()
+
+    def __len__(self):
+        return self.end - len(self.excluded)
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        excluded = iter(self.excluded)
+        skip = next(excluded, None)
+        for i in xrange(0, self.end):
+            if i == skip:
+                skip = next(excluded, None)
+            else:
+                yield i
+
+    def __reversed__(self):
+        excluded = reversed(self.excluded)
+        skip = next(excluded, None)
+        for i in xrange(self.end - 1, -1, -1):
+            if i == skip:
+                skip = next(excluded, None)
+            else:
+                yield i
+
+    def __contains__(self, value):
+        return (0 <= value < self.end) and (value not in self.excluded)
+
+    def __repr__(self):
+        return 'RangeIdSet(%d, %s)' % (self.end, self.excluded)
+
+    def copy(self):
+        return RangeIdSet(self.end, self.excluded)
+
+    def tostring(self):
+        return '%d:%s' % (self.end, self.excluded.tostring())
+
+    def as_idset(self):
+        return IdSet.FromSorted(iter(self))
+
+    def intersection(self, other):
+        if isinstance(other, RangeIdSet):
+            return RangeIdSet(min(self.end, other.end),
+                              self.excluded.union(other.excluded))
+        other = IdSet.Coerce(other).below(self.end)
+        if self.excluded:
+            return other.difference(self.excluded)
+        return other
+
+    def union(self, other):
+        if isinstance(other, RangeIdSet):
+            small, large = sorted((self, other), key=lambda s: s.end)
+            common = small.excluded.intersection(large.excluded)
+            return RangeIdSet(large.end, common.union(
+                [e for e in large.excluded if e >= small.end]))
+        other = IdSet.Coerce(other)
+        if other.ids and other.ids[-1] >= self.end:
+            return self.as_idset().union(other)
+        return RangeIdSet(self.end, self.excluded.difference(other))
+
+    def difference(self, other):
+        if isinstance(other, RangeIdSet):
+            return IdSet.FromSorted(v for v in other.excluded if v in self)
+        return RangeIdSet(self.end, self.excluded.union(other))
+
+    def __rsub__(self, other):
+        other = IdSet.Coerce(other)
+        return IdSet.FromSorted(v for v in other if v not in self)
+
+    __and__ = __rand__ = __iand__ = intersection
+    __or__ = __ror__ = __ior__ = union
+    __sub__ = __isub__ = difference
+
+
+if __name__ == "__main__":
+    import doctest
+    import random
+    import sys
+
+    # Cross-check the set algebra against Python's own sets
+    for tries in range(0, 200):
+        n = random.randint(1, 300)
+        sa = set(random.sample(range(0, n), random.randint(0, n)))
+        sb = set(random.sample(range(0, n), random.randint(0, n // 10 + 1)))
+        a, b, r = IdSet(sa), IdSet(sb), RangeIdSet(n) - sb
+        assert(set(a & b) == sa & sb and set(b & a) == sa & sb)
+        assert(set(a | b) == sa | sb and set(a - b) == sa - sb)
+        assert(set(b - a) == sb - sa)
+        assert(set(r) == set(range(0, n)) - sb and len(r) == n - len(sb))
+        assert(list(reversed(r)) == list(r)[::-1])
+        assert(list(reversed(a)) == list(a)[::-1])
+        assert(set(r & a) == sa - sb and set(a & r) == sa - sb)
+        assert(set(r | a) == set(range(0, n)) - (sb - sa))
+        assert(set(a - r) == sa & sb and set(r - a) == set(r) - sa)
+        a |= sb
+        b -= sa
+        assert(set(a) == sa | sb and set(b) == sb - sa)
+
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
@@ -1,7 +1,21 @@
+import email
+import os
 import unittest
+from cStringIO import StringIO
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from urllib import quote
 from nose.tools import assert_equal, assert_less
 
-from mailpile.tests import get_shared_mailpile
+from mailpile.crypto.streamer import EncryptingStreamer
+from mailpile.mailutils import Email, ParseMessage
+from mailpile.postinglist import GlobalPostingList, KeywordBatch
+from mailpile.postinglist import PostingListSegments
+from mailpile.postinglist import PostingListContainer, PLC_CACHE
+from mailpile.search import MailIndex, CachedSearchResultSet, StopScanPool
+from mailpile.tests import get_shared_mailpile, MailPileUnittest
+from mailpile.thread_index import ThreadIndex
+from mailpile.util import b36, safe_remove
 
 
 def checkSearch(query, expected_count=1):
@@ -45,6 +59,721 @@ def test_generator():
     # Not found
     yield checkSearch(['subject:Moderation', 'kde-isl'], 0)
     yield checkSearch(['has:crypto'], 3)
+    # Negation, union and mixed operators
+    yield checkSearch(['-from:twitter'], 8)
+    yield checkSearch(['all:mail', '-from:twitter', '-has:crypto'], 5)
+    yield checkSearch(['brennan', '+from:twitter'], 2)
+    yield checkSearch(['from:twitter', '-brennan', '+brennan'], 2)
 
     # Test that we do not crash when searching for a non-existant tag.
     yield checkSearch(['in:doesnotexist'], 0)
+
+
+class TestMetadataIndex(MailPileUnittest):
+    def test_columns_round_trip(self):
+        idx = self.config.index
+        idx.save(self.session)
+        self.assertTrue(os.path.exists(self.config.mailindex_columns_file()))
+
+        # Change a message after saving, so it only lives in mailpile.idx
+        msg_info = idx.get_msg_at_idx_pos(0)
+        subject = msg_info[idx.MSG_SUBJECT]
+        msg_info[idx.MSG_SUBJECT] = u'Changed after saving'
+        idx.set_msg_at_idx_pos(0, msg_info)
+        idx.save_changes(self.session)
+
+        idx2 = MailIndex(self.config)
+        idx2.load(self.session)
+        self.assertTrue(idx2.INDEX.idx_size > 0)
+        self.assertEqual(len(idx2.INDEX), len(idx.INDEX))
+        self.assertEqual(idx2.EMAILS, idx.EMAILS)
+        self.assertEqual(idx2.INDEX_THR, idx.INDEX_THR)
+        for i in range(0, len(idx.INDEX)):
+            self.assertEqual(idx2.get_msg_at_idx_pos(i),
+                             idx.get_msg_at_idx_pos(i))
+        self.assertEqual(idx2.get_msg_at_idx_pos(0)[idx.MSG_SUBJECT],
+                         u'Changed after saving')
+
+        msg_info[idx.MSG_SUBJECT] = subject
+        idx.set_msg_at_idx_pos(0, msg_info)
+
+    def test_encrypted_columns(self):
+        idx = self.config.index
+        idx.save(self.session)
+        columns_file = self.config.mailindex_columns_file()
+        subject = idx.get_msg_at_idx_pos(0)[idx.MSG_SUBJECT]
+        master_key = self.config.master_key
+        self.config.master_key = master_key or 'testing'
+        gpg_recipient = lambda: 'DEADBEEF'
+        idx._gpg_recipient = gpg_recipient
+        try:
+            self.assertTrue(idx.save_columns(self.session))
+            with open(columns_file, 'rb') as fd:
+                self.assertFalse(subject.encode('utf-8') in fd.read())
+
+            idx2 = MailIndex(self.config)
+            idx2._gpg_recipient = gpg_recipient
+            with open(self.config.mailindex_file(), 'rb') as fd:
+                self.assertEqual(idx2._load_columns(None, fd),
+                                 idx.INDEX.idx_size)
+            self.assertEqual(idx2.EMAILS, idx.EMAILS)
+            for i in range(0, len(idx.INDEX)):
+                self.assertEqual(idx2.get_msg_at_idx_pos(i),
+                                 idx.get_msg_at_idx_pos(i))
+
+            # The checkpoint is encrypted as well
+            self.assertTrue(idx.save_checkpoint(self.session))
+            msg_id = idx.get_msg_at_idx_pos(0)[idx.MSG_ID]
+            with open(self.config.mailindex_checkpoint_file(), 'rb') as fd:
+                self.assertFalse(msg_id.encode('utf-8') in fd.read())
+            self.assertTrue(idx2._load_checkpoint(None, idx2.INDEX))
+            self.assertEqual(idx2.MSGIDS, idx.MSGIDS)
+        finally:
+            del idx._gpg_recipient
+            self.config.master_key = master_key
+            idx.save_columns(self.session)
+            idx.save_checkpoint(self.session)
+
+    def test_checkpoint(self):
+        idx = self.config.index
+        idx._sort_permutation('subject')
+        idx.save(self.session)
+        self.assertTrue(os.path.exists(
+            self.config.mailindex_checkpoint_file()))
+
+        # A change which only reaches disk after the checkpoint is written
+        msg_info = idx.get_msg_at_idx_pos(1)
+        subject = msg_info[idx.MSG_SUBJECT]
+        msg_info[idx.MSG_SUBJECT] = u'Aaa changed after the checkpoint'
+        idx.set_msg_at_idx_pos(1, msg_info)
+        self.assertTrue(idx.save_checkpoint(self.session))
+        idx.save_changes(self.session)
+
+        # Load with the checkpoint, then without, and compare
+        checkpoint_file = self.config.mailindex_checkpoint_file()
+        loaded = []
+        for checkpoint in (True, False):
+            if not checkpoint:
+                os.remove(checkpoint_file)
+            idx2 = MailIndex(self.config)
+            idx2.load(self.session)
+            loaded.append(idx2)
+            # Either way, there is a checkpoint for the next startup
+            self.assertTrue(MailIndex(self.config)._load_checkpoint(
+                None, idx2.INDEX))
+        for idx2 in loaded:
+            self.assertEqual(idx2.INDEX_THR, idx.INDEX_THR)
+            self.assertEqual(idx2.THREADS.replies, idx.THREADS.replies)
+            self.assertEqual(idx2.INDEX_SORT, idx.INDEX_SORT)
+            self.assertEqual(idx2.MSGIDS, idx.MSGIDS)
+            self.assertEqual(idx2.EMAIL_IDS, idx.EMAIL_IDS)
+            self.assertEqual(idx2.get_msg_at_idx_pos(1)[idx.MSG_SUBJECT],
+                             msg_info[idx.MSG_SUBJECT])
+            for tid in set(idx.TAGS.keys()) | set(idx2.TAGS.keys()):
+                self.assertEqual(list(idx2.TAGS.get(tid, [])),
+                                 list(idx.TAGS.get(tid, [])))
+        self.assertEqual(loaded[0].PTRS, loaded[1].PTRS)
+        self.assertEqual(loaded[0].THREADS.parents, idx.THREADS.parents)
+        self.assertEqual(sorted(loaded[0]._sort_perms.keys()),
+                         sorted(idx._sort_perms.keys()))
+        for order, perm in loaded[0]._sort_perms.iteritems():
+            self.assertEqual(perm, idx._sort_perms[order])
+
+        msg_info[idx.MSG_SUBJECT] = subject
+        idx.set_msg_at_idx_pos(1, msg_info)
+
+
+class TestParallelLoad(MailPileUnittest):
+    def _encrypted_index(self, idx):
+        data = StringIO()
+        data.write('# Header\n')
+        for i, email in enumerate(idx.EMAILS):
+            data.write('@%s\t%s\n' % (b36(i), quote(email.encode('utf-8'))))
+        lines = [idx.INDEX[i] + '\n' for i in range(0, len(idx.INDEX))]
+
+        # The last chunk overrides the first message: last write wins
+        msg_info = idx.get_msg_at_idx_pos(0)
+        msg_info[idx.MSG_SUBJECT] = u'Overridden'
+        chunks = [lines[i::3] for i in range(0, 3)] + [[
+            idx.m2l(msg_info) + '\n']] * 2
+        for chunk in chunks:
+            with EncryptingStreamer(self.config.master_key or 'missing',
+                                    delimited=True,
+                                    dir=self.config.tempfile_dir()) as es:
+                es.write(''.join(chunk))
+                es.finish()
+                es.save_copy(data)
+        return data
+
+    def test_parallel_load(self):
+        idx = self.config.index
+        fd = self._encrypted_index(idx)
+        load_threads = self.config.sys.load_threads
+        try:
+            for threads in (1, 2):
+                self.config.sys.load_threads = threads
+                idx2, bogus_lines = MailIndex(self.config), []
+                fd.seek(0)
+                idx2._load_index_lines(self.session, fd, bogus_lines)
+                self.assertEqual(bogus_lines, [])
+                self.assertEqual(idx2.EMAILS, idx.EMAILS)
+                self.assertEqual(len(idx2.INDEX), len(idx.INDEX))
+                self.assertEqual(idx2.INDEX_THR, idx.INDEX_THR)
+                for i in range(1, len(idx.INDEX)):
+                    self.assertEqual(idx2.get_msg_at_idx_pos(i),
+                                     idx.get_msg_at_idx_pos(i))
+                self.assertEqual(
+                    idx2.get_msg_at_idx_pos(0)[idx.MSG_SUBJECT],
+                    u'Overridden')
+        finally:
+            self.config.sys.load_threads = load_threads
+
+
+class TestParallelScan(MailPileUnittest):
+    def _scan(self, procs):
+        config = self.config
+        idx = MailIndex(config)
+        # Keep the keywords to ourselves, out of the shared posting lists
+        idx._kw_batch = KeywordBatch(self.session, max_kb=1024 * 1024)
+        idx.flush_keywords = lambda: 0
+        config.sys.scan_processes = procs
+        for mbx_id, mbx_fn in config.sys.mailbox.iteritems():
+            if os.path.basename(mbx_fn) == 'Maildir':
+                idx.scan_mailbox(self.session, mbx_id, mbx_fn,
+                                 config.open_mailbox)
+        keywords = dict((sig, sorted(mids)) for sig, mids
+                        in idx._kw_batch.words.iteritems())
+        return idx, keywords
+
+    def _row(self, idx, msg_idx):
+        # E-mail IDs are handed out in a different order and the order of
+        # the tags is arbitrary, so compare addresses and sets of tags.
+        msg_info = idx.get_msg_at_idx_pos(msg_idx)
+        for field in (idx.MSG_TO, idx.MSG_CC):
+            msg_info[field] = sorted(idx.expand_to_list(msg_info, field))
+        msg_info[idx.MSG_TAGS] = sorted(msg_info[idx.MSG_TAGS].split(','))
+        return msg_info
+
+    def test_parallel_scan(self):
+        scan_processes = self.config.sys.scan_processes
+        settings = (MailIndex.PARALLEL_SCAN_MIN,
+                    MailIndex.PARALLEL_SCAN_BATCH,
+                    MailIndex.PARALLEL_SCAN_CHUNK)
+        try:
+            (MailIndex.PARALLEL_SCAN_MIN,
+             MailIndex.PARALLEL_SCAN_BATCH,
+             MailIndex.PARALLEL_SCAN_CHUNK) = (2, 4, 3)
+            serial, serial_kw = self._scan(1)
+            parallel, parallel_kw = self._scan(2)
+            self.assertTrue(self.config.scan_pool is not None)
+        finally:
+            (MailIndex.PARALLEL_SCAN_MIN,
+             MailIndex.PARALLEL_SCAN_BATCH,
+             MailIndex.PARALLEL_SCAN_CHUNK) = settings
+            self.config.sys.scan_processes = scan_processes
+            StopScanPool(self.config)
+
+        self.assertTrue(len(serial.INDEX) > 4)
+        self.assertEqual(len(parallel.INDEX), len(serial.INDEX))
+        for i in range(0, len(serial.INDEX)):
+            self.assertEqual(self._row(parallel, i), self._row(serial, i))
+        self.assertTrue(serial_kw)
+        self.assertEqual(parallel_kw, serial_kw)
+        self.assertEqual(parallel.INDEX_THR, serial.INDEX_THR)
+        self.assertEqual(parallel.THREADS.replies, serial.THREADS.replies)
+
+
+class TestKeywordBatch(MailPileUnittest):
+    # Made-up words for made-up message IDs, far past the end of the
+    # shared index, so other tests never see them.
+    def _index(self, idx, prefix, base):
+        for i in range(0, 25):
+            keywords = set('%s%d' % (prefix, j) for j in range(0, 4)
+                           if i % (j + 1) == 0)
+            idx.index_message(self.session, b36(base + i), '<%d@kw>' % i,
+                              None, 0, 0, read_results=(keywords, ''))
+
+    def _hits(self, idx, prefix, base):
+        CachedSearchResultSet.DropCaches()
+        return [sorted(h - base for h in
+                       idx.search(self.session, ['%s%d' % (prefix, j)]
+                                  ).as_set())
+                for j in range(0, 4)]
+
+    def test_batched_hits(self):
+        idx = MailIndex(self.config)
+        self._index(idx, 'zqunbatched', 900000)
+        unbatched = self._hits(idx, 'zqunbatched', 900000)
+        self.assertEqual(unbatched[1], range(0, 25, 2))
+
+        for max_kb in (1024, 1):  # Flushed at the end, or along the way
+            prefix, base = 'zqbatched%d' % max_kb, 910000 + 100 * max_kb
+            idx = MailIndex(self.config)
+            idx._kw_batch = KeywordBatch(self.session, max_kb=max_kb)
+            idx._begin_keyword_batch(self.session)
+            try:
+                self._index(idx, prefix, base)
+                if max_kb > 1:
+                    self.assertEqual(len(idx._kw_batch), 4)
+                    self.assertEqual(self._hits(idx, prefix, base)[0], [])
+            finally:
+                idx._end_keyword_batch()
+            self.assertEqual(len(idx._kw_batch), 0)
+            self.assertEqual(self._hits(idx, prefix, base), unbatched)
+
+    def test_save_changes_flushes_first(self):
+        idx = self.config.index
+        base = 1100000
+        mailindex_file = os.path.join(self.config.workdir, 'kw-test.idx')
+        kw_batch, saved_changes = idx._kw_batch, idx._saved_changes
+        flush_keywords = idx.flush_keywords
+        flushed = []
+
+        def flush():
+            flushed.append(os.path.exists(mailindex_file))
+            return flush_keywords()
+        try:
+            self.config.mailindex_file = lambda: mailindex_file
+            idx.flush_keywords = flush
+            idx._kw_batch = KeywordBatch(self.session, max_kb=1024)
+            idx._begin_keyword_batch(self.session)
+            self._index(idx, 'zqsaved', base)
+            idx.MODIFIED.add(0)
+            idx.save_changes(self.session)
+            self.assertEqual(flushed, [False])
+            self.assertTrue(os.path.exists(mailindex_file))
+            self.assertEqual(len(idx._kw_batch), 0)
+            self.assertEqual(self._hits(idx, 'zqsaved', base)[0],
+                             range(0, 25))
+        finally:
+            idx._kw_batching -= 1
+            idx._kw_batch, idx._saved_changes = kw_batch, saved_changes
+            del idx.flush_keywords
+            del self.config.mailindex_file
+            safe_remove(mailindex_file)
+
+
+class TestThreading(MailPileUnittest):
+    def _add(self, idx, msg_id, subject, ts, refs=None):
+        msg = email.message_from_string(
+            'Message-ID: <%s>\nSubject: %s\n%s\nHello\n' % (
+                msg_id, subject,
+                ('In-Reply-To: <%s>\n' % refs) if refs else ''))
+        msg_idx, msg_info = idx.add_new_msg(
+            'ptr%s' % msg_id, idx.encode_msg_id('<%s>' % msg_id), ts,
+            'a@b.c', [], [], 1, subject, '', [])
+        idx.set_conversation_ids(msg_info[idx.MSG_MID], msg)
+        return msg_idx
+
+    def _thread(self, idx, msg_idx):
+        root = idx.INDEX_THR[msg_idx]
+        return [root] + idx.get_reply_idxs(root)
+
+    def test_threads_in_sync(self):
+        idx = self.config.index
+        self.assertEqual(ThreadIndex.FromRoots(idx.INDEX_THR).replies,
+                         idx.THREADS.replies)
+
+    def test_thread_split_and_merge(self):
+        idx, ts = MailIndex(self.config), 1400000000
+        a = self._add(idx, 'a', 'Hello', ts)
+        b = self._add(idx, 'b', 'Re: Hello', ts + 10, refs='a')
+        c = self._add(idx, 'c', 'Re: Hello', ts + 20, refs='b')
+        d = self._add(idx, 'd', 'Re: Hello', ts + 30, refs='a')
+        e = self._add(idx, 'e', 'RE: hello', ts + 40)
+        f = self._add(idx, 'f', 'Other', ts + 50)
+        self.assertEqual(self._thread(idx, c), [a, b, c, d, e])
+        self.assertEqual(self._thread(idx, f), [f])
+
+        # Splitting off b takes its reply along
+        idx.unthread_message(b36(b))
+        self.assertEqual(self._thread(idx, c), [b, c])
+        self.assertEqual(self._thread(idx, a), [a, d, e])
+        self.assertEqual(idx.get_msg_at_idx_pos(c)[idx.MSG_THREAD_MID],
+                         b36(b))
+
+        # Removing the root keeps the rest together
+        idx.unthread_message(b36(a))
+        self.assertEqual(self._thread(idx, a), [a])
+        self.assertEqual(self._thread(idx, e), [d, e])
+
+        # A message referencing two threads merges them
+        g = email.message_from_string(
+            'Message-ID: <g>\nIn-Reply-To: <c>\nReferences: <f> <c>\n\n')
+        g_idx, g_info = idx.add_new_msg('ptrg', '<g>', ts + 60, 'a@b.c',
+                                        [], [], 1, 'Merge', '', [])
+        idx.set_conversation_ids(g_info[idx.MSG_MID], g)
+        self.assertEqual(self._thread(idx, f), [b, c, f, g_idx])
+        self.assertEqual(ThreadIndex.FromRoots(idx.INDEX_THR).replies,
+                         idx.THREADS.replies)
+
+
+class TestReadMessage(MailPileUnittest):
+    def _read(self, idx, *parts):
+        msg = MIMEMultipart('alternative')
+        msg['Subject'] = 'Weekly news'
+        for text, subtype in parts:
+            msg.attach(MIMEText(text, subtype, 'utf-8'))
+        msg = ParseMessage(StringIO(msg.as_string()), pgpmime=False)
+        return idx.read_message(self.session, '1', '<x@y>', msg, 1000,
+                                1400000000)
+
+    def test_html_alternatives(self):
+        idx = MailIndex(self.config)
+        plain = 'Plain words about aardvarks. ' * 10
+        html = ('<html><head><style>td { colour: teal; }</style></head>'
+                '<body><p>Fancy words about <b>zebras</b></p></body></html>')
+        keywords, info = self._read(idx, (plain, 'plain'), (html, 'html'))
+        self.assertTrue('aardvarks' in keywords)
+        self.assertTrue('weekly:subject' in keywords)
+        self.assertTrue('zebras' in keywords)
+        self.assertFalse('teal' in keywords)
+        self.assertTrue(info['snippet'].startswith('Plain words'))
+
+        self.config.prefs.index_skip_html = True
+        try:
+            keywords, info = self._read(idx, (plain, 'plain'),
+                                        (html, 'html'))
+        finally:
+            self.config.prefs.index_skip_html = False
+        self.assertTrue('aardvarks' in keywords)
+        self.assertFalse('zebras' in keywords)
+
+        keywords, info = self._read(idx, ('Short', 'plain'), (html, 'html'))
+        self.assertTrue('zebras' in keywords)
+        self.assertFalse('teal' in keywords)
+
+        keywords, info = self._read(idx, (html, 'html'))
+        self.assertTrue('zebras' in keywords and 'text:missing' in keywords)
+        self.assertEqual(info['snippet'], 'Fancy words about zebras')
+        self.assertEqual(sorted(idx.extraction_timing.keys()),
+                         ['decode', 'normalise', 'plugins', 'tokenise'])
+        self.assertEqual(idx.extraction_timing['decode'][0], 4)
+
+
+class TestTokenizer(MailPileUnittest):
+    def test_search_folded_words(self):
+        idx = MailIndex(self.config)
+        msg = MIMEText(u'Le caf\xe9 est \xe0 T\u014dky\u014d, '
+                       u'\u6771\u4eac\u90fd.'.encode('utf-8'),
+                       'plain', 'utf-8')
+        msg['Subject'] = 'Caf\xc3\xa9 au lait'
+        msg = ParseMessage(StringIO(msg.as_string()), pgpmime=False)
+        keywords, info = idx.read_message(self.session, '1', '<x@y>', msg,
+                                          1000, 1400000000)
+        index = dict((kw, ['1']) for kw in keywords)
+
+        def found(*terms):
+            return list(idx.search(self.session, list(terms),
+                                   keywords=index).as_set())
+
+        self.assertEqual(found(u'CAF\xc9'), [1])
+        self.assertEqual(found(u'tokyo', u'subject:caf\xe9'), [1])
+        self.assertEqual(found(u'\u6771\u4eac'), [1])
+        self.assertEqual(found(u'\u4eac\u90fd'), [1])
+        self.assertEqual(found(u'\u90fd\u6771'), [])
+
+    def test_migration(self):
+        from mailpile.plugins.migrate import migrate_tokenizer
+        idx = self.config.index
+        count = self.mp.search('twitter').result['stats']['count']
+        self.config.sys.index_tokenizer = 'old'
+        self.assertTrue(migrate_tokenizer(self.session))
+        self.assertEqual(self.config.sys.index_tokenizer,
+                         idx.tokenizer().signature)
+        self.assertEqual(self.mp.search('Twitter').result['stats']['count'],
+                         count)
+
+    def test_migration_resumes(self):
+        from mailpile.plugins import migrate
+        idx = self.config.index
+        signature = idx.tokenizer().signature
+        reindexed = []
+        index_email = idx.index_email
+        batch = migrate.REINDEX_BATCH
+        try:
+            idx.index_email = lambda s, e: reindexed.append(e.msg_idx_pos)
+            migrate.REINDEX_BATCH = 2
+            self.config.sys.index_tokenizer = 'old'
+            self.config.sys.index_reindexed = '%s %d' % (signature, 3)
+            self.assertTrue(migrate.migrate_tokenizer(self.session))
+        finally:
+            idx.index_email = index_email
+            migrate.REINDEX_BATCH = batch
+        self.assertEqual(reindexed, range(3, len(idx.INDEX)))
+        self.assertEqual(self.config.sys.index_tokenizer, signature)
+        self.assertEqual(self.config.sys.index_reindexed, '')
+
+
+class TestQueryPlan(MailPileUnittest):
+    def test_explain(self):
+        results = self.mp.search('--explain', 'twitter', '-in:spam')
+        self.assertEqual(results.result['stats']['count'], 3)
+        explain = results.result['explain']
+        self.assertEqual([(r['depth'], r['op'], r['term']) for r in explain],
+                         [(0, '', 'AND'), (1, '', 'twitter'),
+                          (1, '-', 'in:spam')])
+        self.assertTrue(explain[1]['estimate'] >= explain[1]['found'] >= 3)
+        self.assertTrue('est=' in results.as_text())
+
+    def test_short_circuit(self):
+        explain = []
+        srs = self.config.index.search(self.session,
+                                       ['dates:2014', 'size:>1k',
+                                        'twitter', 'zxqwvnonexistent'],
+                                       explain=explain)
+        self.assertEqual(len(srs.as_set()), 0)
+        found = dict((r['term'], r['found']) for r in explain)
+        self.assertEqual(found['zxqwvnonexistent'], 0)
+        self.assertEqual(found['dates:2014'], None)
+        self.assertEqual(found['size:>1k'], None)
+        self.assertEqual(found['twitter'], None)
+
+
+class TestSortOrders(MailPileUnittest):
+    def _expected(self, idx, how, msg_idxs):
+        keys = idx.INDEX_SORT[how]
+        text = lambda i: ((how in idx.SORT_TEXT) and
+                          idx._sort_text(how, i) or u'')
+        return sorted(msg_idxs, key=lambda i: (keys[i], text(i), i))
+
+    def test_sort_permutations(self):
+        idx = self.config.index
+        count = len(idx.INDEX)
+        for how in ('date', 'freshness', 'from', 'subject', 'size'):
+            results = range(count - 1, -1, -1)
+            self.assertTrue(idx.sort_results(self.session, results,
+                                             'flat-%s' % how))
+            self.assertEqual(results,
+                             self._expected(idx, how, range(0, count)))
+
+        # Permutations stay in order as messages change
+        msg_info = idx.get_msg_at_idx_pos(0)
+        subject = msg_info[idx.MSG_SUBJECT]
+        msg_info[idx.MSG_SUBJECT] = u'Re: Zzz moved to the end'
+        idx.update_msg_sorting(0, msg_info)
+        results = range(0, count)
+        idx.sort_results(self.session, results, 'flat-subject')
+        self.assertEqual(results[-1], 0)
+
+        msg_info[idx.MSG_SUBJECT] = subject
+        idx.update_msg_sorting(0, msg_info)
+        perm = list(idx._sort_permutation('subject'))
+        self.assertEqual(perm,
+                         self._expected(idx, 'subject', range(0, count)))
+
+    def test_text_sorting(self):
+        idx, ts = MailIndex(self.config), 1400000000
+        subjects = [u'Newsletter January', u'\u042f\u0431\u043b',
+                    u'Re: newsletter December', u'\u0416\u0443\u043a',
+                    u'\u65e5\u672c', u'\u0391\u03b8', u'\xc9t\xe9',
+                    u'ete']
+        for i, subject in enumerate(subjects):
+            idx.add_new_msg('ptr%d' % i, '<%d@x>' % i, ts, 'a@b.c', [], [],
+                            1, subject, '', [])
+        expected = [6, 7, 2, 0, 5, 3, 1, 4]
+        results = range(0, len(subjects))
+        idx.sort_results(self.session, results, 'flat-subject')
+        self.assertEqual(results, expected)
+
+        # Walking the permutation gives the same, also as things change
+        idx._sort_permutation('subject')
+        idx.PERM_CHUNK = 2
+        walk = idx._walk_permutation('subject', set(range(0, 8)))
+        self.assertEqual([walk.next(), walk.next(), walk.next()],
+                         expected[:3])
+        for msg_idx, subject in ((2, u'Newsletter November'),
+                                 (6, u'Zzz'), (1, u'Aaa')):
+            msg_info = idx.get_msg_at_idx_pos(msg_idx)
+            msg_info[idx.MSG_SUBJECT] = subject
+            idx.set_msg_at_idx_pos(msg_idx, msg_info)
+        self.assertEqual(list(walk), [0, 5, 3, 4])
+        self.assertEqual(list(idx._sort_permutation('subject')),
+                         [1, 7, 0, 2, 6, 5, 3, 4])
+        self.assertEqual(list(idx._sort_permutation('subject')),
+                         self._expected(idx, 'subject', range(0, 8)))
+
+    def test_lazy_sorted_results(self):
+        idx = self.config.index
+        srs = idx.search(self.session, ['all:mail'], order='all')
+        for how in ('rev-date', 'date', 'flat-rev-freshness', 'from',
+                    'rev-subject', 'flat-size', 'flat-index'):
+            results = list(srs.as_set())
+            idx.sort_results(self.session, results, how)
+            lazy = srs.sorted_results(how)
+            self.assertEqual(lazy[:3], results[:3])
+            self.assertEqual(len(lazy), len(results))
+            self.assertEqual(list(lazy), results)
+            self.assertEqual(list(srs.iter_sorted(how)), results)
+
+        # Anything but reading falls back to being a plain list
+        lazy = srs.sorted_results('flat-index')
+        lazy.reverse()
+        self.assertEqual(lazy[0], max(srs.as_set()))
+        self.assertFalse(lazy.reorder('date'))
+
+
+class TestPostingListSegments(MailPileUnittest):
+    QUERIES = (['brennan'], ['agirorn'], ['from:twitter'], ['att:jpg'])
+
+    def _counts(self):
+        return [len(self.config.index.search(self.session, q).as_set())
+                for q in self.QUERIES]
+
+    def test_freeze_merge_and_delete(self):
+        idx = self.config.index
+        counts = self._counts()
+        segments = PostingListSegments.Get(self.session)
+
+        # Freezing the journal moves keywords into a segment
+        GlobalPostingList.Optimize(self.session, idx, quick=True)
+        self.assertTrue(len(segments) > 0)
+        self.assertEqual(self._counts(), counts)
+
+        # Forced merges move everything on to the posting lists
+        GlobalPostingList.Optimize(self.session, idx, force=True)
+        self.assertEqual(len(segments), 0)
+        self.assertEqual(self._counts(), counts)
+
+        # Deleted messages vanish from results
+        hits = idx.search(self.session, ['brennan']).as_set()
+        idx.forget_keywords(self.session, hits)
+        try:
+            self.assertEqual(self._counts()[0], 0)
+        finally:
+            segments.tombstones = segments.tombstones - hits
+            os.remove(os.path.join(segments.path, segments.TOMBSTONES))
+            CachedSearchResultSet.DropCaches()
+        self.assertEqual(self._counts(), counts)
+
+
+    def test_compaction(self):
+        idx = self.config.index
+        counts = self._counts()
+        segments = PostingListSegments.Get(self.session)
+        tombstones = os.path.join(segments.path, segments.TOMBSTONES)
+        stray = os.path.join(segments.path, '0-zz.seg.tmp')
+        open(stray, 'w').close()
+        PostingListSegments(self.session, segments.path)
+        self.assertFalse(os.path.exists(stray))
+
+        # Deletions are appended to the tombstone log, once
+        hits = idx.search(self.session, ['brennan']).as_set()
+        try:
+            for i in range(0, 2):
+                idx.forget_keywords(self.session, hits)
+                self.assertEqual(os.path.getsize(tombstones), 4 * len(hits))
+
+            # A forced optimization purges them from the PLCs, after
+            # which the tombstones themselves can go.
+            GlobalPostingList.Optimize(self.session, idx, force=True)
+            self.assertEqual(len(segments.tombstones), 0)
+            self.assertFalse(os.path.exists(tombstones))
+            CachedSearchResultSet.DropCaches()
+            self.assertEqual(self._counts()[0], 0)
+        finally:
+            segments.tombstones = segments.tombstones - hits
+            safe_remove(tombstones)
+            for msg_idx_pos in hits:
+                idx.index_email(self.session, Email(idx, msg_idx_pos))
+            CachedSearchResultSet.DropCaches()
+        self.assertEqual(self._counts(), counts)
+
+
+class TestPostingListMigration(MailPileUnittest):
+    def _words(self, sig):
+        plc = PostingListContainer(self.session, sig)
+        return plc.legacy, dict((k, list(v)) for k, v in plc.words.items())
+
+    def test_legacy_round_trip(self):
+        sig = 'zlegacytest'
+        fn = PostingListContainer._SaveFile(self.config, sig)
+        marker = os.path.join(self.config.workdir,
+                              PostingListContainer.MIGRATION_MARKER)
+        with open(fn, 'w') as fd:
+            fd.write('%s\t1\t2\ta\n%sx\t10\n' % (sig, sig))
+        try:
+            expected = {sig: [1, 2, 10], sig + 'x': [36]}
+            self.assertEqual(self._words(sig), (True, expected))
+
+            safe_remove(marker)
+            self.assertTrue(PostingListContainer.MigrateAll(self.session))
+            self.assertFalse(sig in PLC_CACHE)
+            with open(fn, 'rb') as fd:
+                self.assertFalse(fd.read().startswith(sig))
+            self.assertEqual(self._words(sig), (False, expected))
+            with open(marker, 'r') as fd:
+                self.assertEqual(fd.read(), 'done\n')
+        finally:
+            safe_remove(fn)
+
+
+    def test_unicode_sig(self):
+        sig = u'zunicodesigtest'
+        fn = PostingListContainer._SaveFile(self.config, sig)
+        try:
+            plc = PostingListContainer(self.session, sig)
+            plc.add(sig, ['1', 'zz', '7yw'])
+            plc.save()
+            self.assertEqual(self._words(sig), (False, {sig: [1, 1295,
+                                                              10328]}))
+        finally:
+            PLC_CACHE.pop(sig, None)
+            safe_remove(fn)
+
+
+class TestAddressIndex(MailPileUnittest):
+    def test_address_index(self):
+        idx = self.config.index
+        idx._build_address_index(self.session)
+        ai = idx.address_index()
+        self.assertEqual(len(ai), len(idx.EMAILS))
+        for term in ('twitter', 'com', 'co'):
+            expected = set(eid for eid, e in enumerate(idx.EMAILS)
+                           if term in e.lower())
+            found = ai.search([term])
+            if len(term) >= 3:
+                self.assertEqual(set(found), expected)
+            else:
+                self.assertTrue(set(found) <= expected)
+            ranks = [ai.rank(eid) for eid in found]
+            self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+        # New addresses are searchable right away
+        eid = idx.update_email('zebulon@example.org', name='Zeb Ulon')
+        self.assertEqual(ai.search(['zeb', 'ulon']), [eid])
+
+        result = self.mp.search_address('zebulon').result
+        self.assertEqual([a['address'] for a in result['addresses']],
+                         ['zebulon@example.org'])
+
+    def test_hidden_mail(self):
+        idx = MailIndex(self.config)
+        eid = idx.update_email('bob@example.org', name='Bob')
+        idx._build_address_index(self.session)
+        ai = idx.address_index()
+        hiding = self.config.get_tag_id('New')
+        idx._address_hiding_tags = lambda: set([hiding])
+        for tags, counted in (([hiding], False), ([], True)):
+            rank = ai.rank(eid)
+            msg_idx, msg_info = idx.add_new_msg(
+                'ptr%s' % counted, 'id%s' % counted, 1400000000,
+                'Bob <bob@example.org>', [], [], 1, 'Hi', '', tags)
+            self.assertEqual(ai.rank(eid), rank)
+            idx.address_seen(msg_idx)
+            self.assertEqual(ai.rank(eid) != rank, counted)
+
+    def test_scores_in_checkpoint(self):
+        idx = self.config.index
+        idx._build_address_index(self.session)
+        idx.save(self.session)
+        self.assertTrue(idx.save_checkpoint(self.session))
+
+        idx2 = MailIndex(self.config)
+        with open(self.config.mailindex_file(), 'rb') as fd:
+            idx2._load_columns(None, fd)
+        self.assertEqual(idx2._address_scores[0], len(idx.INDEX))
+        idx2._build_address_index(self.session)
+        ai, ai2 = idx.address_index(), idx2.address_index()
+        for eid in range(0, len(idx2.EMAILS)):
+            self.assertEqual(ai2.rank(eid), ai.rank(eid))
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 import mailpile
 
@@ -59,3 +61,64 @@ class TestVCard(MailPileUnittest):
         self.assertEqual(res[0], "photo")
         self.assertEqual(res[1][0], ("thing", 'comma, semicolon; backslash\\'))
         self.assertEqual(res[2], "value")
+
+
+class TestVCardStore(MailPileUnittest):
+    def _card(self, fn, email, kind='individual', key=None):
+        card = mailpile.vcard.MailpileVCard(
+            mailpile.vcard.VCardLine(name='fn', value=fn),
+            mailpile.vcard.VCardLine(name='email', value=email),
+            mailpile.vcard.VCardLine(name='kind', value=kind))
+        if key:
+            card.add(mailpile.vcard.VCardLine(name='key', value=key))
+        return card
+
+    def test_line_and_kind_indexes(self):
+        vcs = mailpile.vcard.VCardStore(self.config, tempfile.mkdtemp())
+        fpr = 'data:application/x-pgp-fingerprint,ABCD'
+        vcs.add_vcards(self._card('Alice', 'alice@x.com', key=fpr),
+                       self._card('Bob', 'bob@x.com'),
+                       self._card('Me', 'me@x.com', kind='profile'))
+        self.assertEqual([c.fn for c in vcs.find_vcards_with_line('KEY', fpr)],
+                         ['Alice'])
+
+        # Indexes are kept up to date as cards change
+        bob = vcs.get_vcard('bob@x.com')
+        vcs.deindex_vcard(bob)
+        bob.add(mailpile.vcard.VCardLine(name='key', value=fpr))
+        vcs.index_vcard(bob)
+        self.assertEqual([c.fn for c in vcs.find_vcards_with_line('key', fpr)],
+                         ['Alice', 'Bob'])
+        vcs.del_vcards(vcs.get_vcard('alice@x.com'))
+        self.assertEqual([c.fn for c in vcs.find_vcards_with_line('key', fpr)],
+                         ['Bob'])
+
+        self.assertEqual([c.fn for c in vcs.find_vcards([], kinds=['profile'])],
+                         ['Me'])
+        self.assertEqual([c.fn for c in vcs.find_vcards(['x.com'])],
+                         ['Bob', 'Me'])
+
+    def test_load_from_cache(self):
+        vcard_dir = tempfile.mkdtemp()
+        vcs = mailpile.vcard.VCardStore(self.config, vcard_dir)
+        vcs.add_vcards(self._card('Alice', 'alice@x.com'),
+                       self._card('Bob', 'bob@x.com'))
+
+        # The first load creates the cache, the second uses it
+        vcs = mailpile.vcard.VCardStore(self.config, vcard_dir)
+        vcs.load_vcards()
+        cache_file = self.config.vcard_cache_file()
+        self.assertTrue(os.path.exists(cache_file))
+        bob = vcs.get_vcard('bob@x.com')
+        os.remove(vcs.get_vcard('alice@x.com').filename)
+        bob.fn = 'Robert'
+        bob.save()
+        os.utime(bob.filename, (1, 1))
+
+        vcs = mailpile.vcard.VCardStore(self.config, vcard_dir)
+        vcs.load_vcards()
+        self.assertEqual(vcs.get_vcard('alice@x.com'), None)
+        self.assertEqual(vcs.get_vcard('bob@x.com').fn, 'Robert')
+        self.assertEqual(vcs._read_cache(cache_file).keys(),
+                         [os.path.basename(bob.filename)])
+        self.assertEqual(vcs.get_vcard('bob@x.com').filename, bob.filename)
@@ -0,0 +1,183 @@
+import re
+from array import array
+
+import mailpile.util
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+from mailpile.search_sets import IdSet
+from mailpile.util import *
+
+
+class ThreadIndex(object):
+    #
+    # This is the in-memory structure describing how messages are threaded.
+    #
+    # Each message belongs to exactly one thread, named by the index
+    # position of its root message; the metadata index stores that in each
+    # message's row (MSG_THREAD_MID), so that is what gets persisted. Here
+    # we keep the reverse mapping, from each root to the set of its replies.
+    # Messages which are alone in their threads take no space at all.
+    #
+    # We also keep the direct parent/child links, as far as we know them
+    # (from In-Reply-To and References), so a sub-thread can be split off
+    # along with everything that replied to it.
+    #
+    # Finally, for subject-based threading, we map a hash of each normalized
+    # subject to the most recent thread using it.
+    #
+    # This class does no locking, callers must do that.
+    #
+    SUBJECT_PREFIX_RE = re.compile(r'^\s*((re|fwd?|aw|sv|vs)(\[\d+\])?:\s*)+',
+                                   re.IGNORECASE)
+
+    def __init__(self):
+        self.replies = {}
+        self.parents = {}
+        self.children = {}
+        self.subjects = {}
+        self.subjects_seeded = False
+
+    @classmethod
+    def FromRoots(cls, roots):
+        """
+        Create a thread index from a list of thread roots, one per message.
+
+        >>> ti = ThreadIndex.FromRoots([0, 0, 2, 0, -1, 2])
+        >>> ti.replies
+        {0: IdSet([1, 3]), 2: IdSet([5])}
+        """
+        ti = cls()
+        replies = {}
+        for msg_idx, root in enumerate(roots):
+            if root >= 0 and root != msg_idx:
+                if root in replies:
+                    replies[root].append(msg_idx)
+                else:
+                    replies[root] = [msg_idx]
+        for root, msg_idxs in replies.iteritems():
+            ti.replies[root] = IdSet.FromSorted(msg_idxs)
+        return ti
+
+    @classmethod
+    def SubjectKey(cls, subject):
+        """
+        Return a short hash of a subject, ignoring reply/forward prefixes.
+
+        >>> (ThreadIndex.SubjectKey(u'Re: FWD: Hello  World') ==
+        ...  ThreadIndex.SubjectKey(u'hello world'))
+        True
+        >>> ThreadIndex.SubjectKey(u'Re: ') is None
+        True
+        """
+        subject = cls.SUBJECT_PREFIX_RE.sub(u'', subject or u'')
+        subject = u' '.join(subject.lower().split())
+        if not subject:
+            return None
+        return md5_hex(subject.encode('utf-8'))[:16]
+
+    def move(self, msg_idx, old_root, new_root):
+        """Record that a message has moved from one thread to another."""
+        if old_root == new_root:
+            return
+        if old_root >= 0 and old_root != msg_idx:
+            replies = self.replies.get(old_root)
+            if replies is not None:
+                replies.discard(msg_idx)
+                if not replies:
+                    del self.replies[old_root]
+        if new_root >= 0 and new_root != msg_idx:
+            if new_root not in self.replies:
+                self.replies[new_root] = IdSet()
+            self.replies[new_root].add(msg_idx)
+
+    def get_replies(self, root):
+        return self.replies.get(root) or IdSet()
+
+    def thread_size(self, root):
+        return 1 + len(self.replies.get(root, ()))
+
+    def set_parent(self, msg_idx, parent):
+        self.unlink(msg_idx)
+        if parent is not None and parent != msg_idx:
+            self.parents[msg_idx] = parent
+            if parent not in self.children:
+                self.children[parent] = IdSet()
+            self.children[parent].add(msg_idx)
+
+    def unlink(self, msg_idx):
+        parent = self.parents.pop(msg_idx, None)
+        if parent is not None:
+            kids = self.children.get(parent)
+            if kids is not None:
+                kids.discard(msg_idx)
+                if not kids:
+                    del self.children[parent]
+
+    def descendants(self, msg_idx, roots):
+        """
+        Return the messages which (directly or not) replied to a message,
+        and are still in the same thread as it.
+
+        >>> ti = ThreadIndex()
+        >>> for kid, parent in ((1, 0), (2, 1), (3, 2), (4, 0)):
+        ...     ti.set_parent(kid, parent)
+        >>> sorted(ti.descendants(1, [0, 0, 0, 3, 0]))
+        [2]
+        """
+        found, seen, todo = [], set([msg_idx]), [msg_idx]
+        root = roots[msg_idx]
+        while todo:
+            for kid in self.children.get(todo.pop(), []):
+                if roots[kid] == root and kid not in seen:
+                    seen.add(kid)
+                    found.append(kid)
+                    todo.append(kid)
+        return found
+
+    def note_subject(self, key, root, ts):
+        if key is not None:
+            if ts >= self.subjects.get(key, (None, 0))[1]:
+                self.subjects[key] = (root, ts)
+
+    def find_subject(self, key, ts, max_age):
+        root, when = self.subjects.get(key, (None, 0))
+        if root is not None and abs(ts - when) <= max_age:
+            return root
+        return None
+
+    def parent_arrays(self):
+        msg_idxs = sorted(self.parents.keys())
+        return (array('i', msg_idxs),
+                array('i', [self.parents[m] for m in msg_idxs]))
+
+    def set_parent_arrays(self, msg_idxs, parents):
+        for msg_idx, parent in zip(msg_idxs, parents):
+            self.set_parent(msg_idx, parent)
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+
+    # Moving messages around keeps the reply sets consistent
+    roots = [0, 0, 0, 3, 3, 5]
+    ti = ThreadIndex.FromRoots(roots)
+    ti.move(4, 3, 0)
+    ti.move(2, 0, 2)
+    roots[4], roots[2] = 0, 2
+    assert(ti.replies == ThreadIndex.FromRoots(roots).replies)
+    assert(ti.thread_size(0) == 3 and ti.thread_size(3) == 1)
+    assert(list(ti.get_replies(5)) == [])
+
+    # Thousands of replies are cheap to append to
+    roots = [0] * 5000
+    ti = ThreadIndex.FromRoots(roots)
+    roots.append(0)
+    ti.move(5000, -1, 0)
+    assert(ti.thread_size(0) == 5001)
+
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
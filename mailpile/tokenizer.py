@@ -0,0 +1,232 @@
+import re
+import unicodedata
+
+import mailpile.util
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+from mailpile.util import *
+
+
+##[ Stemmers ]#################################################################
+#
+# Stemmers are functions which take a (folded) word and return its stem.
+# They are looked up by language name; if PyStemmer is installed, all of
+# the Snowball stemmers it provides are available. Plugins may register
+# others with register_stemmer().
+#
+STEMMERS = {}
+
+try:
+    import Stemmer as _PyStemmer
+
+    def _snowball(language):
+        return lambda: _PyStemmer.Stemmer(language).stemWord
+
+    for _language in _PyStemmer.algorithms():
+        STEMMERS[_language] = _snowball(_language)
+except ImportError:
+    _PyStemmer = None
+
+
+def _is_ascii(text):
+    # This is much faster than searching with a regexp
+    try:
+        text.encode('ascii')
+        return True
+    except UnicodeError:
+        return False
+
+
+def register_stemmer(language, factory):
+    """Register a function which returns a stemmer for a language."""
+    STEMMERS[language.lower()] = factory
+
+
+class Tokenizer(object):
+    #
+    # This is the one place which decides how text is split into the words
+    # we index and search for; the index and the search engine must agree,
+    # so both use this (see MailIndex.tokenizer).
+    #
+    # Text is case folded and accent folded (NFKD, strip combining marks,
+    # recompose), so upper and lower case, accented and unaccented letters
+    # all match each other.
+    # Runs of CJK characters, which have no spaces between words, are split
+    # into overlapping bigrams. Plain ASCII text, which is most of what we
+    # see, takes a fast path which gives the same results as WORD_REGEXP.
+    #
+    # Short texts (header values, mostly) are memoized, as the same list
+    # names and sender names show up over and over.
+    #
+    # If the way words are produced changes, VERSION must change too, so
+    # the tokenizer migration knows to reindex.
+    #
+    VERSION = 'u1'
+    MEMO_MAX_TEXT = 256
+    MEMO_MAX_ENTRIES = 4096
+
+    COMBINING_RE = re.compile(u'[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff'
+                              u'\u20d0-\u20ff\ufe20-\ufe2f]+')
+    WORD_RE = re.compile(u'[^\\s!@#$%^&*\\(\\)_+=\\{\\}\\[\\]:\\"|;\'\\\\<>\\?,'
+                         u'\\.\\/\\-\u00a1\u00ab\u00bb\u00bf\u2010-\u2027'
+                         u'\u2030-\u205e\u3000-\u3003\u3008-\u3011]+',
+                         re.UNICODE)
+    CJK_RE = re.compile(u'([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff'
+                        u'\uac00-\ud7af\uf900-\ufaff]+)')
+    FOLD_MAP = {0xdf: u'ss', 0x17f: u's', 0x3c2: u'\u03c3'}
+
+    def __init__(self, stemmer=None, stoplist=None):
+        self.stoplist = STOPLIST if (stoplist is None) else stoplist
+        self.stemmer_name = (stemmer or '').lower()
+        self.stem_word = None
+        if self.stemmer_name in STEMMERS:
+            self.stem_word = STEMMERS[self.stemmer_name]()
+        self.signature = self.VERSION
+        if self.stem_word is not None:
+            self.signature += '+stem:%s' % self.stemmer_name
+        self._memo = ({}, {})
+
+    def fold(self, text):
+        """
+        Fold case and accents.
+
+        >>> tok = Tokenizer()
+        >>> tok.fold(u'Caf\\xe9 STRA\\xdfE \\uff21b') == u'cafe strasse ab'
+        True
+        """
+        if not isinstance(text, unicode):
+            text = text.decode('utf-8', 'replace')
+        text = text.lower()
+        if _is_ascii(text):
+            return text
+        return self._fold_non_ascii(text)
+
+    def _fold_non_ascii(self, text):
+        text = unicodedata.normalize('NFKD', text.translate(self.FOLD_MAP))
+        return unicodedata.normalize('NFKC', self.COMBINING_RE.sub(u'', text))
+
+    def _split(self, text):
+        # Returns a list of (unstemmed) words, which may repeat
+        if not isinstance(text, unicode):
+            text = text.decode('utf-8', 'replace')
+        text = text.lower()
+        if _is_ascii(text):
+            return WORD_REGEXP.findall(text)
+        text = self._fold_non_ascii(text)
+        words = []
+        for word in self.WORD_RE.findall(text):
+            if self.CJK_RE.search(word) is None:
+                if len(word) > 1:
+                    words.append(word)
+                continue
+            for i, run in enumerate(self.CJK_RE.split(word)):
+                if i % 2 == 0:
+                    if len(run) > 1:
+                        words.append(run)
+                elif len(run) == 1:
+                    words.append(run)
+                else:
+                    words.extend(run[j:j + 2] for j in range(0, len(run) - 1))
+        return words
+
+    def words(self, text, stem=True):
+        """
+        Return the words in a text, in order and without repetitions. This
+        is for parsing search terms, the stoplist is not applied.
+
+        >>> tok = Tokenizer()
+        >>> tok.words(u'The caf\\xe9, the CAFE!') == [u'the', u'cafe']
+        True
+        >>> tok.words(u'\\u6771\\u4eac\\u90fd x') == [u'\\u6771\\u4eac',
+        ...                                          u'\\u4eac\\u90fd']
+        True
+        """
+        stem_word = self.stem_word if stem else None
+        seen, words = set(), []
+        for word in self._split(text):
+            if stem_word is not None:
+                word = stem_word(word)
+            if word not in seen:
+                seen.add(word)
+                words.append(word)
+        return words
+
+    def tokenize(self, text, stem=True):
+        """
+        Return the set of words in a text, minus the stoplist. Callers
+        must not modify the set, it may be shared.
+
+        >>> sorted(Tokenizer().tokenize('The cat and THE Hat: the end.'))
+        [u'cat', u'end', u'hat']
+        """
+        short = (len(text) <= self.MEMO_MAX_TEXT)
+        if short:
+            memo = self._memo[stem and 1 or 0]
+            tokens = memo.get(text)
+            if tokens is not None:
+                return tokens
+
+        tokens = set(self._split(text))
+        if stem and self.stem_word is not None:
+            tokens = set(self.stem_word(w) for w in tokens)
+        tokens.difference_update(self.stoplist)
+
+        if short:
+            if len(memo) >= self.MEMO_MAX_ENTRIES:
+                memo.clear()
+            tokens = memo[text] = frozenset(tokens)
+        return tokens
+
+    def is_segmented(self, text):
+        """Does this text contain characters we split into bigrams?"""
+        return self.CJK_RE.search(text) is not None
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+
+    tok = Tokenizer()
+
+    # ASCII text gives the same words as WORD_REGEXP always did
+    text = 'Hello, World! re: foo-bar_baz x@y.com 3.14 it\'s ~ok~ 12'
+    assert(sorted(tok.tokenize(text)) ==
+           sorted(set(WORD_REGEXP.findall(text.lower())) - STOPLIST))
+
+    # Accents, case and compatibility forms all fold to the same word
+    for word in (u'na\u00efve', u'NA\u00cfVE', u'nai\u0308ve', u'naive'):
+        assert(tok.tokenize(word) == frozenset([u'naive']))
+    assert(tok.fold(u'\u0130stanbul') == u'istanbul')
+
+    # Unicode punctuation separates words too
+    assert(tok.words(u'\u201cquoted\u201d \u2014 dash\u2026') ==
+           [u'quoted', u'dash'])
+
+    # Hangul and kana survive the round trip through NFKD
+    assert(tok.words(u'\ud55c\uad6d\uc5b4') == [u'\ud55c\uad6d',
+                                                 u'\uad6d\uc5b4'])
+    assert(tok.words(u'\u304c') == [u'\u304c'])
+
+    # Mixed scripts, single CJK characters are kept
+    assert(tok.words(u'abc\u65e5def \u672c') == [u'abc', u'\u65e5',
+                                                 u'def', u'\u672c'])
+
+    # The memo returns the same result, and does not grow without bounds
+    assert(tok.tokenize(u'Mailpile List') is tok.tokenize(u'Mailpile List'))
+    for i in range(0, Tokenizer.MEMO_MAX_ENTRIES + 10):
+        tok.tokenize(u'name %d' % i)
+    assert(len(tok._memo[1]) <= Tokenizer.MEMO_MAX_ENTRIES)
+
+    # Stemmers are optional and pluggable
+    register_stemmer('Test', lambda: lambda w: w.rstrip('s'))
+    stok = Tokenizer(stemmer='test')
+    assert(stok.signature == 'u1+stem:test')
+    assert(stok.tokenize(u'cats and dogs') == frozenset([u'cat', u'dog']))
+    assert(stok.tokenize(u'cats', stem=False) == frozenset([u'cats']))
+    assert(Tokenizer(stemmer='klingon').signature == Tokenizer.VERSION)
+
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
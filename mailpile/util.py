@@ -476,6 +476,52 @@ def decrypt_and_parse_lines(fd, parser, config,
             _parser([line])
 
 
+def split_encrypted_chunks(fd, max_plain=1000):
+    """
+    Split a file of mixed plain-text and encrypted data into its parts,
+    yielding (encrypted, lines) tuples in the order they appear, so the
+    encrypted chunks can be decrypted independently of each other.
+    Runs of plain-text are split up every max_plain lines.
+    """
+    import mailpile.crypto.streamer as cstrm
+    pds = cstrm.PartialDecryptingStreamer
+    plain, chunk = [], None
+    for line in fd:
+        if chunk is not None:
+            chunk.append(line)
+            if pds.EndEncrypted(line):
+                yield (True, chunk)
+                chunk = None
+        elif pds.StartEncrypted(line):
+            if plain:
+                yield (False, plain)
+                plain = []
+            chunk = [line]
+        else:
+            plain.append(line)
+            if len(plain) >= max_plain:
+                yield (False, plain)
+                plain = []
+    if chunk:
+        yield (True, chunk)
+    if plain:
+        yield (False, plain)
+
+
+def decrypt_chunk_lines(chunk, config, _raise=IOError):
+    """Decrypt one chunk from split_encrypted_chunks, returning its lines."""
+    import mailpile.crypto.streamer as cstrm
+    symmetric_key = config and config.master_key or 'missing'
+    with cstrm.PartialDecryptingStreamer(
+            chunk[:1], StringIO.StringIO(''.join(chunk[1:])),
+            name='decrypt_chunk',
+            mep_key=symmetric_key,
+            gpg_pass=(config.gnupg_passphrase.get_reader()
+                      if config else None)) as pdsfd:
+        lines = list(pdsfd)
+        pdsfd.verify(_raise=_raise)
+    return lines
+
 
 # This is a hack to deal with the fact that Windows sometimes won't
 # let us delete files right away because it thinks they are still open.
@@ -3,6 +3,7 @@ import threading
 import time
 
 import mailpile.util
+from mailpile.address_index import AddressIndex
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.util import *
@@ -834,14 +835,8 @@ class MailpileVCard(SimpleVCard):
         if data:
             pass
         elif filename:
-            from mailpile.crypto.streamer import DecryptingStreamer
             self.filename = filename or self.filename
-            with open(self.filename, 'rb') as fd:
-                with DecryptingStreamer(fd,
-                                        mep_key=self.decryption_key_func(),
-                                        name='VCard/load') as streamer:
-                    data = streamer.read().decode('utf-8')
-                    streamer.verify(_raise=IOError)
+            data = self.read_file(self.filename)
         else:
             raise ValueError('Need data or a filename!')
 
@@ -861,6 +856,19 @@ class MailpileVCard(SimpleVCard):
 
         return self
 
+    def read_file(self, filename):
+        """
+        Read and decrypt a file, returning its contents as unicode.
+        """
+        from mailpile.crypto.streamer import DecryptingStreamer
+        with open(filename, 'rb') as fd:
+            with DecryptingStreamer(fd,
+                                    mep_key=self.decryption_key_func(),
+                                    name='VCard/load') as streamer:
+                data = streamer.read().decode('utf-8')
+                streamer.verify(_raise=IOError)
+        return data
+
     def save(self, filename=None):
         filename = filename or self.filename
         if filename:
@@ -972,6 +980,8 @@ class VCardStore(dict):
     Or they can be found using searches...
     >>> vcs.find_vcards(['guy'])[0].fn
     u'Guy'
+    >>> [c.fn for c in vcs.find_vcards(['ud', 'evil.c'])]
+    [u'Dude']
 
     Cards can be removed using del_vcards
     >>> vcs.del_vcards(vcs.get_vcard('d@evil.com'))
@@ -989,8 +999,41 @@ class VCardStore(dict):
         self.config = config
         self.vcard_dir = vcard_dir
         self.loaded = False
+        self._addresses = AddressIndex()
+        self._kinds = {}
+        self._line_index = {}
         self._lock = VCardRLock()
 
+    #
+    # Besides the dictionary itself, which maps e-mail addresses, group
+    # nicknames and UIDs to cards, we keep a few secondary indexes, all of
+    # which map to sets of card UIDs:
+    #
+    #   - self._kinds, by kind
+    #   - self._line_index[name][value], by the values of lines
+    #
+    # Line indexes are built the first time somebody searches for a given
+    # line name (see find_vcards_with_line) and maintained from then on.
+    # Cards must be deindexed before they are changed and reindexed after,
+    # as the commands and importers do; lookups double check the results,
+    # so a stale entry costs some time, but is otherwise harmless.
+    #
+    def _index_lines(self, card, name, lines):
+        uid = card.random_uid
+        for vcl in card.get_all(name):
+            if vcl.value not in lines:
+                lines[vcl.value] = set()
+            lines[vcl.value].add(uid)
+
+    def _card_keys(self, card, claimed=True):
+        attrs = (['email'] if (card.kind in self.KINDS_PEOPLE)
+                 else ['nickname'])
+        keys = [vcl.value.lower() for attr in attrs
+                for vcl in card.get_all(attr)]
+        if claimed:
+            keys = [k for k in keys if self.get(k) is card]
+        return keys + [card.random_uid]
+
     def index_vcard(self, card):
         attrs = (['email'] if (card.kind in self.KINDS_PEOPLE)
                  else ['nickname'])
@@ -1001,6 +1044,13 @@ class VCardStore(dict):
                     if n == 0 or key not in self:
                         self[key] = card
             self[card.random_uid] = card
+            self._addresses.add(card.random_uid, u' '.join(
+                [unicode(card.fn or '')] + self._card_keys(card, False)))
+            if card.kind not in self._kinds:
+                self._kinds[card.kind] = set()
+            self._kinds[card.kind].add(card.random_uid)
+            for name, lines in self._line_index.iteritems():
+                self._index_lines(card, name, lines)
 
     def deindex_vcard(self, card):
         attrs = (['email'] if (card.kind in self.KINDS_PEOPLE)
@@ -1014,6 +1064,75 @@ class VCardStore(dict):
                         del self[key]
             if card.random_uid in self:
                 del self[card.random_uid]
+            self._addresses.remove(card.random_uid)
+            for uids in self._kinds.values():
+                uids.discard(card.random_uid)
+            for name, lines in self._line_index.iteritems():
+                for vcl in card.get_all(name):
+                    uids = lines.get(vcl.value)
+                    if uids is not None:
+                        uids.discard(card.random_uid)
+                        if not uids:
+                            del lines[vcl.value]
+
+    #
+    # Loading one file per card gets slow once there are thousands of
+    # them, especially if they are encrypted. So after loading, we write
+    # all the cards to a single cache file (encrypted, if the cards are),
+    # and next time only the files which are missing from the cache or
+    # whose size or modification time has changed are read.
+    #
+    CACHE_MAGIC = 'Mailpile VCard cache 1'
+
+    def _cache_stamp(self, path):
+        st = os.stat(path)
+        return '%r/%d' % (st.st_mtime, st.st_size)
+
+    def _read_cache(self, cache_file):
+        cache = {}
+        if not (cache_file and os.path.exists(cache_file)):
+            return cache
+        try:
+            data = MailpileVCard(config=self.config).read_file(cache_file)
+            header, data = data.split(u'\n', 1)
+            if header != u'%s %s' % (self.CACHE_MAGIC, self.vcard_dir):
+                return cache
+            while data:
+                fn, stamp, length, data = data.split(u'\n', 3)
+                length = int(length)
+                cache[fn] = (stamp, data[:length])
+                data = data[length:]
+        except (IOError, OSError, ValueError):
+            pass
+        return cache
+
+    def _write_cache(self, cache_file, cache):
+        if not cache_file:
+            return
+        data = [u'%s %s\n' % (self.CACHE_MAGIC, self.vcard_dir)]
+        for fn in sorted(cache.keys()):
+            stamp, vcf = cache[fn]
+            data.append(u'%s\n%s\n%d\n%s' % (fn, stamp, len(vcf), vcf))
+        data = u''.join(data).encode('utf-8')
+        encryption_key = (self.config.prefs.encrypt_vcards and
+                          self.config.master_key)
+        try:
+            if encryption_key:
+                from mailpile.crypto.streamer import EncryptingStreamer
+                subj = self.config.mailpile_path(cache_file)
+                with EncryptingStreamer(encryption_key,
+                                        delimited=False,
+                                        dir=self.config.tempfile_dir(),
+                                        header_data={'subject': subj},
+                                        name='VCard/cache') as es:
+                    es.write(data)
+                    es.save(cache_file)
+            else:
+                with open(cache_file + '.new', 'wb') as fd:
+                    fd.write(data)
+                os.rename(cache_file + '.new', cache_file)
+        except (IOError, OSError):
+            safe_remove(cache_file)
 
     def load_vcards(self, session=None):
         if self.loaded:
@@ -1021,16 +1140,25 @@ class VCardStore(dict):
         try:
             with self._lock:
                 self.loaded = True
-                prfs = self.config.prefs
-                key_func = lambda: self.config.master_key
+                cache_file = self.config.vcard_cache_file()
+                cache = self._read_cache(cache_file)
+                fresh, changed = {}, False
                 for fn in sorted(os.listdir(self.vcard_dir)):
                     if mailpile.util.QUITTING:
                         return
                     try:
+                        path = os.path.join(self.vcard_dir, fn)
+                        stamp = self._cache_stamp(path)
                         c = MailpileVCard(config=self.config)
-                        c.load(os.path.join(self.vcard_dir, fn),
-                               config=self.config)
+                        if cache.get(fn, (None, ))[0] == stamp:
+                            data = cache[fn][1]
+                        else:
+                            data = c.read_file(path)
+                            changed = True
+                        c.load(data=data, config=self.config)
+                        c.filename = path
                         self.index_vcard(c)
+                        fresh[fn] = (stamp, data)
                         if session:
                             session.ui.mark('Loaded %s from %s'
                                             % (c.email, fn))
@@ -1045,6 +1173,8 @@ class VCardStore(dict):
                                 import traceback
                                 traceback.print_exc()
                             session.ui.warning('Failed to load vcard %s' % fn)
+                if changed or len(fresh) != len(cache):
+                    self._write_cache(cache_file, fresh)
         except (OSError, IOError):
             pass
 
@@ -1052,29 +1182,51 @@ class VCardStore(dict):
         return self.get(email.lower(), None)
 
     def find_vcards_with_line(vcards, name, value):
-        # FIXME: This is pretty slow. Can we do better?
-        vcards = [vc for vc in set(vcards.values())
-                  if [vcl for vcl in vc.get_all(name) if vcl.value == value]]
-        vcards.sort(key=lambda vc: (vc.fn, vc.email))
-        return vcards
+        name = name.lower()
+        with vcards._lock:
+            lines = vcards._line_index.get(name)
+            if lines is None:
+                lines = vcards._line_index[name] = {}
+                for card in vcards._all_cards():
+                    vcards._index_lines(card, name, lines)
+            found = [vcards[uid] for uid in lines.get(value, [])
+                     if uid in vcards]
+        found = [vc for vc in found
+                 if [vcl for vcl in vc.get_all(name) if vcl.value == value]]
+        found.sort(key=lambda vc: (vc.fn, vc.email))
+        return found
+
+    def _all_cards(self, kinds=None):
+        if kinds is None:
+            return dict((c.random_uid, c) for c in self.values()).values()
+        return [self[uid] for kind in set(kinds)
+                for uid in self._kinds.get(kind, [])
+                if uid in self and self[uid].kind == kind]
 
     def find_vcards(vcards, terms, kinds=None):
         kinds = kinds or vcards.KINDS_ALL
-        results = []
+        terms = [t.lower() for t in terms]
         with vcards._lock:
-            if not terms:
-                results = [set([vcards[k].random_uid for k in vcards
-                                if (vcards[k].kind in kinds) or not kinds])]
-            for term in terms:
-                term = term.lower()
-                results.append(set([vcards[k].random_uid for k in vcards
-                                    if (term in k or
-                                        term in vcards[k].fn.lower())
-                                    and ((vcards[k].kind in kinds) or
-                                         not kinds)]))
-            while len(results) > 1:
-                results[0] &= results.pop(-1)
-            results = [vcards[rid] for rid in results[0]]
+            # Terms of 3 letters or more are substring searches in the
+            # address index, which narrows things down. Everything is then
+            # checked by hand, as short terms match anywhere, not just at
+            # the beginning of words, and a card's secondary addresses only
+            # count if no other card claims them.
+            long_terms = [t for t in terms if len(t) >= 3]
+            if long_terms:
+                candidates = [vcards[rid] for rid
+                              in vcards._addresses.search(long_terms)
+                              if rid in vcards]
+            else:
+                candidates = vcards._all_cards(kinds)
+            results = []
+            for card in candidates:
+                if card.kind not in kinds:
+                    continue
+                fn, keys = card.fn.lower(), vcards._card_keys(card)
+                if not [t for t in terms if not (t in fn or
+                                                 [k for k in keys if t in k])]:
+                    results.append(card)
             results.sort(key=lambda card: card.fn)
             return results
 
@@ -1264,8 +1416,10 @@ class VCardImporter(VCardPluginClass):
                 for vcl in vcard.get_all(merge_by):
                     existing.extend(
                         vcard_store.find_vcards_with_line(merge_by, vcl.value))
-            for card in existing:
+            for card in set(existing):
+                vcard_store.deindex_vcard(card)
                 card.merge(self.config.guid, vcard.as_lines())
+                vcard_store.index_vcard(card)
                 updated.append(card)
 
             # Otherwise, create new ones.
@@ -1,3 +1,4 @@
+import heapq
 import threading
 import time
 
@@ -152,8 +153,37 @@ class Cron(threading.Thread):
 
 
 class Worker(threading.Thread):
-
-    def __init__(self, name, session, daemon=False):
+    #
+    # Jobs are kept in a heap, ordered by priority and then by the order
+    # they were added in. By default all jobs have the same priority, so
+    # they run strictly in order (the scan and save workers depend on
+    # this). Workers created with prioritize=True run jobs added by or for
+    # the user (any session other than the background one) before
+    # background jobs, so they don't wait behind long queues of rescans.
+    # Within one priority, jobs run in order, so "do this and then wait"
+    # still works.
+    #
+    # Delayed jobs (after=timestamp) wait in a second heap, ordered by
+    # time, and move to the main queue when they are due.
+    #
+    # Unique jobs are tracked by name, along with the best priority any
+    # queued job of that name has. If a unique job is added again with a
+    # better priority, the queued one is promoted instead.
+    #
+    # A worker may run several threads, for I/O bound jobs. In that case
+    # background jobs may only use all but one of them, so there is always
+    # a thread free for the user. Jobs may run in parallel then, so this is
+    # only for roles where order doesn't matter.
+    #
+    # Pausing lets the jobs queued so far finish, then holds back any new
+    # ones until unpaused, so the main session can do() things in order.
+    #
+    PRIORITY_FIRST = 0
+    PRIORITY_INTERACTIVE = 1
+    PRIORITY_BACKGROUND = 2
+
+    def __init__(self, name, session, daemon=False, threads=1,
+                 prioritize=False):
         threading.Thread.__init__(self)
         self.daemon = mailpile.util.TESTING or daemon
         self.name = name or 'Worker'
@@ -166,33 +196,83 @@ class Worker(threading.Thread):
         self.pauses = 0
         self.session = session
         self.important = False
+        self.threads = max(1, threads)
+        self.prioritize = prioritize
+        self._seq = 0
+        self._held = []
+        self._names = {}
+        self._busy = 0
+        self._busy_background = 0
+        self._active = {}
+        self.stats = {
+            'done': 0,
+            'failed': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+            'run_total': 0.0
+        }
 
     def __str__(self):
-        return ('%s: %s (%ds, jobs=%s, jobs_after=%s)'
-                % (threading.Thread.__str__(self),
-                   self.running,
-                   time.time() - self.last_run,
+        # List each running job (one per thread) and how long it has been
+        # going; when idle, whatever finished last.
+        now = time.time()
+        with self.LOCK:
+            running = ', '.join('%s (%ds)' % (name, now - started)
+                                for name, started
+                                in sorted(self._active.values()))
+        if not running:
+            running = '%s (%ds)' % (self.running, now - self.last_run)
+        return ('%s: %s (jobs=%s, jobs_after=%s)'
+                % (threading.Thread.__str__(self), running,
                    len(self.JOBS), len(self.JOBS_LATER)))
 
+    def _priority(self, session):
+        if (session is None or
+                session is getattr(session.config, 'background', None)):
+            return self.PRIORITY_BACKGROUND
+        return self.PRIORITY_INTERACTIVE
+
+    def _promote(self, name, priority):
+        # This is rare, so a linear scan is fine. The priority is the
+        # first field of JOBS entries and the third of JOBS_LATER ones.
+        for queue, pfield in ((self.JOBS, 0), (self.JOBS_LATER, 2),
+                              (self._held, 0)):
+            for i, job in enumerate(queue):
+                if job[-2] == name and job[pfield] > priority:
+                    job = list(job)
+                    job[pfield] = priority
+                    queue[i] = tuple(job)
+            heapq.heapify(queue)
+        self._names[name] = (self._names[name][0], priority)
+
     def add_task(self, session, name, task,
-                 after=None, unique=False, first=False):
+                 after=None, unique=False, first=False, priority=None):
         with self.LOCK:
-            if unique:
-                for s, n, t in self.JOBS:
-                    if n == name:
-                        return
-            if unique and after:
-                for ts, (s, n, t) in self.JOBS_LATER:
-                    if n == name:
-                        return
-
-            snt = (session, name, task)
             if first:
-                self.JOBS[:0] = [snt]
-            elif after:
-                self.JOBS_LATER.append((after, snt))
+                priority = self.PRIORITY_FIRST
+            elif not self.prioritize:
+                priority = self.PRIORITY_INTERACTIVE
+            elif priority is None:
+                priority = self._priority(session)
+
+            count, best = self._names.get(name, (0, priority))
+            if unique and count:
+                if priority < best:
+                    self._promote(name, priority)
+                    self.LOCK.notify()
+                return
+            self._names[name] = (count + 1, min(best, priority))
+
+            self._seq += 1
+            if after and after > time.time():
+                heapq.heappush(self.JOBS_LATER,
+                               (after, self._seq, priority,
+                                session, name, task))
             else:
-                self.JOBS.append(snt)
+                # The most recent "first" job goes first.
+                heapq.heappush(self._held if self.pauses else self.JOBS,
+                               (priority, first and -self._seq or self._seq,
+                                time.time(), session, name, task))
 
             self.LOCK.notify()
 
@@ -228,63 +308,131 @@ class Worker(threading.Thread):
     def _play_nice_with_threads(self):
         play_nice_with_threads()
 
-    def run(self):
-        self.ALIVE = True
+    def _runnable(self):
+        # Called with the lock held. Moves delayed jobs which are due to
+        # the main queue, and checks whether one of our threads may take
+        # the job at the front of it.
+        now = time.time()
+        while (self.JOBS_LATER and self.JOBS_LATER[0][0] <= now and
+                not self.pauses):
+            ts, seq, priority, session, name, task = heapq.heappop(
+                self.JOBS_LATER)
+            heapq.heappush(self.JOBS, (priority, seq, ts, session, name, task))
+        if not self.JOBS:
+            return False
+        return (self.threads == 1 or
+                self.JOBS[0][0] < self.PRIORITY_BACKGROUND or
+                self._busy_background < self.threads - 1)
+
+    def _wait_time(self):
+        if self.JOBS_LATER:
+            return max(0.01, self.JOBS_LATER[0][0] - time.time())
+        return None
+
+    def _run_jobs(self):
         while self._keep_running():
             with self.LOCK:
-                while len(self.JOBS) < 1:
+                while not self._runnable():
                     if not self._keep_running(locked=True):
                         return
-                    self.LOCK.wait()
+                    self.LOCK.wait(self._wait_time())
 
             self._play_nice_with_threads()
             with self.LOCK:
-                session, name, task = self.JOBS.pop(0)
-                if len(self.JOBS) < 0:
-                    now = time.time()
-                    self.JOBS.extend(snt for ts, snt
-                                     in self.JOBS_LATER if ts <= now)
-                    self.JOBS_LATER = [(ts, snt) for ts, snt
-                                       in self.JOBS_LATER if ts > now]
+                if not self._runnable():
+                    continue
+                priority, seq, ts, session, name, task = heapq.heappop(
+                    self.JOBS)
+                count, best = self._names[name]
+                if count > 1:
+                    self._names[name] = (count - 1, best)
+                else:
+                    del self._names[name]
+                background = (priority >= self.PRIORITY_BACKGROUND)
+                started = time.time()
+                thread_id = threading.current_thread().ident
+                self._active[thread_id] = (name, started)
+                self._busy += 1
+                self._busy_background += background and 1 or 0
+                waited = time.time() - ts
+                self.stats['wait_total'] += waited
+                self.stats['wait_max'] = max(waited, self.stats['wait_max'])
+
+            failed = False
             try:
-                self.last_run = time.time()
-                self.running = name
                 if session:
                     session.ui.mark('Starting: %s' % name)
                     session.report_task_completed(name, task())
                 else:
                     task()
             except (IOError, OSError), e:
+                failed = True
                 self._failed(session, name, task, e)
                 time.sleep(1)
             except Exception, e:
+                failed = True
                 self._failed(session, name, task, e)
             finally:
-                self.last_run = time.time()
-                self.running = 'Finished %s' % self.running
+                with self.LOCK:
+                    self._busy -= 1
+                    self._busy_background -= background and 1 or 0
+                    self.stats['done'] += 1
+                    self.stats['failed'] += failed and 1 or 0
+                    self.stats['run_total'] += time.time() - started
+                    del self._active[thread_id]
+                    self.last_run = time.time()
+                    self.running = 'Finished %s' % name
+                    self.LOCK.notify_all()
+
+    def run(self):
+        self.ALIVE = True
+        for i in range(1, self.threads):
+            helper = threading.Thread(target=self._run_jobs,
+                                      name='%s/%d' % (self.name, i))
+            helper.daemon = self.daemon
+            helper.start()
+        self._run_jobs()
+
+    def status(self):
+        """Queue depth and latency figures, for ProgramStatus."""
+        with self.LOCK:
+            done = max(1, self.stats['done'])
+            return {
+                'name': self.name,
+                'threads': self.threads,
+                'running': self._busy,
+                'queued': len(self.JOBS) + len(self._held),
+                'later': len(self.JOBS_LATER),
+                'paused': self.pauses,
+                'done': self.stats['done'],
+                'failed': self.stats['failed'],
+                'wait_avg_ms': int(1000 * self.stats['wait_total'] / done),
+                'wait_max_ms': int(1000 * self.stats['wait_max']),
+                'run_avg_ms': int(1000 * self.stats['run_total'] / done)
+            }
 
     def pause(self, session):
+        # New jobs are held back from now on; wait for the ones queued
+        # before to run and for the running ones to finish.
         with self.LOCK:
             self.pauses += 1
-            first = (self.pauses == 1)
-
-        if first:
-            def pause_task():
-                session.report_task_completed('Pause', True)
-                session.wait_for_task('Unpause', quiet=True)
-
-            self.add_task(None, 'Pause', pause_task)
-            session.wait_for_task('Pause', quiet=True)
+            while (self.JOBS or self._busy) and self.isAlive():
+                self.LOCK.wait(1)
 
     def unpause(self, session):
         with self.LOCK:
             self.pauses -= 1
-            if self.pauses == 0:
-                session.report_task_completed('Unpause', True)
+            if not self.pauses:
+                for job in self._held:
+                    heapq.heappush(self.JOBS, job)
+                self._held = []
+            self.LOCK.notify_all()
 
     def die_soon(self, session=None):
         def die():
-            self.ALIVE = False
+            with self.LOCK:
+                self.ALIVE = False
+                self.LOCK.notify_all()
         self.add_task(session, '%s shutdown' % self.name, die)
 
     def quit(self, session=None, join=True):
@@ -331,12 +479,28 @@ class ImportantWorker(Worker):
             play_nice_with_threads()
 
 
+class LowPriorityWorker(Worker):
+    IDLE_SECONDS = 10
+    MAX_WAIT = 60
+
+    def _play_nice_with_threads(self):
+        # Background housekeeping waits (a while) for the user to go idle
+        # before each job, so it does not compete with interactive use.
+        for i in range(0, self.MAX_WAIT):
+            if (mailpile.util.QUITTING or
+                    mailpile.util.LAST_USER_ACTIVITY <
+                    time.time() - self.IDLE_SECONDS):
+                break
+            time.sleep(1)
+        play_nice_with_threads()
+
+
 class DumbWorker(Worker):
-    def add_task(self, session, name, task, unique=False):
+    def add_task(self, session, name, task, unique=False, **kwargs):
         with self.LOCK:
             return task()
 
-    def add_unique_task(self, session, name, task):
+    def add_unique_task(self, session, name, task, **kwargs):
         return self.add_task(session, name, task)
 
     def do(self, session, name, task, unique=False):
@@ -349,6 +513,91 @@ class DumbWorker(Worker):
 if __name__ == "__main__":
     import doctest
     import sys
+
+    class _Config(object):
+        background = None
+
+    class _Session(object):
+        def __init__(self, config):
+            self.config = config
+            self.ui = self
+
+        def mark(self, *args):
+            pass
+
+        def report_task_completed(self, *args):
+            pass
+
+    config = _Config()
+    config.background = _Session(config)
+    user = _Session(config)
+    ran = []
+
+    # By default, jobs run strictly in order, whoever added them.
+    w = Worker('Test worker', None)
+    w.add_task(config.background, 'bg', lambda: ran.append('bg'))
+    w.add_task(user, 'user', lambda: ran.append('user'))
+    w.add_task(user, 'urgent', lambda: ran.append('urgent'), priority=0)
+    w.start()
+    w.pause(None)
+    assert(ran == ['bg', 'user', 'urgent'])
+
+    # Once paused, queued jobs have run and new ones wait for unpause.
+    w.add_task(None, 'held', lambda: ran.append('held'))
+    time.sleep(0.1)
+    assert(ran == ['bg', 'user', 'urgent'] and w.status()['queued'] == 1)
+    w.unpause(None)
+    w.quit()
+    assert(ran[-1] == 'held')
+    ran = []
+
+    # Interactive jobs go before background ones, otherwise jobs run in
+    # order; unique jobs are only queued once, but get promoted.
+    w = Worker('Test worker', None, prioritize=True)
+    for i in range(0, 5):
+        w.add_task(config.background, 'bg%d' % i,
+                   lambda i=i: ran.append('bg%d' % i))
+    w.add_task(user, 'user', lambda: ran.append('user'))
+    w.add_task(None, 'first', lambda: ran.append('first'), first=True)
+    w.add_unique_task(config.background, 'bg3', lambda: ran.append('dup'))
+    w.add_unique_task(user, 'bg4', lambda: ran.append('dup'))
+    w.add_task(None, 'later', lambda: ran.append('later'),
+               after=time.time() + 0.5)
+    assert(w.status()['queued'] == 7 and w.status()['later'] == 1)
+    w.start()
+    while len(ran) < 8:
+        time.sleep(0.05)
+    w.quit()
+    assert(ran == ['first', 'bg4', 'user', 'bg0', 'bg1', 'bg2', 'bg3',
+                   'later'])
+    assert(w.status()['done'] == 9 and w.status()['queued'] == 0)
+
+    # With several threads, background jobs leave one free for the user.
+    w = Worker('Test pool', None, threads=3, prioritize=True)
+    w.start()
+    for i in range(0, 3):
+        w.add_task(None, 'slow', lambda: time.sleep(0.5))
+    time.sleep(0.1)
+    t0 = time.time()
+    assert(w.do(None, 'quick', lambda: 1))
+    w.add_task(user, 'quick', lambda: ran.append('quick'))
+    while 'quick' not in ran:
+        time.sleep(0.01)
+    assert(time.time() - t0 < 0.3)
+    w.pause(None)
+    assert(w.status()['running'] == 0)
+    w.unpause(None)
+
+    # Each thread times its own job.
+    while w.status()['queued'] or w.status()['running']:
+        time.sleep(0.05)
+    run_total = w.stats['run_total']
+    w.add_task(None, 'nap', lambda: time.sleep(0.5))
+    w.add_task(None, 'snooze', lambda: time.sleep(0.5))
+    time.sleep(0.1)
+    assert(': nap (0s), snooze (0s) (' in str(w))
+    w.quit()
+    assert(0.9 < w.stats['run_total'] - run_total < 1.1)
     result = doctest.testmod(optionflags=doctest.ELLIPSIS,
                              extraglobs={'junk': {}})
     print '%s' % (result, )
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+#
+# This compares the throughput of the in-process and the openssl coprocess
+# backends of mailpile.crypto.streamer, for a range of (posting list and
+# metadata index chunk sized) payloads.
+#
+import os
+import sys
+import time
+from tempfile import mkdtemp
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+import mailpile.crypto.streamer as streamer
+
+
+def benchmark(size, count, in_process):
+    streamer.IN_PROCESS_CRYPTO = in_process
+    data = ''.join('%8.8x some index data\n' % i
+                   for i in range(0, size / 23 + 1))[:size]
+    fn = os.path.join(tmpdir, 'benchmark.aes')
+
+    t0 = time.time()
+    for i in range(0, count):
+        with streamer.EncryptingStreamer('benchmark key', dir=tmpdir,
+                                         delimited=False) as es:
+            es.write(data)
+            es.save(fn)
+    t1 = time.time()
+    for i in range(0, count):
+        with open(fn, 'rb') as fd:
+            with streamer.DecryptingStreamer(fd, mep_key='benchmark key',
+                                             md5sum=es.outer_md5sum) as ds:
+                assert(ds.read() == data)
+                assert(ds.verify())
+    t2 = time.time()
+    os.remove(fn)
+    return (t1 - t0, t2 - t1)
+
+
+if not streamer.InProcessBackend('aes-256-cbc'):
+    print 'No in-process AES backend found (try: pip install cryptography)'
+    sys.exit(1)
+
+tmpdir = mkdtemp()
+try:
+    for size, count in ((1024, 200), (64 * 1024, 100), (4096 * 1024, 5)):
+        for in_process in (False, True):
+            enc, dec = benchmark(size, count, in_process)
+            mb = float(size * count) / (1024 * 1024)
+            print ('%-10s %8d bytes x %3d: encrypt %6.3fs (%7.2f MB/s), '
+                   'decrypt %6.3fs (%7.2f MB/s)'
+                   % (in_process and 'in-process' or 'openssl',
+                      size, count, enc, mb / enc, dec, mb / dec))
+finally:
+    os.rmdir(tmpdir)